@@ -0,0 +1,379 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Dict
+from icecream import ic
+import csv
+import json
+import time
+import fire
+
+import numpy as np
+
+from decouple import config
+
+from utils import build_single_field_query, build_multiple_fields_query, build_hybrid_query, build_knn_query, \
+    build_source_filter, build_search_request, elastic_client, elastic_index_name, elastic_sparse_field_name, fuzzy_fuzziness, multi_suggest_fields
+
+batch_size = config('BATCH_SIZE', default=20, cast=int)
+batch_concurrency = config('BATCH_CONCURRENCY', default=4, cast=int)
+
+def build_per_field_fuzzy_query(searchterm: str,
+                                field_names=None,
+                                fuzziness: str = None,
+                                source_fields: List[str] = None,
+                                size: int = 10) -> Dict:
+    """
+    Build the multi-field fuzzy query the pages used before it became a fuzzy multi_match: one
+    unbounded fuzzy clause per field, in a bool should. Only kept as a baseline for `compare`.
+    """
+    fields = [field.split("^")[0] for field in field_names]
+
+    return {
+        "query": {
+            "bool": {
+                "should": [{"fuzzy": {field: {"value": searchterm, "fuzziness": fuzziness if fuzziness else "AUTO"}}}
+                           for field in fields]
+            }
+        },
+        "size": size,
+        "_source": build_source_filter(source_fields),
+    }
+
+multi_field_names = [field.strip() for field in multi_suggest_fields.split(",")]
+
+# each search mode, with the same parameters the search pages use. The "_baseline" modes are
+# the fuzzy queries as they were before prefix_length and max_expansions were set, to compare against.
+search_modes = {
+    "match": (build_single_field_query, {"field_name": "text", "search_type": "match"}),
+    "fuzzy": (build_single_field_query, {"field_name": "text", "search_type": "fuzzy", "fuzziness": fuzzy_fuzziness}),
+    "fuzzy_baseline": (build_single_field_query, {"field_name": "text", "search_type": "fuzzy", "fuzziness": "2",
+                                                  "prefix_length": 0, "max_expansions": 50, "transpositions": True,
+                                                  "trigram_prefilter": False}),
+    "semantic": (build_single_field_query, {"field_name": elastic_sparse_field_name, "search_type": "semantic"}),
+    "multi_field": (build_multiple_fields_query, {"field_names": multi_field_names, "search_type": "match"}),
+    "multi_field_fuzzy": (build_multiple_fields_query, {"field_names": multi_field_names, "search_type": "fuzzy", "fuzziness": fuzzy_fuzziness}),
+    "multi_field_fuzzy_baseline": (build_per_field_fuzzy_query, {"field_names": multi_field_names, "fuzziness": "2"}),
+    "hybrid": (build_hybrid_query, {"field_names": ["text", "heading"]}),
+    "knn": (build_knn_query, {}),
+}
+
+# the batch only needs ids and scores back
+msearch_filter_path = ['responses.took', 'responses.status', 'responses.error.type', 'responses.error.reason',
+                       'responses.hits.hits._id', 'responses.hits.hits._score']
+
+# the builders whose queries can be sent as stored search templates
+templated_builders = [build_single_field_query, build_multiple_fields_query, build_hybrid_query]
+
+def build_mode_query(mode: str,
+                     searchterm: str,
+                     size: int = 10,
+                     templates: bool = False,
+                     client=elastic_client,
+                     **params) -> Dict:
+    """
+    Build the query body for a search mode.
+
+    Args:
+        mode (str): The search mode, one of the keys of `search_modes`.
+        searchterm (str): The search term to query.
+        size (int): The number of hits to return. Default is 10.
+        templates (bool): Whether to build a search template request, for the modes that have
+            one. Default is False.
+        client (Elasticsearch): The Elasticsearch client to store the template with.
+        **params: Overrides for the default parameters of the mode.
+
+    Returns:
+        dict: The query body, without highlighting or `_source`, or the template request.
+    """
+    builder, defaults = search_modes[mode]
+
+    if templates and builder in templated_builders:
+        return build_search_request(builder, searchterm, size=size, templates=True, client=client, **{**defaults, **params})
+
+    query_body = builder(searchterm, size=size, **{**defaults, **params})
+    query_body.pop("highlight", None)
+    query_body["_source"] = False
+    return query_body
+
+def parse_modes(modes) -> List[str]:
+    """
+    Parse the modes given on the command line, either as a comma separated string or a list.
+    """
+    if isinstance(modes, str):
+        modes = modes.split(",")
+    modes = [mode.strip() for mode in modes]
+
+    unknown = [mode for mode in modes if mode not in search_modes]
+    if unknown:
+        raise ValueError("Unknown search modes {}, expected some of {}".format(unknown, list(search_modes)))
+
+    return modes
+
+def read_queries(queries_fn: str) -> List[Dict]:
+    """
+    Read queries from a JSONL or CSV file.
+
+    JSONL lines and CSV rows need a "query" field, and can have an "id" field. Any other
+    field is kept, so that judgments or notes travel with the query.
+
+    Args:
+        queries_fn (str): The path to the file.
+
+    Returns:
+        list: The queries, each a dictionary with at least an "id" and a "query" key.
+    """
+    with open(queries_fn, 'r', encoding='utf-8') as f:
+        if queries_fn.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    queries = []
+    for count, row in enumerate(rows, start=1):
+        row = dict(row)
+        row["id"] = str(row.get("id") or "query-{}".format(count))
+        queries.append(row)
+
+    return queries
+
+def run_msearch(bodies: List[Dict],
+                index_name=elastic_index_name,
+                client=elastic_client):
+    """
+    Run query bodies in a single msearch request, or template requests in a single msearch_template request.
+
+    Args:
+        bodies (list): The query bodies, or the template requests.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The Elasticsearch client.
+
+    Returns:
+        tuple: The responses, in the same order as the bodies, and the round trip in milliseconds.
+    """
+    searches = []
+    for body in bodies:
+        searches.append({})
+        searches.append(body)
+
+    start = time.perf_counter()
+    if bodies and all('params' in body for body in bodies):
+        response = client.msearch_template(index=index_name, search_templates=searches, filter_path=msearch_filter_path)
+    else:
+        response = client.msearch(index=index_name, searches=searches, filter_path=msearch_filter_path)
+    round_trip_ms = (time.perf_counter() - start) * 1000
+
+    return response["responses"], round_trip_ms
+
+def run_mode(mode: str,
+             queries: List[Dict],
+             size: int = 10,
+             batch_size: int = batch_size,
+             concurrency: int = batch_concurrency,
+             index_name=elastic_index_name,
+             client=elastic_client,
+             templates: bool = False,
+             **params) -> List[Dict]:
+    """
+    Run queries through one search mode, in msearch batches sent concurrently.
+
+    Args:
+        mode (str): The search mode, one of the keys of `search_modes`.
+        queries (list): The queries, as returned by `read_queries`.
+        size (int): The number of hits to return per query. Default is 10.
+        batch_size (int): The number of queries per msearch request.
+        concurrency (int): The number of msearch requests in flight at the same time.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The Elasticsearch client.
+        templates (bool): Whether to send stored search templates, with msearch_template. Default is False.
+        **params: Overrides for the default parameters of the mode.
+
+    Returns:
+        list: One record per query, with its latencies, hit IDs and scores.
+    """
+    batches = [queries[i:i + batch_size] for i in range(0, len(queries), batch_size)]
+
+    def run_one_batch(batch_number, batch):
+        bodies = [build_mode_query(mode, query["query"], size=size, templates=templates, client=client, **params)
+                  for query in batch]
+        responses, round_trip_ms = run_msearch(bodies, index_name=index_name, client=client)
+
+        records = []
+        for query, response in zip(batch, responses):
+            hits = response.get("hits", {}).get("hits", [])
+            records.append({
+                "mode": mode,
+                "id": query["id"],
+                "query": query["query"],
+                "took_ms": response.get("took"),
+                "batch_number": batch_number,
+                "batch_ms": round_trip_ms,
+                "batch_size": len(batch),
+                "hit_ids": [hit["_id"] for hit in hits],
+                "scores": [hit["_score"] for hit in hits],
+                "error": response.get("error"),
+            })
+        return records
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return [record for records in executor.map(run_one_batch, range(len(batches)), batches) for record in records]
+
+def summarize_records(records: List[Dict], wall_time_s: float) -> Dict:
+    """
+    Summarize the latencies and throughput of the records of one mode.
+
+    Args:
+        records (list): The records returned by `run_mode`.
+        wall_time_s (float): The wall time it took to run them, in seconds.
+
+    Returns:
+        dict: The count, errors, QPS and took/batch percentiles.
+    """
+    took = np.array([record["took_ms"] for record in records if record["took_ms"] is not None], dtype=float)
+    batch = np.array(list({record["batch_number"]: record["batch_ms"] for record in records}.values()), dtype=float)
+
+    summary = {
+        "queries": len(records),
+        "errors": sum(1 for record in records if record["error"]),
+        "zero_hits": sum(1 for record in records if not record["hit_ids"]),
+        "qps": len(records) / wall_time_s if wall_time_s else None,
+    }
+
+    for name, values in [("took_ms", took), ("batch_ms", batch)]:
+        for percentile in [50, 90, 99]:
+            summary[f"{name}_p{percentile}"] = float(np.percentile(values, percentile)) if len(values) else None
+
+    return summary
+
+def run_batch(queries_fn: str,
+              output_fn: str = "batch_results.jsonl",
+              modes="match,fuzzy,semantic,multi_field,hybrid",
+              size: int = 10,
+              batch_size: int = batch_size,
+              concurrency: int = batch_concurrency,
+              index_name=elastic_index_name,
+              client=elastic_client,
+              templates: bool = False) -> Dict:
+    """
+    Run a file of queries through each search mode and record their latency and results.
+
+    Args:
+        queries_fn (str): The path to a JSONL or CSV file of queries.
+        output_fn (str): The path of the JSONL file to write one record per query and mode to.
+        modes (str): The search modes to run, comma separated. Default is all of them.
+        size (int): The number of hits to return per query. Default is 10.
+        batch_size (int): The number of queries per msearch request.
+        concurrency (int): The number of msearch requests in flight at the same time.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The Elasticsearch client.
+        templates (bool): Whether to send stored search templates, with msearch_template. Default is False.
+
+    Returns:
+        dict: The summary of each mode, as returned by `summarize_records`.
+    """
+    queries = read_queries(queries_fn)
+    summaries = {}
+
+    with open(output_fn, 'w', encoding='utf-8') as output_file:
+        for mode in parse_modes(modes):
+            start = time.perf_counter()
+            records = run_mode(mode, queries,
+                               size=size,
+                               batch_size=batch_size,
+                               concurrency=concurrency,
+                               index_name=index_name,
+                               client=client,
+                               templates=templates)
+            summaries[mode] = summarize_records(records, time.perf_counter() - start)
+
+            for record in records:
+                output_file.write(json.dumps(record) + "\n")
+
+            ic(mode, summaries[mode])
+
+    return summaries
+
+def compare_modes(queries_fn: str,
+                  baseline: str = "fuzzy_baseline",
+                  candidate: str = "fuzzy",
+                  size: int = 10,
+                  repeat: int = 3,
+                  batch_size: int = batch_size,
+                  concurrency: int = batch_concurrency,
+                  index_name=elastic_index_name,
+                  client=elastic_client,
+                  **params) -> Dict:
+    """
+    Benchmark a search mode against a baseline: how much faster it is, and how many of the
+    baseline's hits it still finds.
+
+    The modes are run alternately `repeat` times, so caches warm up evenly for both, and the
+    latency of each mode is taken over every run. The recall of a query is the share of the
+    baseline's top `size` hits that are also in the candidate's.
+
+    Args:
+        queries_fn (str): The path to a JSONL or CSV file of queries.
+        baseline (str): The mode to compare against. Default is "fuzzy_baseline".
+        candidate (str): The mode to benchmark. Default is "fuzzy".
+        size (int): The number of hits to compare per query. Default is 10.
+        repeat (int): The number of times to run each mode. Default is 3.
+        batch_size (int): The number of queries per msearch request.
+        concurrency (int): The number of msearch requests in flight at the same time.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The Elasticsearch client.
+        **params: Overrides for the default parameters of the candidate, e.g. --prefix_length 2.
+
+    Returns:
+        dict: The latency summary of each mode, the speedup of the median took time, and the
+            mean recall of the candidate against the baseline.
+    """
+    queries = read_queries(queries_fn)
+    parse_modes([baseline, candidate])
+
+    runs = {baseline: [], candidate: []}
+    wall_times = {baseline: 0.0, candidate: 0.0}
+
+    for _ in range(repeat):
+        for mode, mode_params in [(baseline, {}), (candidate, params)]:
+            start = time.perf_counter()
+            runs[mode].extend(run_mode(mode, queries,
+                                       size=size,
+                                       batch_size=batch_size,
+                                       concurrency=concurrency,
+                                       index_name=index_name,
+                                       client=client,
+                                       **mode_params))
+            wall_times[mode] += time.perf_counter() - start
+
+    summaries = {mode: summarize_records(records, wall_times[mode]) for mode, records in runs.items()}
+
+    # the hits of the last run of each mode, by query
+    baseline_hits = {record["id"]: record["hit_ids"] for record in runs[baseline][-len(queries):]}
+    candidate_hits = {record["id"]: record["hit_ids"] for record in runs[candidate][-len(queries):]}
+
+    recalls = [len(set(hit_ids) & set(candidate_hits[query_id])) / len(hit_ids)
+               for query_id, hit_ids in baseline_hits.items() if hit_ids]
+
+    comparison = {
+        "baseline": summaries[baseline],
+        "candidate": summaries[candidate],
+        "speedup_took_p50": summaries[baseline]["took_ms_p50"] / summaries[candidate]["took_ms_p50"]
+            if summaries[baseline]["took_ms_p50"] and summaries[candidate]["took_ms_p50"] else None,
+        f"recall@{size}": float(np.mean(recalls)) if recalls else None,
+    }
+
+    ic(comparison)
+    return comparison
+
+if __name__ == "__main__":
+
+    # Invoking this function would look something like:
+    #   python batch.py run queries.jsonl  (grabs defaults from .env)
+    #   python batch.py run queries.csv --modes match,semantic --batch_size 50 --concurrency 8 --output_fn results.jsonl
+    #   python batch.py run queries.jsonl --templates  (sends stored search templates with msearch_template)
+    #   python batch.py compare queries.jsonl  (bounded fuzzy against the unbounded one)
+    #   python batch.py compare queries.jsonl --baseline multi_field_fuzzy_baseline --candidate multi_field_fuzzy
+    #   python batch.py compare queries.jsonl --prefix_length 2 --trigram_prefilter True
+
+    fire.Fire({
+        "run": run_batch,
+        "compare": compare_modes,
+    })
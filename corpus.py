@@ -0,0 +1,339 @@
+from icecream import ic
+from functools import lru_cache
+from itertools import islice
+from typing import List, Dict, Tuple
+from array import array
+import codecs
+import fnmatch
+import glob
+import json
+import mmap
+import os
+import threading
+
+import markdown
+
+from decouple import config
+
+raw_data = config('RAW_DATA', default='none')
+corpus_store_dir = config('CORPUS_STORE_DIR', default='.corpus')
+corpus_cache_size = config('CORPUS_CACHE_SIZE', default=32, cast=int)
+
+CORPUS_INDEX_FN = "index.json"
+CORPUS_HTML_FN = "html.bin"
+CORPUS_TEXT_FN = "text.bin"
+CORPUS_LINES_FN = "lines.bin"
+CORPUS_STORE_VERSION = 2
+
+def read_line_window(file_path: str, line_number: int, context: int = 5) -> Tuple[int, List[str]]:
+    """
+    Read a window of lines around a line directly from a file, without a corpus store.
+
+    Args:
+        file_path (str): The path to the file.
+        line_number (int): The 1-based line number to center the window on.
+        context (int): The number of lines to include before and after the line.
+
+    Returns:
+        tuple: The 1-based number of the first line in the window, and the lines.
+    """
+    first_line = max(1, line_number - context)
+    with open(file_path, 'r', encoding='utf-8') as file:
+        lines = list(islice(file, first_line - 1, line_number + context))
+    return first_line, [line.rstrip('\n') for line in lines]
+
+def render_markdown_file(markdown_file: str) -> str:
+    """
+    Load a markdown file and convert it to HTML.
+
+    Args:
+        markdown_file (str): The path to the markdown file.
+
+    Returns:
+        str: The rendered HTML.
+    """
+    with codecs.open(markdown_file, "r", encoding="utf-8") as input_file:
+        text = input_file.read()
+    return markdown.markdown(text)
+
+def matches_raw_data(file_path: str, raw_data=raw_data) -> bool:
+    """
+    Check whether a path matches the RAW_DATA pattern, the way `glob.glob(..., recursive=True)`
+    would match it: wildcards stay within one directory, and a `**` part matches any number
+    of directories, none included.
+    """
+    file_parts = os.path.abspath(file_path).split(os.sep)
+    pattern_parts = os.path.abspath(raw_data).split(os.sep)
+
+    def match(file_index, pattern_index):
+        if pattern_index == len(pattern_parts):
+            return file_index == len(file_parts)
+
+        part = pattern_parts[pattern_index]
+        if part == "**":
+            return any(match(i, pattern_index + 1) for i in range(file_index, len(file_parts) + 1))
+
+        return file_index < len(file_parts) and \
+            fnmatch.fnmatch(file_parts[file_index], part) and \
+            match(file_index + 1, pattern_index + 1)
+
+    return match(0, 0)
+
+def raw_data_root(raw_data=raw_data) -> str:
+    """
+    Get the deepest directory of the RAW_DATA pattern that has no wildcard, which is the one to watch.
+    """
+    root = []
+    for part in os.path.abspath(raw_data).split(os.sep):
+        if glob.has_magic(part):
+            break
+        root.append(part)
+
+    root = os.sep.join(root) or os.sep
+    return root if os.path.isdir(root) else os.path.dirname(root)
+
+def build_corpus_store(raw_data=raw_data,
+                       store_dir=corpus_store_dir):
+    """
+    Build the local corpus store used by the File Browser page.
+
+    Every file matching the glob is rendered to HTML once and appended to a single
+    blob, and an index with the file list and the byte offset/length of each rendered
+    document is written next to it. The raw text goes into a second blob, with a
+    line-offset table so any window of lines can be sliced out without scanning the
+    file. Line numbers follow the ones `index_file_to_elasticsearch` gives each hit.
+    Everything is written to temporary names and swapped in at the end, so a running
+    app never sees a half-written store.
+
+    Args:
+        raw_data (str): The path pattern to match the files to store.
+        store_dir (str): The directory to write the store into.
+
+    Returns:
+        int: The number of files in the store.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+
+    index_path = os.path.join(store_dir, CORPUS_INDEX_FN)
+    html_path = os.path.join(store_dir, CORPUS_HTML_FN)
+    text_path = os.path.join(store_dir, CORPUS_TEXT_FN)
+    lines_path = os.path.join(store_dir, CORPUS_LINES_FN)
+
+    files = []
+    html_offset = 0
+    text_offset = 0
+    line_offsets = array('Q')
+
+    with open(html_path + ".tmp", 'wb') as html_file, open(text_path + ".tmp", 'wb') as text_file:
+        for file_path in sorted(glob.glob(raw_data, recursive=True)):
+            html = render_markdown_file(file_path).encode('utf-8')
+            html_file.write(html)
+
+            with open(file_path, 'rb') as raw_file:
+                text = raw_file.read()
+            text_file.write(text)
+
+            # one start offset per line, plus the end of the file, relative to the file's text
+            lines_start = len(line_offsets)
+            position = 0
+            for line in text.splitlines(keepends=True):
+                line_offsets.append(position)
+                position += len(line)
+            line_offsets.append(position)
+
+            files.append({
+                "path": file_path,
+                "file_name": os.path.basename(file_path),
+                "mtime": os.path.getmtime(file_path),
+                "html_offset": html_offset,
+                "html_length": len(html),
+                "text_offset": text_offset,
+                "text_length": len(text),
+                "lines_offset": lines_start,
+                "line_count": len(line_offsets) - lines_start - 1,
+            })
+            html_offset += len(html)
+            text_offset += len(text)
+
+    with open(lines_path + ".tmp", 'wb') as lines_file:
+        line_offsets.tofile(lines_file)
+
+    with open(index_path + ".tmp", 'w', encoding='utf-8') as index_file:
+        json.dump({"version": CORPUS_STORE_VERSION, "files": files}, index_file)
+
+    os.replace(html_path + ".tmp", html_path)
+    os.replace(text_path + ".tmp", text_path)
+    os.replace(lines_path + ".tmp", lines_path)
+    os.replace(index_path + ".tmp", index_path)
+
+    ic("Built corpus store {} with {} files".format(store_dir, len(files)))
+
+    return len(files)
+
+class CorpusStore:
+    """
+    Read-only view over a corpus store written by `build_corpus_store`.
+
+    The file list is only loaded the first time it is needed, the rendered HTML and
+    raw text are memory-mapped rather than read, and the most recently used documents
+    are kept decoded in an LRU cache. When the store is rebuilt, `reopen_if_rebuilt` closes
+    it, and the next read opens the new one.
+    """
+
+    def __init__(self, store_dir=corpus_store_dir, cache_size=corpus_cache_size):
+        self.store_dir = store_dir
+        self._files = None
+        self._by_path = None
+        self._by_name = None
+        self._mmap = None
+        self._text_mmap = None
+        self._line_offsets = None
+        self._built_at = None
+        self._lock = threading.Lock()
+        self.html = lru_cache(maxsize=cache_size)(self._read_html)
+
+    @staticmethod
+    def exists(store_dir=corpus_store_dir) -> bool:
+        """
+        Check whether a corpus store has been built in the directory.
+        """
+        return all(os.path.exists(os.path.join(store_dir, fn))
+                   for fn in (CORPUS_INDEX_FN, CORPUS_HTML_FN, CORPUS_TEXT_FN, CORPUS_LINES_FN))
+
+    @property
+    def files(self) -> List[Dict]:
+        """
+        The entries in the store, loaded lazily from the index file.
+        """
+        if self._files is None:
+            with open(os.path.join(self.store_dir, CORPUS_INDEX_FN), 'r', encoding='utf-8') as index_file:
+                # the index file is replaced last by a rebuild, so its time tells the builds apart
+                self._built_at = os.fstat(index_file.fileno()).st_mtime
+                self._files = json.load(index_file)["files"]
+            self._by_path = {entry["path"]: entry for entry in self._files}
+            self._by_name = {entry["file_name"]: entry for entry in self._files}
+        return self._files
+
+    def paths(self) -> List[str]:
+        """
+        Get the paths of every file in the store.
+        """
+        return [entry["path"] for entry in self.files]
+
+    def search(self, term: str = "") -> List[str]:
+        """
+        Get the paths of the files whose path contains the term (case insensitive).
+
+        Args:
+            term (str): The text to look for. An empty term matches every file.
+
+        Returns:
+            list: The matching paths, in store order.
+        """
+        term = term.strip().lower()
+        if not term:
+            return self.paths()
+        return [entry["path"] for entry in self.files if term in entry["path"].lower()]
+
+    def entry(self, path: str) -> Dict:
+        """
+        Get the index entry for a path.
+        """
+        self.files
+        return self._by_path[path]
+
+    def find(self, file_name: str) -> str:
+        """
+        Get the path of a file from its base name, as stored in the `file_name` field of a hit.
+
+        Returns:
+            str: The path, or None if the file is not in the store.
+        """
+        self.files
+        entry = self._by_name.get(file_name)
+        return entry["path"] if entry else None
+
+    def _map(self, file_name: str) -> mmap.mmap:
+        with open(os.path.join(self.store_dir, file_name), 'rb') as blob_file:
+            # mmap can't map an empty file, which is what an empty corpus produces.
+            if os.fstat(blob_file.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _blob(self) -> mmap.mmap:
+        if self._mmap is None:
+            self._mmap = self._map(CORPUS_HTML_FN)
+        return self._mmap
+
+    def _text_blob(self) -> mmap.mmap:
+        if self._text_mmap is None:
+            self._text_mmap = self._map(CORPUS_TEXT_FN)
+        return self._text_mmap
+
+    def _lines(self) -> array:
+        if self._line_offsets is None:
+            self._line_offsets = array('Q')
+            with open(os.path.join(self.store_dir, CORPUS_LINES_FN), 'rb') as lines_file:
+                self._line_offsets.frombytes(lines_file.read())
+        return self._line_offsets
+
+    def _read_html(self, path: str) -> str:
+        entry = self.entry(path)
+        start = entry["html_offset"]
+        return self._blob()[start:start + entry["html_length"]].decode('utf-8')
+
+    def lines(self, path: str, line_number: int, context: int = 5) -> Tuple[int, List[str]]:
+        """
+        Get a window of lines around a line, slicing only those bytes out of the store.
+
+        Args:
+            path (str): The path of the file in the store.
+            line_number (int): The 1-based line number to center the window on.
+            context (int): The number of lines to include before and after the line.
+
+        Returns:
+            tuple: The 1-based number of the first line in the window, and the lines.
+        """
+        entry = self.entry(path)
+        first_line = max(1, line_number - context)
+        last_line = min(entry["line_count"], line_number + context)
+        if first_line > last_line:
+            return first_line, []
+
+        offsets = self._lines()
+        base = entry["lines_offset"]
+        start = entry["text_offset"] + offsets[base + first_line - 1]
+        end = entry["text_offset"] + offsets[base + last_line]
+
+        text = self._text_blob()[start:end].decode('utf-8')
+        return first_line, text.splitlines()
+
+    def reopen_if_rebuilt(self) -> bool:
+        """
+        Close the store if it was rebuilt since its file list was loaded, so the next read opens the new one.
+
+        Returns:
+            bool: Whether the store was closed.
+        """
+        with self._lock:
+            if self._built_at is None or os.path.getmtime(os.path.join(self.store_dir, CORPUS_INDEX_FN)) == self._built_at:
+                return False
+            self.close()
+            return True
+
+    def close(self):
+        """
+        Release the memory maps and drop the file list, line offsets and any cached documents.
+        The store opens again on the next read.
+        """
+        self.html.cache_clear()
+        for blob in (self._mmap, self._text_mmap):
+            if blob is not None:
+                blob.close()
+        self._mmap = None
+        self._text_mmap = None
+        self._files = None
+        self._by_path = None
+        self._by_name = None
+        self._line_offsets = None
+        self._built_at = None
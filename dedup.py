@@ -0,0 +1,241 @@
+from typing import Iterable, List
+from icecream import ic
+import hashlib
+import re
+import zlib
+
+import numpy as np
+
+from decouple import config
+
+dedup_num_perm = config('DEDUP_NUM_PERM', default=64, cast=int)
+dedup_bands = config('DEDUP_BANDS', default=16, cast=int)
+dedup_threshold = config('DEDUP_THRESHOLD', default=0.8, cast=float)
+dedup_shingle_size = config('DEDUP_SHINGLE_SIZE', default=5, cast=int)
+dedup_chunk_size = config('DEDUP_CHUNK_SIZE', default=2000, cast=int)
+
+# the keyword field every line's duplicate cluster is indexed in, and searches collapse on
+DUPLICATE_CLUSTER_FIELD = "duplicate_cluster"
+
+# the field a copy of a line that isn't embedded carries its text in, instead of text
+DUPLICATE_TEXT_FIELD = "duplicate_text"
+
+# a Mersenne prime, small enough that a * hash + b never overflows 64 bits
+MINHASH_PRIME = (1 << 31) - 1
+
+def normalize_text(text: str) -> str:
+    """
+    Lowercase a line and reduce it to its words, so lines that only differ in case,
+    punctuation or spacing are exact duplicates.
+    """
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+def exact_key(text: str) -> str:
+    """
+    Get the key that exact duplicates of a line share, once normalized.
+    """
+    return hashlib.sha1(normalize_text(text).encode()).hexdigest()[:16]
+
+def restore_duplicate_text(hits: List[dict]) -> List[dict]:
+    """
+    Move the text of the hits that are copies of a line back to the text field, where every
+    other hit has it.
+
+    Args:
+        hits (list): The hits, changed in place.
+
+    Returns:
+        list: The hits.
+    """
+    for hit in hits:
+        source = hit.get('_source')
+        if source and DUPLICATE_TEXT_FIELD in source:
+            source['text'] = source.pop(DUPLICATE_TEXT_FIELD)
+
+    return hits
+
+def shingle_hashes(text: str, shingle_size: int = dedup_shingle_size) -> np.ndarray:
+    """
+    Hash the character shingles of a normalized line.
+
+    Args:
+        text (str): The line.
+        shingle_size (int): The number of characters per shingle. Default is DEDUP_SHINGLE_SIZE, or 5.
+
+    Returns:
+        numpy.ndarray: The distinct shingle hashes, 32 bit values in a 64 bit array for the permutations.
+    """
+    text = normalize_text(text)
+    shingles = {text[i:i + shingle_size] for i in range(max(1, len(text) - shingle_size + 1))}
+    return np.unique(np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles)))
+
+class MinHasher:
+    """
+    Compute MinHash signatures of lines, many lines at a time.
+
+    Each of the `num_perm` hash functions is a * x + b mod a prime, applied to every shingle
+    hash of a chunk of lines in one array operation, and the minimum per line is taken with
+    `np.minimum.reduceat`. The share of equal values in two signatures estimates the Jaccard
+    similarity of the shingles of the two lines.
+    """
+
+    def __init__(self, num_perm: int = dedup_num_perm,
+                 shingle_size: int = dedup_shingle_size,
+                 seed: int = 0):
+        generator = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = generator.integers(1, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = generator.integers(0, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+
+    def signatures(self, texts: List[str]) -> np.ndarray:
+        """
+        Compute the signatures of a chunk of lines.
+
+        Args:
+            texts (list): The lines.
+
+        Returns:
+            numpy.ndarray: One row of `num_perm` values per line.
+        """
+        if not texts:
+            return np.empty((0, self.num_perm), dtype=np.uint32)
+
+        hashes = [shingle_hashes(text, self.shingle_size) for text in texts]
+        offsets = np.cumsum([0] + [len(line_hashes) for line_hashes in hashes[:-1]])
+
+        permuted = (np.concatenate(hashes)[:, None] * self.a + self.b) % MINHASH_PRIME
+        return np.minimum.reduceat(permuted, offsets, axis=0).astype(np.uint32)
+
+def find_duplicate_clusters(texts: Iterable[str],
+                            num_perm: int = dedup_num_perm,
+                            bands: int = dedup_bands,
+                            threshold: float = dedup_threshold,
+                            chunk_size: int = dedup_chunk_size) -> List[str]:
+    """
+    Group lines that are exact or near duplicates of each other.
+
+    The signatures are split into `bands`, and lines whose signatures agree on a whole band
+    are candidates, found by sorting the band hashes rather than comparing every pair. A
+    candidate joins the cluster when its signature agrees with the first line of the band's
+    bucket on at least `threshold` of the values. Exact duplicates are grouped by their
+    `exact_key` before any of this, and only one copy of each line is hashed.
+
+    Args:
+        texts (iterable): The lines, read once, a chunk at a time.
+        num_perm (int): The length of the signatures. Default is DEDUP_NUM_PERM, or 64.
+        bands (int): The number of LSH bands, which must divide `num_perm`. More bands find
+            less similar pairs. Default is DEDUP_BANDS, or 16.
+        threshold (float): The estimated Jaccard similarity above which two lines are
+            duplicates. Default is DEDUP_THRESHOLD, or 0.8.
+        chunk_size (int): The number of lines hashed at a time. Default is DEDUP_CHUNK_SIZE, or 2000.
+
+    Raises:
+        ValueError: If `bands` does not divide `num_perm`.
+
+    Returns:
+        list: The cluster key of each line: the smallest `exact_key` in its cluster, so the
+            key of a line with no duplicates is its own.
+    """
+    if num_perm % bands:
+        raise ValueError("DEDUP_BANDS ({}) must divide DEDUP_NUM_PERM ({})".format(bands, num_perm))
+
+    hasher = MinHasher(num_perm=num_perm)
+    keys = []
+    distinct_keys = {}
+    chunks = []
+    chunk = []
+
+    # exact duplicates share one signature, so only the first copy of a line is hashed
+    for text in texts:
+        key = exact_key(text)
+        keys.append(key)
+        if key in distinct_keys:
+            continue
+
+        distinct_keys[key] = len(distinct_keys)
+        chunk.append(text)
+        if len(chunk) == chunk_size:
+            chunks.append(hasher.signatures(chunk))
+            chunk = []
+    chunks.append(hasher.signatures(chunk))
+
+    signatures = np.concatenate(chunks)
+    parent = np.arange(len(signatures))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows = num_perm // bands
+    weights = np.random.default_rng(1).integers(1, 1 << 63, size=rows, dtype=np.uint64)
+
+    for band in range(bands if len(signatures) > 1 else 0):
+        # wrapping uint64 arithmetic is a fine hash of the band
+        band_hashes = (signatures[:, band * rows:(band + 1) * rows].astype(np.uint64) * weights).sum(axis=1)
+        order = np.argsort(band_hashes, kind='stable')
+        sorted_hashes = band_hashes[order]
+
+        # the first line of every run of equal band hashes, repeated for each line of the run
+        starts = np.concatenate([[True], sorted_hashes[1:] != sorted_hashes[:-1]])
+        firsts = order[np.maximum.accumulate(np.where(starts, np.arange(len(order)), 0))]
+
+        candidates = ~starts
+        pairs_first, pairs_other = firsts[candidates], order[candidates]
+        similar = (signatures[pairs_first] == signatures[pairs_other]).mean(axis=1) >= threshold
+
+        for i, j in zip(pairs_first[similar], pairs_other[similar]):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    cluster_keys = {}
+    for key, i in distinct_keys.items():
+        root = find(i)
+        cluster_keys[root] = min(key, cluster_keys.get(root, key))
+
+    clusters = [cluster_keys[find(distinct_keys[key])] for key in keys]
+    ic("{} lines, {} distinct, {} clusters".format(len(keys), len(distinct_keys), len(cluster_keys)))
+
+    return clusters
+
+def tag_duplicates(actions, cluster_keys=None):
+    """
+    Tag index actions with the duplicate cluster of their line, and only embed the first copy of each line in a file.
+
+    The text field is copied to the semantic_text field by the mapping. The other copies of
+    a line within a file carry it in DUPLICATE_TEXT_FIELD instead, which is copied to the text
+    field and so searched like it, but never embedded, so they are indexed without an
+    inference call and the text is still sent once. They are in the same cluster as the first
+    copy, so a search that collapses on the cluster shows one that was embedded. Every file
+    keeps an embedded copy of its lines, so a semantic search filtered on the file name still
+    finds them, and a file synced on its own tags its lines the same way a full load does.
+
+    Args:
+        actions (iterable): The bulk actions. Delete actions are passed through.
+        cluster_keys (iterable): The cluster key of each index action, as returned by
+            `find_duplicate_clusters`. Default is None, for the exact duplicate key of each line.
+
+    Yields:
+        dict: The bulk action, with its `_source` tagged.
+    """
+    cluster_keys = iter(cluster_keys) if cluster_keys is not None else None
+    embedded = set()
+
+    for action in actions:
+        if action.get("_op_type") == "delete":
+            yield action
+            continue
+
+        source = action["_source"]
+        key = exact_key(source["text"])
+        source[DUPLICATE_CLUSTER_FIELD] = next(cluster_keys) if cluster_keys is not None else key
+
+        if (source["file_name"], key) in embedded:
+            source[DUPLICATE_TEXT_FIELD] = source.pop("text")
+        else:
+            embedded.add((source["file_name"], key))
+
+        yield action
@@ -0,0 +1,284 @@
+from typing import List, Dict
+from icecream import ic
+import csv
+import hashlib
+import json
+import math
+import os
+import fire
+
+import numpy as np
+
+from decouple import config
+
+from batch import run_mode, parse_modes, batch_size, batch_concurrency
+from utils import elastic_client, elastic_index_name
+
+evaluation_cache_dir = config('EVALUATION_CACHE_DIR', default='.evaluation_cache')
+evaluation_depth = config('EVALUATION_DEPTH', default=50, cast=int)
+
+def read_judgments(judgments_fn: str) -> List[Dict]:
+    """
+    Read relevance judgments from a JSONL or CSV file.
+
+    JSONL lines look like {"id": "q1", "query": "ceo", "ratings": {"<doc id>": 2, ...}}.
+    CSV files have one row per judged document, with "id", "query", "doc_id" and "rating"
+    columns. Ratings are graded, and anything above 0 counts as relevant.
+
+    Args:
+        judgments_fn (str): The path to the file.
+
+    Returns:
+        list: The judged queries, each with an "id", a "query" and a "ratings" dictionary.
+    """
+    with open(judgments_fn, 'r', encoding='utf-8') as f:
+        if judgments_fn.endswith(".csv"):
+            queries = {}
+            for row in csv.DictReader(f):
+                query_id = row.get("id") or row["query"]
+                query = queries.setdefault(query_id, {"id": query_id, "query": row["query"], "ratings": {}})
+                query["ratings"][row["doc_id"]] = float(row["rating"])
+            return list(queries.values())
+
+        judgments = []
+        for count, line in enumerate((line for line in f if line.strip()), start=1):
+            row = json.loads(line)
+            row["id"] = str(row.get("id") or "query-{}".format(count))
+            row["ratings"] = {doc_id: float(rating) for doc_id, rating in row["ratings"].items()}
+            judgments.append(row)
+        return judgments
+
+def dcg(gains: List[float]) -> float:
+    """
+    Discounted cumulative gain of graded ratings, in rank order.
+    """
+    return sum((2 ** gain - 1) / math.log2(rank + 2) for rank, gain in enumerate(gains))
+
+def ndcg_at_k(hit_ids: List[str], ratings: Dict[str, float], k: int = 10) -> float:
+    """
+    Normalized DCG of the top k hits, against the best possible ordering of the judged documents.
+    """
+    ideal = dcg(sorted(ratings.values(), reverse=True)[:k])
+    if ideal == 0:
+        return 0.0
+    return dcg([ratings.get(hit_id, 0.0) for hit_id in hit_ids[:k]]) / ideal
+
+def reciprocal_rank(hit_ids: List[str], ratings: Dict[str, float], k: int = 10) -> float:
+    """
+    One over the rank of the first relevant hit in the top k, or 0 if there is none.
+    """
+    for rank, hit_id in enumerate(hit_ids[:k], start=1):
+        if ratings.get(hit_id, 0.0) > 0:
+            return 1.0 / rank
+    return 0.0
+
+def recall_at_k(hit_ids: List[str], ratings: Dict[str, float], k: int = 10) -> float:
+    """
+    The share of the relevant documents that are in the top k hits.
+    """
+    relevant = {doc_id for doc_id, rating in ratings.items() if rating > 0}
+    if not relevant:
+        return 0.0
+    return len(relevant.intersection(hit_ids[:k])) / len(relevant)
+
+rank_metrics = {
+    "ndcg": ndcg_at_k,
+    "mrr": reciprocal_rank,
+    "recall": recall_at_k,
+}
+
+class CachedClient:
+    """
+    Answer msearch requests from a response cache on disk, and only send the misses on.
+
+    Responses are keyed by the index and query body, so running the same query again, for
+    instance to re-score a parameter sweep with another metric or k, never reaches the
+    cluster. Without a client this is an offline fixture: it only serves what is already in
+    the cache directory, and answers anything else with an error response.
+    """
+
+    def __init__(self, cache_dir=evaluation_cache_dir, client=None):
+        self.cache_dir = cache_dir
+        self.client = client
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def cache_key(index_name: str, body: Dict) -> str:
+        """
+        Build the cache key of a query body on an index.
+        """
+        return hashlib.sha256(json.dumps([index_name, body], sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key: str):
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, response: Dict):
+        # write then rename, so concurrent batches never read half a file
+        tmp_path = "{}.{}.tmp".format(self._path(key), os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(response, f)
+        os.replace(tmp_path, self._path(key))
+
+    def msearch(self, index=None, searches=None, **kwargs):
+        """
+        The msearch API, with each search answered from the cache when possible.
+        """
+        bodies = searches[1::2]
+        keys = [self.cache_key(index, body) for body in bodies]
+        responses = [self.get(key) for key in keys]
+
+        misses = [i for i, response in enumerate(responses) if response is None]
+
+        if misses and self.client is None:
+            for i in misses:
+                responses[i] = {"status": 404, "error": {"type": "fixture_miss", "reason": "not in {}".format(self.cache_dir)}}
+        elif misses:
+            miss_searches = []
+            for i in misses:
+                miss_searches.extend([searches[2 * i], bodies[i]])
+
+            fetched = self.client.msearch(index=index, searches=miss_searches, **kwargs)["responses"]
+
+            for i, response in zip(misses, fetched):
+                responses[i] = response
+                if not response.get("error"):
+                    self.put(keys[i], response)
+
+        return {"responses": responses}
+
+def score_records(records: List[Dict], judgments: List[Dict], k: int = 10) -> List[Dict]:
+    """
+    Score the records of a batch run against the judgments.
+
+    Args:
+        records (list): The records returned by `batch.run_mode`.
+        judgments (list): The judgments, as returned by `read_judgments`.
+        k (int): The rank cutoff. Default is 10.
+
+    Returns:
+        list: The records, each with a value for every metric in `rank_metrics`.
+    """
+    ratings = {judgment["id"]: judgment["ratings"] for judgment in judgments}
+
+    for record in records:
+        for name, metric in rank_metrics.items():
+            record[f"{name}@{k}"] = metric(record["hit_ids"], ratings[record["id"]], k=k)
+
+    return records
+
+def evaluate_mode(mode: str,
+                  judgments: List[Dict],
+                  k: int = 10,
+                  depth: int = evaluation_depth,
+                  batch_size: int = batch_size,
+                  concurrency: int = batch_concurrency,
+                  index_name=elastic_index_name,
+                  client=elastic_client,
+                  **params) -> Dict:
+    """
+    Run the judged queries through a search mode and compute the mean of each metric.
+
+    Args:
+        mode (str): The search mode, one of the keys of `batch.search_modes`.
+        judgments (list): The judgments, as returned by `read_judgments`.
+        k (int): The rank cutoff. Default is 10.
+        depth (int): The number of hits to fetch. Fetching the same depth whatever k is lets
+            the cached responses be re-scored at any k up to it.
+        batch_size (int): The number of queries per msearch request.
+        concurrency (int): The number of msearch requests in flight at the same time.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The client, usually a `CachedClient`.
+        **params: Overrides for the default parameters of the mode.
+
+    Returns:
+        dict: The mean of each metric, the number of queries and errors, and the per-query records.
+    """
+    records = run_mode(mode, judgments,
+                       size=max(k, depth),
+                       batch_size=batch_size,
+                       concurrency=concurrency,
+                       index_name=index_name,
+                       client=client,
+                       **params)
+    records = score_records(records, judgments, k=k)
+
+    scored = [record for record in records if not record["error"]]
+
+    summary = {f"{name}@{k}": float(np.mean([record[f"{name}@{k}"] for record in scored])) if scored else None
+               for name in rank_metrics}
+    summary["queries"] = len(records)
+    summary["errors"] = len(records) - len(scored)
+    summary["records"] = records
+
+    return summary
+
+def evaluate(judgments_fn: str,
+             modes="match,fuzzy,semantic,multi_field,hybrid",
+             k: int = 10,
+             output_fn: str = None,
+             cache_dir=evaluation_cache_dir,
+             offline: bool = False,
+             batch_size: int = batch_size,
+             concurrency: int = batch_concurrency,
+             index_name=elastic_index_name) -> Dict:
+    """
+    Evaluate the relevance of each search mode against a judgments file.
+
+    Args:
+        judgments_fn (str): The path to a JSONL or CSV judgments file.
+        modes (str): The search modes to evaluate, comma separated. Default is all of them.
+        k (int): The rank cutoff. Default is 10.
+        output_fn (str): The path of a JSONL file to write the per-query scores to. Default is None.
+        cache_dir (str): The directory of the response cache.
+        offline (bool): Only use the response cache, never the cluster. Default is False.
+        batch_size (int): The number of queries per msearch request.
+        concurrency (int): The number of msearch requests in flight at the same time.
+        index_name (str): The name of the Elasticsearch index to search in.
+
+    Returns:
+        dict: The mean metrics of each mode.
+    """
+    judgments = read_judgments(judgments_fn)
+    client = CachedClient(cache_dir=cache_dir, client=None if offline else elastic_client)
+
+    summaries = {}
+    output_file = open(output_fn, 'w', encoding='utf-8') if output_fn else None
+
+    try:
+        for mode in parse_modes(modes):
+            summary = evaluate_mode(mode, judgments,
+                                    k=k,
+                                    batch_size=batch_size,
+                                    concurrency=concurrency,
+                                    index_name=index_name,
+                                    client=client)
+
+            if output_file:
+                for record in summary["records"]:
+                    output_file.write(json.dumps(record) + "\n")
+
+            summaries[mode] = {key: value for key, value in summary.items() if key != "records"}
+            ic(mode, summaries[mode])
+    finally:
+        if output_file:
+            output_file.close()
+
+    return summaries
+
+if __name__ == "__main__":
+
+    # Invoking this function would look something like:
+    #   python evaluation.py run judgments.jsonl  (grabs defaults from .env)
+    #   python evaluation.py run judgments.csv --modes match,multi_field --k 5 --output_fn scores.jsonl
+    #   python evaluation.py run judgments.jsonl --offline  (only uses the response cache)
+
+    fire.Fire({
+        "run": evaluate,
+    })
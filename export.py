@@ -0,0 +1,319 @@
+from typing import Any, Iterable, List, Dict
+from icecream import ic
+import csv
+import io
+import json
+import os
+import fire
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from decouple import config
+
+from history import HistoryStore, HISTORY_COLUMNS, search_history_db
+from utils import scan_elastic_by_single_field, scan_elastic_by_multiple_fields, elastic_client, elastic_index_name, \
+    search_export_page_size, search_export_slices
+
+export_batch_size = config('EXPORT_BATCH_SIZE', default=10000, cast=int)
+
+# the fields the pages display get their own columns, and anything else in _source is kept as JSON,
+# so every export has the same schema whatever the query asked for
+hit_source_fields = [("file_name", pa.string()), ("line_number", pa.int64()), ("heading", pa.string()), ("text", pa.string())]
+
+hit_schema = pa.schema([("_id", pa.string()), ("_score", pa.float64())] + hit_source_fields +
+                       [("highlight", pa.string()), ("source", pa.string())])
+
+history_schema = pa.schema([
+    ("id", pa.int64()),
+    ("search_time", pa.timestamp("us")),
+    ("session_id", pa.string()),
+    ("page", pa.string()),
+    ("search_type", pa.string()),
+    ("search_term", pa.string()),
+    ("search_field", pa.string()),
+    ("hit_count", pa.int64()),
+    ("took_ms", pa.float64()),
+    ("round_trip_ms", pa.float64()),
+    ("search_query", pa.string()),
+])
+
+export_formats = {
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+    "arrow": ("application/vnd.apache.arrow.file", ".arrow"),
+    "jsonl": ("application/x-ndjson", ".jsonl"),
+    "csv": ("text/csv", ".csv"),
+}
+
+def hit_record(hit: Dict) -> Dict:
+    """
+    Flatten an Elasticsearch hit into a record with the columns of `hit_schema`.
+
+    Args:
+        hit (dict): The hit.
+
+    Returns:
+        dict: The record.
+    """
+    source_names = [name for name, _ in hit_source_fields]
+    source = hit.get('_source') or {}
+    extra = {key: value for key, value in source.items() if key not in source_names}
+
+    record = {
+        "_id": hit.get('_id'),
+        "_score": hit.get('_score'),
+        "highlight": json.dumps(hit['highlight']) if hit.get('highlight') else None,
+        "source": json.dumps(extra, default=str) if extra else None,
+    }
+
+    for name in source_names:
+        record[name] = source.get(name)
+
+    return record
+
+def hits_to_record_batch(hits: List[Dict]) -> pa.RecordBatch:
+    """
+    Turn Elasticsearch hits into a record batch of `hit_schema`, without pandas.
+
+    Args:
+        hits (list): The hits.
+
+    Returns:
+        pyarrow.RecordBatch: The hits.
+    """
+    return pa.RecordBatch.from_pylist([hit_record(hit) for hit in hits], schema=hit_schema)
+
+def history_rows_to_record_batch(rows: List[tuple]) -> pa.RecordBatch:
+    """
+    Turn rows of the history store into a record batch of `history_schema`.
+
+    Args:
+        rows (list): The rows, as yielded by `HistoryStore.iter_batches`.
+
+    Returns:
+        pyarrow.RecordBatch: The searches.
+    """
+    arrays = []
+    for i, field in enumerate(history_schema):
+        values = [row[i] for row in rows]
+        if pa.types.is_timestamp(field.type):
+            # the store keeps ISO timestamps, which arrow parses itself
+            arrays.append(pa.array(values, type=pa.string()).cast(field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+
+    return pa.RecordBatch.from_arrays(arrays, schema=history_schema)
+
+class TextBatchWriter:
+    """
+    Write record batches as JSON lines or CSV rows, with the same interface as the arrow writers.
+    """
+
+    def __init__(self, sink, schema: pa.Schema, file_format: str = "jsonl"):
+        if isinstance(sink, str):
+            self.file = open(sink, 'w', encoding='utf-8', newline='')
+        else:
+            # binary file objects, such as the buffer of a download button
+            self.file = io.TextIOWrapper(sink, encoding='utf-8', newline='')
+        self.sink = sink
+        self.file_format = file_format
+        self.csv_writer = None
+
+        if file_format == "csv":
+            self.csv_writer = csv.DictWriter(self.file, fieldnames=schema.names)
+            self.csv_writer.writeheader()
+
+    def write_batch(self, batch: pa.RecordBatch):
+        rows = batch.to_pylist()
+        if self.csv_writer:
+            self.csv_writer.writerows(rows)
+        else:
+            self.file.writelines(json.dumps(row, default=str) + "\n" for row in rows)
+
+    def close(self):
+        if isinstance(self.sink, str):
+            self.file.close()
+        else:
+            # leave the caller's file object open
+            self.file.flush()
+            self.file.detach()
+
+def write_batches(batches: Iterable[pa.RecordBatch], sink, schema: pa.Schema, file_format: str = "parquet") -> int:
+    """
+    Write record batches to a file, one Parquet row group, Arrow IPC batch or block of lines at a time.
+
+    Only the batch being written is held in memory, however many there are.
+
+    Args:
+        batches (iterable): The record batches.
+        sink (str or file): The path or binary file object to write to.
+        schema (pyarrow.Schema): The schema of every batch.
+        file_format (str): One of the keys of `export_formats`. Default is "parquet".
+
+    Returns:
+        int: The number of rows written.
+    """
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    elif file_format == "arrow":
+        writer = pa.ipc.new_file(sink, schema)
+    elif file_format in ["jsonl", "csv"]:
+        writer = TextBatchWriter(sink, schema, file_format=file_format)
+    else:
+        raise ValueError("Unknown format {}, expected one of {}".format(file_format, list(export_formats)))
+
+    rows = 0
+    try:
+        for batch in batches:
+            if batch.num_rows:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+    finally:
+        writer.close()
+
+    return rows
+
+def export_hits(hit_pages: Iterable[List[Dict]], sink, file_format: str = "parquet") -> int:
+    """
+    Export pages of hits, each page becoming a row group.
+
+    Args:
+        hit_pages (iterable): The pages of hits, for instance from a `utils.ResultPager`.
+        sink (str or file): The path or file object to write to.
+        file_format (str): One of the keys of `export_formats`. Default is "parquet".
+
+    Returns:
+        int: The number of hits written.
+    """
+    return write_batches((hits_to_record_batch(hits) for hits in hit_pages), sink, hit_schema, file_format=file_format)
+
+def limit_hits(hit_pages: Iterable[List[Dict]], max_hits: int):
+    """
+    Stop reading pages of hits once `max_hits` are read, cutting the last page short.
+
+    Args:
+        hit_pages (iterable): The pages of hits. A generator, such as `utils.scan_hits`, is
+            closed once the limit is reached, which releases its point in time.
+        max_hits (int): The number of hits to read at most.
+
+    Yields:
+        list: The hits of a page.
+    """
+    count = 0
+    try:
+        for hits in hit_pages:
+            hits = hits[:max_hits - count]
+            count += len(hits)
+            if hits:
+                yield hits
+            if count >= max_hits:
+                return
+    finally:
+        if hasattr(hit_pages, 'close'):
+            hit_pages.close()
+
+def export_history(sink,
+                   file_format: str = "parquet",
+                   term_filter: str = "",
+                   batch_size: int = export_batch_size,
+                   store: HistoryStore = None) -> int:
+    """
+    Export the search history, streamed from the store in batches.
+
+    Args:
+        sink (str or file): The path or file object to write to.
+        file_format (str): One of the keys of `export_formats`. Default is "parquet".
+        term_filter (str): Only export searches whose term contains this text.
+        batch_size (int): The number of searches per row group.
+        store (HistoryStore): The history store. Default is one on SEARCH_HISTORY_DB.
+
+    Returns:
+        int: The number of searches written.
+    """
+    store = store or HistoryStore(db_fn=search_history_db)
+    store.flush()
+
+    batches = (history_rows_to_record_batch(rows) for rows in store.iter_batches(batch_size=batch_size, term_filter=term_filter))
+    rows = write_batches(batches, sink, history_schema, file_format=file_format)
+
+    ic(f"Exported {rows} searches")
+    return rows
+
+def export_to_bytes(export, **kwargs) -> bytes:
+    """
+    Run one of the export functions into memory, for a download button.
+
+    Args:
+        export (function): `export_hits` or `export_history`.
+        **kwargs: The arguments of the export, without the sink.
+
+    Returns:
+        bytes: The exported file.
+    """
+    sink = io.BytesIO()
+    export(sink=sink, **kwargs)
+    return sink.getvalue()
+
+def export_search(searchterm: str,
+                  output_fn: str,
+                  field_names="text",
+                  search_type: str = "match",
+                  fuzziness: str = None,
+                  source_fields=None,
+                  file_format: str = None,
+                  page_size: int = search_export_page_size,
+                  slices: int = search_export_slices,
+                  index_name=elastic_index_name,
+                  client=elastic_client) -> int:
+    """
+    Export every match of a search term, streamed page by page, whatever the number of hits.
+
+    Args:
+        searchterm (str): The search term to query.
+        output_fn (str): The path of the file to write.
+        field_names (str): The fields to search in, comma separated. A single field is searched
+            like the single-field pages, several like the multi-field pages.
+        search_type (str): The type of search: "match", "fuzzy" or "semantic". Default is "match".
+        fuzziness (str): The fuzziness of a fuzzy search. Default is None.
+        source_fields (str): The fields to export, comma separated. Default is None, for all but the embeddings.
+        file_format (str): One of the keys of `export_formats`. Default is None, to go by the extension of output_fn.
+        page_size (int): The number of hits per request.
+        slices (int): The number of slices of the point in time read in parallel.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The Elasticsearch client.
+
+    Returns:
+        int: The number of hits written.
+    """
+    if isinstance(field_names, str):
+        field_names = [field.strip() for field in field_names.split(",")]
+    if isinstance(source_fields, str):
+        source_fields = [field.strip() for field in source_fields.split(",")]
+    if file_format is None:
+        file_format = os.path.splitext(output_fn)[1].lstrip(".")
+
+    scan_options = dict(index_name=index_name, search_type=search_type, fuzziness=fuzziness,
+                        source_fields=source_fields, page_size=page_size, slices=slices, client=client)
+
+    if len(field_names) == 1:
+        hit_pages = scan_elastic_by_single_field(searchterm, field_name=field_names[0], **scan_options)
+    else:
+        hit_pages = scan_elastic_by_multiple_fields(searchterm, field_names=field_names, **scan_options)
+
+    rows = export_hits(hit_pages, output_fn, file_format=file_format)
+
+    ic(f"Exported {rows} hits to {output_fn}")
+    return rows
+
+if __name__ == "__main__":
+
+    # Invoking this function would look something like:
+    #   python export.py history history.parquet  (grabs defaults from .env)
+    #   python export.py history history.arrow --file_format arrow --term_filter ceo
+    #   python export.py search ceo hits.jsonl  (every match of "ceo" in the text field)
+    #   python export.py search ceo hits.parquet --field_names text.completion,heading.completion --slices 4
+
+    fire.Fire({
+        "history": export_history,
+        "search": export_search,
+    })
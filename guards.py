@@ -0,0 +1,268 @@
+from typing import Dict
+from icecream import ic
+from concurrent.futures import Future
+from collections import OrderedDict, deque
+import hashlib
+import json
+import threading
+import time
+
+from decouple import config
+
+# admission control and circuit breaking of the searches, per search type
+search_max_concurrency = config('SEARCH_MAX_CONCURRENCY', default=8, cast=int)
+search_queue_timeout = config('SEARCH_QUEUE_TIMEOUT', default=2.0, cast=float)
+breaker_failure_rate = config('BREAKER_FAILURE_RATE', default=0.5, cast=float)
+breaker_slow_call_ms = config('BREAKER_SLOW_CALL_MS', default=2000, cast=float)
+breaker_window = config('BREAKER_WINDOW', default=20, cast=int)
+breaker_min_calls = config('BREAKER_MIN_CALLS', default=5, cast=int)
+breaker_cooldown = config('BREAKER_COOLDOWN', default=30.0, cast=float)
+
+class ResultCache:
+    """
+    A thread-safe LRU cache whose entries expire after a time to live.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts) -> str:
+        """
+        Build a cache key from JSON-serializable parts, such as an index name and a query body.
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl is not None and time.monotonic() - entry[0] > self.ttl):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class SingleFlight:
+    """
+    Let concurrent callers with the same key share one call, instead of each making their own.
+
+    The first caller runs the call, and the callers that arrive while it is in flight wait for
+    its result. The result is handed to all of them, so it must be treated as read-only.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn):
+        """
+        Run `fn`, or wait for the call already in flight for `key`.
+
+        Args:
+            key (str): The key of the call.
+            fn (function): The call, without arguments.
+
+        Returns:
+            tuple: The result of the call, and whether it came from another caller's call.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+class SearchRejected(RuntimeError):
+    """
+    Raised when a search is not let through to the cluster, because its queue is full or its circuit is open.
+    """
+
+class SearchGuard:
+    """
+    Admission control and a circuit breaker for one search type, shared by all sessions.
+
+    At most `max_concurrency` searches are in flight at a time, and a search that can't get
+    a slot within `queue_timeout` seconds is rejected, rather than holding its session's
+    thread until the cluster answers. The outcome of the last `window` searches is kept, and
+    errors and searches slower than `slow_call_ms` count as failures. Once the failure rate
+    reaches `failure_rate`, the circuit opens and every search is rejected straight away.
+    After `cooldown` seconds, one trial search is let through: if it succeeds the circuit
+    closes, otherwise it opens again.
+    """
+
+    def __init__(self, search_type: str,
+                 max_concurrency: int = search_max_concurrency,
+                 queue_timeout: float = search_queue_timeout,
+                 failure_rate: float = breaker_failure_rate,
+                 slow_call_ms: float = breaker_slow_call_ms,
+                 window: int = breaker_window,
+                 min_calls: int = breaker_min_calls,
+                 cooldown: float = breaker_cooldown):
+        self.search_type = search_type
+        self.max_concurrency = max_concurrency
+        self.queue_timeout = queue_timeout
+        self.failure_rate = failure_rate
+        self.slow_call_ms = slow_call_ms
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_at = None
+        self.in_flight = 0
+        self.counts = {"admitted": 0, "rejected": 0, "failed": 0, "slow": 0, "opened": 0}
+        self._outcomes = deque(maxlen=window)
+        self._latencies = deque(maxlen=window)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._trial = False
+
+    def _reject(self, reason: str):
+        with self._lock:
+            self.counts["rejected"] += 1
+        raise SearchRejected(f"{self.search_type} search rejected: {reason}")
+
+    def acquire(self):
+        """
+        Wait for a slot for a search.
+
+        Raises:
+            SearchRejected: If the circuit is open, or no slot is free within the queue timeout.
+        """
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                self._trial = False
+
+            if self.state == "open":
+                rejected = "circuit open"
+            elif self.state == "half_open" and self._trial:
+                rejected = "circuit half open, waiting on the trial search"
+            else:
+                rejected = None
+                # the first search after the cooldown is the trial
+                self._trial = self.state == "half_open"
+
+        if rejected:
+            self._reject(rejected)
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                if self.state == "half_open":
+                    self._trial = False
+            self._reject(f"no slot free within {self.queue_timeout}s")
+
+        with self._lock:
+            self.in_flight += 1
+            self.counts["admitted"] += 1
+
+    def release(self, ok: bool, latency_ms: float = None):
+        """
+        Free the slot of a search, and record how it went. A search answered from the cache
+        passes None as its latency and isn't recorded.
+
+        Args:
+            ok (bool): Whether the search succeeded.
+            latency_ms (float): The round trip of the search.
+        """
+        self._slots.release()
+
+        with self._lock:
+            self.in_flight -= 1
+
+            if ok and latency_ms is None:
+                # a trial answered from the cache still ends the trial, and closes the circuit
+                if self.state == "half_open":
+                    self.state = "closed"
+                    self._trial = False
+                    self._outcomes.clear()
+                return
+
+            slow = ok and latency_ms > self.slow_call_ms
+            failed = not ok or slow
+            self.counts["failed"] += not ok
+            self.counts["slow"] += slow
+            self._outcomes.append(failed)
+            if latency_ms is not None:
+                self._latencies.append(latency_ms)
+
+            if self.state == "half_open":
+                self._trial = False
+                if failed:
+                    self._open()
+                else:
+                    self.state = "closed"
+                    self._outcomes.clear()
+            elif self.state == "closed" and len(self._outcomes) >= self.min_calls and \
+                    sum(self._outcomes) / len(self._outcomes) >= self.failure_rate:
+                self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.counts["opened"] += 1
+        ic(f"Circuit of {self.search_type} searches opened")
+
+    def metrics(self) -> Dict:
+        """
+        Get the state of the guard.
+
+        Returns:
+            dict: The state, in-flight searches, counters, failure rate and latency percentiles of the window.
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "search_type": self.search_type,
+                "state": self.state,
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                **self.counts,
+                "failure_rate": sum(self._outcomes) / len(self._outcomes) if self._outcomes else 0.0,
+                "latency_ms_p50": latencies[len(latencies) // 2] if latencies else None,
+                "latency_ms_p90": latencies[int(len(latencies) * 0.9)] if latencies else None,
+            }
+
+class SearchGuards(dict):
+    """
+    The guard of each search type, created on first use.
+    """
+
+    def __missing__(self, search_type):
+        return self.setdefault(search_type, SearchGuard(search_type))
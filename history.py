@@ -0,0 +1,251 @@
+from typing import List, Dict
+from icecream import ic
+from contextlib import closing
+import json
+import queue
+import sqlite3
+import threading
+
+import pandas as pd
+
+from decouple import config
+
+search_history_db = config('SEARCH_HISTORY_DB', default='search_history.db')
+search_history_batch_size = config('SEARCH_HISTORY_BATCH_SIZE', default=100, cast=int)
+search_history_flush_interval = config('SEARCH_HISTORY_FLUSH_INTERVAL', default=1.0, cast=float)
+
+HISTORY_COLUMNS = ["search_time", "session_id", "page", "search_type", "search_term", "search_field",
+                   "hit_count", "took_ms", "round_trip_ms", "search_query"]
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS searches (
+    id INTEGER PRIMARY KEY,
+    search_time TEXT NOT NULL,
+    session_id TEXT,
+    page TEXT,
+    search_type TEXT,
+    search_term TEXT,
+    search_field TEXT,
+    hit_count INTEGER,
+    took_ms REAL,
+    round_trip_ms REAL,
+    search_query TEXT
+);
+CREATE INDEX IF NOT EXISTS searches_time ON searches (search_time);
+CREATE INDEX IF NOT EXISTS searches_term ON searches (search_term);
+CREATE INDEX IF NOT EXISTS searches_hit_count ON searches (hit_count, search_term);
+"""
+
+def compact_search_record(search_metadata: Dict, session_id: str = None, page: str = None) -> Dict:
+    """
+    Build the compact record of a search that is kept in the history store.
+
+    Only what the history and analytics pages need is kept: no hits, DataFrames or HTML.
+
+    Args:
+        search_metadata (dict): The metadata built by `utils.build_search_metadata`.
+        session_id (str): The ID of the session that ran the search.
+        page (str): The title of the page the search was run on.
+
+    Returns:
+        dict: The record, with a value for each of `HISTORY_COLUMNS`.
+    """
+    stats = search_metadata.get('search_stats') or {}
+    search_field = search_metadata.get('search_field')
+
+    return {
+        "search_time": pd.Timestamp(search_metadata['search_time']).isoformat(),
+        "session_id": session_id,
+        "page": page,
+        "search_type": search_metadata.get('search_type'),
+        "search_term": search_metadata.get('search_term'),
+        "search_field": search_field if isinstance(search_field, str) else json.dumps(search_field),
+        "hit_count": len(search_metadata.get('hits', [])),
+        "took_ms": stats.get('took_ms'),
+        "round_trip_ms": stats.get('round_trip_ms'),
+        "search_query": json.dumps(search_metadata.get('search_query'), default=str),
+    }
+
+class HistoryStore:
+    """
+    Append-only search history, shared by every session, in a SQLite database in WAL mode.
+
+    Records are queued and written by a background thread in batches, so recording a
+    search never waits on the disk. Reads open their own connection, and with WAL they
+    don't block the writer.
+    """
+
+    def __init__(self, db_fn=search_history_db,
+                 batch_size=search_history_batch_size,
+                 flush_interval=search_history_flush_interval,
+                 max_queue_size=10000):
+        self.db_fn = db_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+
+        with closing(self._connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(HISTORY_SCHEMA)
+
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.db_fn, timeout=30)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def record(self, record: Dict):
+        """
+        Queue a record for writing, without blocking. If the queue is full the record is dropped.
+
+        Args:
+            record (dict): The record, as built by `compact_search_record`.
+        """
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        connection = self._connect()
+        insert = "INSERT INTO searches ({}) VALUES ({})".format(", ".join(HISTORY_COLUMNS),
+                                                                 ", ".join("?" for _ in HISTORY_COLUMNS))
+        while True:
+            batch = [self._queue.get()]
+
+            # gather whatever else arrives shortly after, up to a batch
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+
+            try:
+                with connection:
+                    connection.executemany(insert, [[record.get(column) for column in HISTORY_COLUMNS] for record in batch])
+            except sqlite3.Error as e:
+                ic(f"Could not write search history: {e}")
+
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Wait until every queued record has been written.
+        """
+        self._queue.join()
+
+    def _read(self, sql: str, params=()) -> pd.DataFrame:
+        with closing(self._connect()) as connection:
+            return pd.read_sql_query(sql, connection, params=params)
+
+    def count(self, term_filter: str = "") -> int:
+        """
+        Count the searches whose term contains the filter.
+        """
+        return int(self._read("SELECT COUNT(*) AS n FROM searches WHERE search_term LIKE ?",
+                              (f"%{term_filter}%",))["n"][0])
+
+    def page(self, offset: int = 0, limit: int = 50, term_filter: str = "") -> pd.DataFrame:
+        """
+        Get a page of searches, newest first.
+
+        Args:
+            offset (int): The number of searches to skip.
+            limit (int): The number of searches to return.
+            term_filter (str): Only return searches whose term contains this text.
+
+        Returns:
+            pandas.DataFrame: The searches.
+        """
+        return self._read("SELECT * FROM searches WHERE search_term LIKE ? ORDER BY search_time DESC LIMIT ? OFFSET ?",
+                          (f"%{term_filter}%", limit, offset))
+
+    def iter_batches(self, batch_size: int = 10000, term_filter: str = ""):
+        """
+        Read the searches in batches, oldest first, without loading them all at once.
+
+        Args:
+            batch_size (int): The number of searches per batch.
+            term_filter (str): Only return searches whose term contains this text.
+
+        Yields:
+            list: The searches of the batch, as tuples of the "id" then `HISTORY_COLUMNS`.
+        """
+        with closing(self._connect()) as connection:
+            cursor = connection.execute("SELECT id, {} FROM searches WHERE search_term LIKE ? ORDER BY id".format(", ".join(HISTORY_COLUMNS)),
+                                        (f"%{term_filter}%",))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+    def top_queries(self, limit: int = 20, since: str = None, page: str = None) -> pd.DataFrame:
+        """
+        Get the most frequent search terms, with how often they found nothing and their average latency.
+
+        Args:
+            limit (int): The number of terms to return.
+            since (str): Only count searches after this ISO timestamp. Default is None, for all.
+            page (str): Only count searches run on this page. Default is None, for all pages.
+
+        Returns:
+            pandas.DataFrame: The terms, most frequent first.
+        """
+        return self._read("""
+            SELECT search_term, COUNT(*) AS searches, SUM(hit_count = 0) AS zero_results, AVG(took_ms) AS avg_took_ms
+            FROM searches WHERE search_time >= ? AND (? IS NULL OR page = ?)
+            GROUP BY search_term ORDER BY searches DESC LIMIT ?""", (since or "", page, page, limit))
+
+    def top_query_bodies(self, limit: int = 20, since: str = None) -> pd.DataFrame:
+        """
+        Get the most frequent search terms of each page, with the query body they were last run with.
+
+        Args:
+            limit (int): The number of terms to return per page.
+            since (str): Only count searches after this ISO timestamp. Default is None, for all.
+
+        Returns:
+            pandas.DataFrame: The page, term, count and query body, most frequent first.
+        """
+        df = self._read("""
+            SELECT searches.page, searches.search_term, counts.searches, searches.search_query
+            FROM (SELECT MAX(id) AS last_id, COUNT(*) AS searches FROM searches
+                  WHERE search_time >= ? GROUP BY page, search_term) AS counts
+            JOIN searches ON searches.id = counts.last_id
+            ORDER BY counts.searches DESC""", (since or "",))
+        return df.groupby('page', dropna=False).head(limit).reset_index(drop=True)
+
+    def zero_result_queries(self, limit: int = 20) -> pd.DataFrame:
+        """
+        Get the search terms that most often found nothing.
+        """
+        return self._read("""
+            SELECT search_term, search_type, COUNT(*) AS searches, MAX(search_time) AS last_searched
+            FROM searches WHERE hit_count = 0
+            GROUP BY search_term, search_type ORDER BY searches DESC LIMIT ?""", (limit,))
+
+    def latency_trend(self, freq: str = "h") -> pd.DataFrame:
+        """
+        Get the search count and latency percentiles over time.
+
+        Args:
+            freq (str): The pandas frequency to bucket the searches by. Default is hourly.
+
+        Returns:
+            pandas.DataFrame: One row per bucket and search type.
+        """
+        df = self._read("SELECT search_time, search_type, took_ms, round_trip_ms FROM searches")
+        if df.empty:
+            return df
+
+        df['search_time'] = pd.to_datetime(df['search_time'])
+        grouped = df.groupby([pd.Grouper(key='search_time', freq=freq), 'search_type'])
+        return grouped.agg(searches=('took_ms', 'size'),
+                           took_ms_p50=('took_ms', 'median'),
+                           took_ms_p90=('took_ms', lambda values: values.quantile(0.9)),
+                           round_trip_ms_p50=('round_trip_ms', 'median')).reset_index()
@@ -1,14 +1,26 @@
-from elasticsearch import Elasticsearch, NotFoundError, exceptions
+from elasticsearch import ApiError, Elasticsearch, NotFoundError, exceptions, helpers
 from icecream import ic
 import glob
 import os
 import time
 import hashlib
+import json
 import re
+import tempfile
 import fire
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 
 from decouple import config
 
+from corpus import build_corpus_store, corpus_store_dir, matches_raw_data, raw_data_root
+from dedup import DUPLICATE_CLUSTER_FIELD, DUPLICATE_TEXT_FIELD, find_duplicate_clusters, tag_duplicates
+from queries import search_template_modes, build_search_template, template_shape
+
 elastic_cloud_id = config('ELASTIC_CLOUD_ID', default='none')
 elastic_api_key = config('ELASTIC_API_KEY', default='none')
 elastic_index_name = config('ELASTIC_INDEX_NAME', default='none')
@@ -21,6 +33,15 @@ elastic_dense_field_name = config('ELASTIC_DENSE_FIELD_NAME', default='none')
 elastic_dense_field_model_name = config('ELASTIC_DENSE_FIELD_MODEL_NAME', default='none')
 elastic_dense_field_dims = config('ELASTIC_DENSE_FIELD_DIMS', default=0, cast=int)
 elastic_sparse_inference_endpoint_name = config('ELASTIC_SPARSE_INFERENCE_ENDPOINT_NAME', default='none')
+elastic_inference_num_allocations = config('ELASTIC_INFERENCE_NUM_ALLOCATIONS', default=1, cast=int)
+elastic_inference_num_threads = config('ELASTIC_INFERENCE_NUM_THREADS', default=1, cast=int)
+elastic_inference_adaptive_allocations = config('ELASTIC_INFERENCE_ADAPTIVE_ALLOCATIONS', default=False, cast=bool)
+elastic_inference_min_allocations = config('ELASTIC_INFERENCE_MIN_ALLOCATIONS', default=0, cast=int)
+elastic_inference_max_allocations = config('ELASTIC_INFERENCE_MAX_ALLOCATIONS', default=4, cast=int)
+elastic_inference_timeout = config('ELASTIC_INFERENCE_TIMEOUT', default=900, cast=float)
+watch_checkpoint_fn = config('WATCH_CHECKPOINT_FILE', default='.watch_checkpoint.json')
+watch_debounce = config('WATCH_DEBOUNCE', default=1.0, cast=float)
+watch_max_delay = config('WATCH_MAX_DELAY', default=10.0, cast=float)
 
 elastic_client = Elasticsearch(
     cloud_id=elastic_cloud_id,
@@ -28,106 +49,276 @@ elastic_client = Elasticsearch(
 )
 
 
+def build_inference_service_settings(num_allocations=elastic_inference_num_allocations,
+                                     num_threads=elastic_inference_num_threads,
+                                     adaptive_allocations=elastic_inference_adaptive_allocations,
+                                     min_allocations=elastic_inference_min_allocations,
+                                     max_allocations=elastic_inference_max_allocations) -> dict:
+    """
+    Build the service settings for the ELSER inference endpoint.
+
+    Args:
+        num_allocations (int): The number of model allocations. Ignored with adaptive allocations.
+        num_threads (int): The number of threads per allocation.
+        adaptive_allocations (bool): Let Elasticsearch scale the allocations with the load.
+        min_allocations (int): The minimum number of allocations when adaptive.
+        max_allocations (int): The maximum number of allocations when adaptive.
+
+    Returns:
+        dict: The service settings.
+    """
+    service_settings = {"num_threads": num_threads}
+
+    if adaptive_allocations:
+        service_settings["adaptive_allocations"] = {
+            "enabled": True,
+            "min_number_of_allocations": min_allocations,
+            "max_number_of_allocations": max_allocations,
+        }
+    else:
+        service_settings["num_allocations"] = num_allocations
+
+    return service_settings
+
+def get_inference_endpoint(inference_endpoint_name=elastic_sparse_inference_endpoint_name, 
+                           client=elastic_client):
+    """
+    Get an inference endpoint from Elasticsearch.
+
+    Args:
+        inference_endpoint_name (str): The name of the inference endpoint.
+        client (Elasticsearch): The Elasticsearch client.
+
+    Returns:
+        dict: The endpoint, or None if it does not exist.
+    """
+    try:
+        endpoints = client.inference.get_model(inference_id=inference_endpoint_name)["endpoints"]
+    except exceptions.NotFoundError:
+        return None
+
+    return endpoints[0] if endpoints else None
+
+def inference_endpoint_matches(endpoint: dict, service_settings: dict) -> bool:
+    """
+    Check whether an existing endpoint was created with the service and settings we want.
+
+    Args:
+        endpoint (dict): The endpoint, as returned by `get_inference_endpoint`.
+        service_settings (dict): The wanted service settings.
+
+    Returns:
+        bool: True if the endpoint can be reused as it is.
+    """
+    if endpoint is None or endpoint.get("service") != "elser":
+        return False
+
+    current = endpoint.get("service_settings", {})
+    return all(current.get(key) == value for key, value in service_settings.items())
+
+def wait_for_inference_endpoint(model_id: str,
+                                client=elastic_client,
+                                timeout=elastic_inference_timeout,
+                                initial_delay=1,
+                                max_delay=30):
+    """
+    Wait until the model behind an inference endpoint is deployed on at least one node.
+
+    The deployment is polled with an exponential backoff, starting at `initial_delay` seconds
+    and doubling up to `max_delay`, until the overall `timeout` runs out.
+
+    Args:
+        model_id (str): The ID of the trained model behind the endpoint.
+        client (Elasticsearch): The Elasticsearch client.
+        timeout (float): The number of seconds to wait in total.
+        initial_delay (float): The number of seconds to wait after the first poll.
+        max_delay (float): The longest wait between two polls.
+
+    Raises:
+        TimeoutError: If the model is not deployed before the timeout.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+
+    while True:
+        status = client.ml.get_trained_models_stats(
+            model_id=model_id,
+        )
+
+        deployment_stats = status["trained_model_stats"][0].get("deployment_stats")
+        nodes = deployment_stats.get("nodes") if deployment_stats else None
+
+        if nodes:
+            ic("ELSER Model has been successfully deployed.")
+            return
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("ELSER model {} was not deployed after {} seconds".format(model_id, timeout))
+
+        ic("ELSER Model is currently being deployed.", delay)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
 def create_inference_endpoint(inference_endpoint_name=elastic_sparse_inference_endpoint_name, 
-                              client=elastic_client):
+                              client=elastic_client,
+                              num_allocations=elastic_inference_num_allocations,
+                              num_threads=elastic_inference_num_threads,
+                              adaptive_allocations=elastic_inference_adaptive_allocations,
+                              min_allocations=elastic_inference_min_allocations,
+                              max_allocations=elastic_inference_max_allocations,
+                              recreate=False,
+                              wait=True,
+                              timeout=elastic_inference_timeout):
     """
-    Create an inference endpoint in Elasticsearch.
+    Create an inference endpoint in Elasticsearch, or reuse an existing one.
 
     This code is lifted almost directly from Elasticsearch Labs: 
         https://github.com/elastic/elasticsearch-labs/blob/main/notebooks/search/09-semantic-text.ipynb
 
+    An endpoint that already exists with the same settings is kept, so the model does not
+    have to be redeployed on every run. Pass `recreate` to always delete and recreate it.
+
     Args:
         inference_endpoint_name (str): The name of the inference endpoint to create.
         client (Elasticsearch): The Elasticsearch client.
+        num_allocations (int): The number of model allocations. Ignored with adaptive allocations.
+        num_threads (int): The number of threads per allocation.
+        adaptive_allocations (bool): Let Elasticsearch scale the allocations with the load.
+        min_allocations (int): The minimum number of allocations when adaptive.
+        max_allocations (int): The maximum number of allocations when adaptive.
+        recreate (bool): Delete and recreate the endpoint even if it can be reused. Default is False.
+        wait (bool): Wait for the model to be deployed before returning. Default is True.
+        timeout (float): The number of seconds to wait for the deployment.
     
     Raises:
-        exceptions.BadRequestError: If the inference endpoint already exists.
+        exceptions.BadRequestError: If the inference endpoint can't be created.
+        TimeoutError: If the model is not deployed before the timeout.
 
     Returns:
-        dict: The information about the created inference endpoint.
+        str: The ID of the trained model behind the endpoint.
 
     """
     
     ic("Creating inference endpoints", inference_endpoint_name, client)
 
-    try:
-        client.inference.delete_model(inference_id=inference_endpoint_name)
-        ic("Deleted inference endpoint {}".format(inference_endpoint_name))
-    except exceptions.NotFoundError:
-        # Inference endpoint does not exist
-        pass
+    service_settings = build_inference_service_settings(num_allocations=num_allocations,
+                                                        num_threads=num_threads,
+                                                        adaptive_allocations=adaptive_allocations,
+                                                        min_allocations=min_allocations,
+                                                        max_allocations=max_allocations)
 
-    try:
-        client.options(
-            request_timeout=60, max_retries=3, retry_on_timeout=True
-        ).inference.put_model(
-            task_type="sparse_embedding",
-            inference_id=inference_endpoint_name,
-            body={
-                "service": "elser",
-                "service_settings": {"num_allocations": 1, "num_threads": 1},
-            },
-        )
-        
-        ic("Created inference endpoint {}".format(inference_endpoint_name))
+    endpoint = get_inference_endpoint(inference_endpoint_name=inference_endpoint_name, client=client)
 
-    except exceptions.BadRequestError as e:
-        if e.error == "resource_already_exists_exception":
-            ic("Inference endpoint already exists {}".format(inference_endpoint_name))
-        else:
-            raise e
-        
-    inference_endpoint_info = client.inference.get_model(
-        inference_id=inference_endpoint_name,
-    )
+    if not recreate and inference_endpoint_matches(endpoint, service_settings):
+        ic("Reusing inference endpoint {}".format(inference_endpoint_name))
+    else:
+        if endpoint is not None:
+            client.inference.delete_model(inference_id=inference_endpoint_name)
+            ic("Deleted inference endpoint {}".format(inference_endpoint_name))
 
-    ic(dict(inference_endpoint_info))
-    
-    model_id = inference_endpoint_info["endpoints"][0]["service_settings"]["model_id"]
+        try:
+            client.options(
+                request_timeout=60, max_retries=3, retry_on_timeout=True
+            ).inference.put_model(
+                task_type="sparse_embedding",
+                inference_id=inference_endpoint_name,
+                body={
+                    "service": "elser",
+                    "service_settings": service_settings,
+                },
+            )
+            
+            ic("Created inference endpoint {}".format(inference_endpoint_name))
+
+        except exceptions.BadRequestError as e:
+            if e.error == "resource_already_exists_exception":
+                ic("Inference endpoint already exists {}".format(inference_endpoint_name))
+            else:
+                raise e
+            
+        endpoint = get_inference_endpoint(inference_endpoint_name=inference_endpoint_name, client=client)
+
+    ic(dict(endpoint))
+
+    model_id = endpoint["service_settings"]["model_id"]
 
     # deploy the ELSER model if it is not already deployed
-    while True:
-        status = client.ml.get_trained_models_stats(
-            model_id=model_id,
-        )
+    if wait:
+        wait_for_inference_endpoint(model_id, 
+                                    client=client, 
+                                    timeout=timeout)
 
-        deployment_stats = status["trained_model_stats"][0].get("deployment_stats")
-        if deployment_stats is None:
-            ic("ELSER Model is currently being deployed.")
-            time.sleep(5)
-            continue
+    return model_id
 
-        nodes = deployment_stats.get("nodes")
-        if nodes is not None and len(nodes) > 0:
-            ic("ELSER Model has been successfully deployed.")
-            break
-        else:
-            ic("ELSER Model is currently being deployed.")
-        time.sleep(5)
+def synonym_rule_id(synonyms: str) -> str:
+    """
+    Build a stable rule ID from the content of a synonym rule.
+
+    The same rule always gets the same ID, regardless of where it is in the CSV file, so the
+    rules stored in Elasticsearch can be diffed against the file.
+
+    Args:
+        synonyms (str): The synonym rule, e.g. "usa,united states,america".
+
+    Returns:
+        str: The rule ID.
+    """
+    normalized = ",".join(term.strip() for term in synonyms.split(","))
+    return "synonym-{}".format(hashlib.sha256(normalized.encode()).hexdigest()[:16])
 
 def read_synonyms_from_csv(synonyms_fn=elastic_synonym_fn):
     """
     Read synonyms from a CSV file and return a list of synonym dictionaries.
 
+    Blank lines and lines starting with '#' are skipped, and repeated rules are only kept once.
+
     Args:
         synonyms_fn (str): The path to the CSV file containing synonyms.
 
     Returns:
         list: A list of synonym dictionaries, where each dictionary has an "id" and "synonyms" key.
     """
-    count = 0
-    synonyms_set = []
+    synonyms_set = {}
 
     with open(synonyms_fn, 'r') as f:
         lines = f.readlines()
         for line in lines:
-            count += 1
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
             synonym_dict = {}
-            synonym_dict["id"] = "synonym-{}".format(count)
-            synonym_dict["synonyms"] = line.strip()
-            synonyms_set.append(synonym_dict)
+            synonym_dict["id"] = synonym_rule_id(line)
+            synonym_dict["synonyms"] = line
+            synonyms_set[synonym_dict["id"]] = synonym_dict
+
+    return list(synonyms_set.values())
 
-    return synonyms_set
+def get_synonyms_set(client=elastic_client, 
+                     synonyms_id=elastic_synonym_id,
+                     page_size=1000):
+    """
+    Get all the rules in a synonyms set from Elasticsearch.
+
+    Args:
+        client (Elasticsearch): The Elasticsearch client.
+        synonyms_id (str): The ID of the synonyms set.
+        page_size (int): The number of rules to fetch per request.
+
+    Raises:
+        exceptions.NotFoundError: If the synonyms set does not exist.
+
+    Returns:
+        dict: The rules, keyed by rule ID.
+    """
+    rules = {}
+
+    while True:
+        response = client.synonyms.get_synonym(id=synonyms_id, from_=len(rules), size=page_size)
+        page = response["synonyms_set"]
+        rules.update({rule["id"]: rule["synonyms"] for rule in page})
+        if not page or len(rules) >= response["count"]:
+            return rules
 
 def create_synonyms_with_csv(client=elastic_client, 
                              synonyms_fn=elastic_synonym_fn, 
@@ -144,6 +335,59 @@ def create_synonyms_with_csv(client=elastic_client,
     client.synonyms.put_synonym(id=synonyms_id, synonyms_set=synonyms_set)
     ic("Created synonyms with CSV", synonyms_fn, synonyms_id)
 
+def sync_synonyms_with_csv(client=elastic_client, 
+                           synonyms_fn=elastic_synonym_fn, 
+                           synonyms_id=elastic_synonym_id,
+                           index_name=elastic_index_name,
+                           dry_run=False):
+    """
+    Update the synonyms set in place so that it matches a CSV file, without reindexing.
+
+    The CSV file is diffed against the stored set, and only the rules that were added or
+    removed are sent through the per-rule synonyms API. The search analyzers of the index
+    are then reloaded, which works because the synonym filter is `updateable`. If the set
+    does not exist yet it is created from the whole file.
+
+    Args:
+        client (Elasticsearch): The Elasticsearch client.
+        synonyms_fn (str): The path to the CSV file containing synonyms.
+        synonyms_id (str): The ID of the synonyms set in Elasticsearch.
+        index_name (str): The name of the index whose search analyzers use the set.
+        dry_run (bool): Only report the changes, without sending them. Default is False.
+
+    Returns:
+        dict: The IDs of the rules that were added and deleted.
+    """
+    wanted = {rule["id"]: rule["synonyms"] for rule in read_synonyms_from_csv(synonyms_fn=synonyms_fn)}
+
+    try:
+        stored = get_synonyms_set(client=client, synonyms_id=synonyms_id)
+    except exceptions.NotFoundError:
+        ic("Synonyms set {} does not exist".format(synonyms_id))
+        if not dry_run:
+            create_synonyms_with_csv(client=client, synonyms_fn=synonyms_fn, synonyms_id=synonyms_id)
+        return {"added": sorted(wanted), "deleted": []}
+
+    added = sorted(rule_id for rule_id in wanted if rule_id not in stored)
+    deleted = sorted(rule_id for rule_id in stored if rule_id not in wanted)
+
+    ic("Synonyms diff", synonyms_id, len(added), len(deleted))
+
+    if dry_run:
+        return {"added": added, "deleted": deleted}
+
+    for rule_id in added:
+        client.synonyms.put_synonym_rule(set_id=synonyms_id, rule_id=rule_id, synonyms=wanted[rule_id])
+
+    for rule_id in deleted:
+        client.synonyms.delete_synonym_rule(set_id=synonyms_id, rule_id=rule_id)
+
+    if (added or deleted) and client.indices.exists(index=index_name):
+        client.indices.reload_search_analyzers(index=index_name)
+        ic("Reloaded search analyzers for {}".format(index_name))
+
+    return {"added": added, "deleted": deleted}
+
 def create_index_with_fields(client=elastic_client, 
                              inference_endpoint_name = elastic_sparse_inference_endpoint_name,
                              index_name=elastic_index_name,
@@ -165,12 +409,25 @@ def create_index_with_fields(client=elastic_client,
 
     settings = {
         "analysis": {
+            "tokenizer": {
+                "trigram_tokenizer": {
+                    "type": "ngram",
+                    "min_gram": 3,
+                    "max_gram": 3,
+                    "token_chars": ["letter", "digit"]
+                }
+            },
             "filter": {
                 "autocomplete_filter": {
                     "type": "edge_ngram",
                     "min_gram": 1,
                     "max_gram": 10
                 },
+                "shingle_filter": {
+                    "type": "shingle",
+                    "min_shingle_size": 2,
+                    "max_shingle_size": 3
+                },
                 "acme_synonym_filter": {
                     "type": "synonym_graph",
                     "synonyms_set": elastic_synonym_id,
@@ -192,6 +449,21 @@ def create_index_with_fields(client=elastic_client,
                         "lowercase",
                         "acme_synonym_filter",
                     ]
+                },
+                "shingle": {
+                    "type": "custom",
+                    "tokenizer": "standard",
+                    "filter": [
+                        "lowercase",
+                        "shingle_filter",
+                    ]
+                },
+                "trigram": {
+                    "type": "custom",
+                    "tokenizer": "trigram_tokenizer",
+                    "filter": [
+                        "lowercase",
+                    ]
                 }
             },
         }
@@ -199,19 +471,64 @@ def create_index_with_fields(client=elastic_client,
 
     mappings = {
         "properties": {
-            "file_name": {"type": "text"},
+            # the keyword sub-fields are what the facet filters and counts use
+            "file_name": {
+                "type": "text",
+                "fields": {
+                    "keyword": {"type": "keyword"},
+                },
+            },
             "line_number": {"type": "integer"},
-            "heading": {
+            # lines that are copies of each other share a key, which searches collapse on
+            DUPLICATE_CLUSTER_FIELD: {"type": "keyword"},
+            # the copies of a line that aren't embedded carry it here. copy_to isn't recursive, so
+            # it is searched as text, with the multi-fields of text, without reaching the
+            # semantic_text field
+            DUPLICATE_TEXT_FIELD: {
                 "type": "text",
+                "index": False,
+                "copy_to": ["text"],
             },
-            "heading_completion": {
+            # the variants of heading and text are multi-fields, indexed from the one copy in _source
+            "heading": {
                 "type": "text",
-                "analyzer": "autocomplete",
-                "search_analyzer": "standard"
+                "fields": {
+                    "completion": {
+                        "type": "text",
+                        "analyzer": "autocomplete",
+                        "search_analyzer": "standard"
+                    },
+                    "keyword": {
+                        "type": "keyword",
+                        "ignore_above": 256
+                    },
+                },
             },
             "text": {
                 "type": "text", 
-                "copy_to": ["text_sparse_embedding"]
+                "copy_to": [sparse_field_name],
+                "fields": {
+                    "completion": {
+                        "type": "text",
+                        "analyzer": "autocomplete",
+                        "search_analyzer": "standard"
+                    },
+                    "synonym": {
+                        "type": "text",
+                        "analyzer": "autocomplete",
+                        "search_analyzer": "acme_synonym_analyzer"
+                    },
+                    # words and word pairs and triples, for the "did you mean" phrase suggester
+                    "shingle": {
+                        "type": "text",
+                        "analyzer": "shingle"
+                    },
+                    # candidates for the fuzzy search's prefilter
+                    "trigram": {
+                        "type": "text",
+                        "analyzer": "trigram"
+                    },
+                },
             },
             sparse_field_name: {
                 "type": "semantic_text",
@@ -223,16 +540,6 @@ def create_index_with_fields(client=elastic_client,
                 "index": True,
                 "similarity": "cosine",
             },
-            "text_completion": {
-                "type": "text",
-                "analyzer": "autocomplete",
-                "search_analyzer": "standard"
-            },
-            "text_synonym": {
-                "type": "text",
-                "analyzer": "autocomplete",
-                "search_analyzer": "acme_synonym_analyzer"
-            },
         }
     }
 
@@ -243,22 +550,47 @@ def create_index_with_fields(client=elastic_client,
     client.indices.create(index=index_name, mappings=mappings, settings=settings)
     ic("Created index {}".format(index_name))
 
-def index_file_to_elasticsearch(file_path: str, 
-                                client=elastic_client, 
-                                index_name=elastic_index_name):
+def create_search_templates(client=elastic_client) -> list:
     """
-    Index a file to Elasticsearch.
+    Store the search templates of the search pages in Elasticsearch.
+
+    The pages store a template the first time they use it anyway, but storing them here means
+    the API key of the app doesn't need to be allowed to manage scripts. A template that can't
+    be stored, e.g. because the API key of the indexer isn't allowed to either, is left for
+    the pages to store or send inline.
 
     Args:
-        file_path (str): The path to the file to index.
         client (Elasticsearch): The Elasticsearch client.
-        index_name (str): The name of the index to index the file into.
+
+    Returns:
+        list: The IDs of the stored templates.
     """
+    template_ids = []
+    for mode, (builder, shape) in search_template_modes.items():
+        template_id, source = build_search_template(builder, template_shape(builder, **shape))
+        try:
+            client.put_script(id=template_id, script={"lang": "mustache", "source": source})
+        except ApiError as e:
+            ic(f"Could not store the {mode} search template {template_id}: {e}")
+            continue
+        ic(f"Stored the {mode} search template as {template_id}")
+        template_ids.append(template_id)
 
-    from elasticsearch import helpers, exceptions
+    return template_ids
 
+def parse_file_to_actions(file_path: str, 
+                          index_name=elastic_index_name):
+    """
+    Parse a file into bulk index actions, one per non-empty line.
+
+    Args:
+        file_path (str): The path to the file to parse.
+        index_name (str): The name of the index the actions target.
+
+    Yields:
+        dict: A bulk index action.
+    """
     last_heading = None  # This will keep track of the last seen heading
-    actions = []  # This will store all the actions to be performed in bulk
 
     with open(file_path, 'r', encoding='utf-8') as file:
         ic("Opened {}".format(file_path))
@@ -275,26 +607,70 @@ def index_file_to_elasticsearch(file_path: str,
                 "file_name": os.path.basename(file_path),
                 "line_number": line_number,
                 "heading": last_heading.strip(),
-                "heading_completion": last_heading.strip(),
                 "text": line.strip(),
-                "text_completion": line.strip(),
-                "text_synonym": line.strip(),
             }
 
             if line not in ['', '\n']:
-                action = {
+                yield {
                     "_index": index_name,
                     "_id": unique_id,
                     "_source": doc
                 }
-                actions.append(action)
+
+def bulk_index_actions(actions, client=elastic_client):
+    """
+    Send index actions to Elasticsearch in bulk.
+
+    Args:
+        actions (iterable): The bulk index actions.
+        client (Elasticsearch): The Elasticsearch client.
+
+    Returns:
+        bool: Whether every action went through.
+    """
+    try:
+        helpers.bulk(client, actions)
+    except helpers.BulkIndexError as e:
+        ic(f"Bulk index error: {e.errors}")
+        return False
+
+    return True
+
+def mark_index_changed(client=elastic_client, index_name=elastic_index_name):
+    """
+    Make the lines just written to an index searchable, and give it a new generation.
+
+    The generation is kept in the `_meta` of the mapping, which the search pages read to tell
+    whether the results they cached are stale.
+
+    Args:
+        client (Elasticsearch): The Elasticsearch client.
+        index_name (str): The name of the index or alias written to.
+    """
+    client.indices.refresh(index=index_name)
+
+    for name, index in client.indices.get_mapping(index=index_name).items():
+        meta = index['mappings'].get('_meta', {})
+        client.indices.put_mapping(index=name, meta={**meta, "generation": uuid.uuid4().hex})
+
+def index_file_to_elasticsearch(file_path: str, 
+                                client=elastic_client, 
+                                index_name=elastic_index_name):
+    """
+    Index a file to Elasticsearch.
+
+    Args:
+        file_path (str): The path to the file to index.
+        client (Elasticsearch): The Elasticsearch client.
+        index_name (str): The name of the index to index the file into.
+    """
+    actions = list(parse_file_to_actions(file_path, index_name=index_name))
 
     # Perform all actions in bulk
     if actions:
-        try:
-            helpers.bulk(client, actions)
-        except helpers.BulkIndexError as e:
-            ic(f"Bulk index error: {e.errors}")
+        cluster_keys = find_duplicate_clusters(action["_source"]["text"] for action in actions)
+        bulk_index_actions(tag_duplicates(actions, cluster_keys), client=client)
+        mark_index_changed(client=client, index_name=index_name)
         
 def index_directory_to_elasticsearch(client=elastic_client, 
                                      index_name=elastic_index_name,
@@ -307,23 +683,465 @@ def index_directory_to_elasticsearch(client=elastic_client,
         index_name (str): The name of the index to index the files into.
         raw_data (str): The path pattern to match the files to index.
     """
-    glob_pattern = raw_data
+    ic("Indexing {}".format(raw_data))
+
+    # duplicates are found across the whole corpus, so every file is parsed before any is
+    # sent, to a spool file rather than memory, which is read once for the clusters and
+    # once for the load
+    with tempfile.TemporaryDirectory() as spool_dir:
+        spool_fn = os.path.join(spool_dir, "actions.jsonl")
+
+        spooled_files = spool_directory_actions(spool_fn, index_name=index_name, raw_data=raw_data)
+
+        if any(entry["actions"] for entry in spooled_files.values()):
+            cluster_keys = find_duplicate_clusters(action["_source"]["text"] for action in read_spooled_actions(spool_fn))
+            load_spooled_actions(spool_fn, cluster_keys, spooled_files, client=client, index_name=index_name)
+
+def spool_directory_actions(spool_fn: str,
+                            index_name=elastic_index_name,
+                            raw_data=raw_data):
+    """
+    Parse all files in a directory and buffer the bulk actions to a JSONL file on disk.
+
+    This lets parsing run before the index exists, without holding every document in memory.
+
+    Args:
+        spool_fn (str): The path of the file to write the actions to.
+        index_name (str): The name of the index the actions target.
+        raw_data (str): The path pattern to match the files to parse.
+
+    Returns:
+        dict: The size and modification time of each file, by absolute path, as they were
+            before it was parsed, and the number of actions written for it, in the order of the spool.
+    """
+    spooled_files = {}
+
+    with open(spool_fn, 'w', encoding='utf-8') as spool_file:
+        for file_path in glob.glob(raw_data, recursive=True):
+            # a file saved while it is parsed looks changed to the watcher, which syncs it again
+            stat = os.stat(file_path)
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime, "actions": 0}
+            for action in parse_file_to_actions(file_path, index_name=index_name):
+                spool_file.write(json.dumps(action) + "\n")
+                entry["actions"] += 1
+            spooled_files[os.path.abspath(file_path)] = entry
+
+    ic("Spooled {} actions to {}".format(sum(entry["actions"] for entry in spooled_files.values()), spool_fn))
+
+    return spooled_files
+
+def read_spooled_actions(spool_fn: str):
+    """
+    Read back the bulk actions written by `spool_directory_actions`.
+
+    Yields:
+        dict: A bulk index action.
+    """
+    with open(spool_fn, 'r', encoding='utf-8') as spool_file:
+        for line in spool_file:
+            yield json.loads(line)
+
+def load_spooled_actions(spool_fn: str,
+                         cluster_keys,
+                         spooled_files: dict,
+                         client=elastic_client,
+                         index_name=elastic_index_name,
+                         checkpoint_fn=watch_checkpoint_fn):
+    """
+    Send the actions written by `spool_directory_actions` in bulk, tagged with their duplicate
+    clusters, and mark the index as changed, so the search pages drop the results they cached
+    while it was loading.
+
+    When every action went through, the watch checkpoint is written for the loaded files, so
+    the first `watch` after a load only sends the files that changed since they were parsed.
+
+    Args:
+        spool_fn (str): The path of the spool file.
+        cluster_keys (list): The cluster key of each action, as returned by `dedup.find_duplicate_clusters`.
+        spooled_files (dict): The files in the spool, as returned by `spool_directory_actions`.
+        client (Elasticsearch): The Elasticsearch client.
+        index_name (str): The name of the index the actions target.
+        checkpoint_fn (str): The path of the watch checkpoint file.
+    """
+    checkpoint = {"index": index_name, "files": {}}
+    file_entries = iter((file_path, entry) for file_path, entry in spooled_files.items() for _ in range(entry["actions"]))
+
+    def hashed(actions):
+        # the spool holds the actions of each file in turn, in the order of spooled_files
+        for action in actions:
+            file_path, entry = next(file_entries)
+            docs = checkpoint["files"].setdefault(file_path, {"size": entry["size"], "mtime": entry["mtime"], "docs": {}})["docs"]
+            docs[action["_id"]] = document_hash(action["_source"])
+            yield action
+
+    loaded = bulk_index_actions(hashed(tag_duplicates(read_spooled_actions(spool_fn), cluster_keys)), client=client)
+    mark_index_changed(client=client, index_name=index_name)
+
+    if loaded:
+        # the files without a line to index are checkpointed too, so they aren't parsed again
+        for file_path, entry in spooled_files.items():
+            checkpoint["files"].setdefault(file_path, {"size": entry["size"], "mtime": entry["mtime"], "docs": {}})
+        save_watch_checkpoint(checkpoint, checkpoint_fn)
+
+def run_pipeline(stages: dict) -> dict:
+    """
+    Run a set of dependent steps, each one as soon as the steps it depends on are done.
+
+    Every stage gets its own thread and first waits for the stages it depends on, so
+    independent stages overlap and the total time is that of the longest chain. A failed
+    stage fails the stages that depend on it, and its exception is raised at the end.
+
+    Args:
+        stages (dict): Maps a stage name to a (function, [names of stages it depends on]) tuple.
+            The function is called with the results of its dependencies, in order. A stage has
+            to come after the stages it depends on.
+
+    Raises:
+        ValueError: If a stage depends on a stage that does not come before it.
+
+    Returns:
+        dict: The timings of each stage, in seconds, plus the total under "total".
+    """
+    timings = {}
+    pipeline_start = time.monotonic()
 
-    ic("Indexing {}".format(glob_pattern))
+    def run_stage(name, fn, dependencies):
+        inputs = [futures[dependency].result() for dependency in dependencies]
+        stage_start = time.monotonic()
+        result = fn(*inputs)
+        timings[name] = time.monotonic() - stage_start
+        ic("Finished {} in {:.1f}s".format(name, timings[name]))
+        return result
 
-    for file_path in glob.glob(glob_pattern, recursive=True):
-        index_file_to_elasticsearch(client=client, 
-                                    file_path=file_path, 
-                                    index_name=index_name)
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        futures = {}
+        for name, (fn, dependencies) in stages.items():
+            unknown = [dependency for dependency in dependencies if dependency not in futures]
+            if unknown:
+                raise ValueError("Stage {} depends on {}, which must come before it".format(name, unknown))
+            futures[name] = executor.submit(run_stage, name, fn, dependencies)
+
+        for future in futures.values():
+            future.exception()
+
+    timings["total"] = time.monotonic() - pipeline_start
+    ic(timings)
+
+    for future in futures.values():
+        future.result()
+
+    return timings
+
+def save_watch_checkpoint(checkpoint: dict, checkpoint_fn=watch_checkpoint_fn):
+    """
+    Write the watch checkpoint, replacing the old one in one step, so a crash never leaves half of it.
+
+    Args:
+        checkpoint (dict): The index the checkpoint is for, and the size, modification time
+            and line hashes of each of its files.
+        checkpoint_fn (str): The path of the checkpoint file.
+    """
+    tmp_fn = checkpoint_fn + ".tmp"
+    with open(tmp_fn, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_fn, checkpoint_fn)
+
+def document_hash(source: dict) -> str:
+    """
+    Hash the source of a document, to tell whether a line has changed since it was indexed.
+    """
+    return hashlib.sha256(json.dumps(source, sort_keys=True).encode()).hexdigest()
+
+class IndexWatcher(FileSystemEventHandler):
+    """
+    Keep the index in step with the files matching RAW_DATA as they are saved, moved and deleted.
+
+    File events are coalesced: a burst of saves becomes one micro-batch, sent once no event has
+    arrived for `debounce` seconds, or `max_delay` seconds after the first one at the latest.
+    Only the files that changed are parsed again, and only the lines whose content changed are
+    sent, as index actions, with delete actions for the lines that are gone. This keeps the
+    semantic_text inference to the lines that need it.
+
+    The checkpoint file keeps the size, modification time and line hashes of every indexed file,
+    and is written after each batch, and by a full load. On start, the files are compared to it by size and
+    modification time, so a restart only parses what changed while the watcher was down.
+    """
+
+    def __init__(self, client=elastic_client,
+                 index_name=elastic_index_name,
+                 raw_data=raw_data,
+                 checkpoint_fn=watch_checkpoint_fn,
+                 debounce: float = watch_debounce,
+                 max_delay: float = watch_max_delay):
+        super().__init__()
+        self.client = client
+        self.index_name = index_name
+        self.raw_data = raw_data
+        self.checkpoint_fn = checkpoint_fn
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.checkpoint = self.load_checkpoint()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._stop = threading.Event()
+
+    def load_checkpoint(self) -> dict:
+        try:
+            with open(self.checkpoint_fn, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            checkpoint = None
+
+        # a checkpoint of another index says nothing about this one
+        if not checkpoint or checkpoint.get("index") != self.index_name:
+            checkpoint = {"index": self.index_name, "files": {}}
+
+        return checkpoint
+
+    def save_checkpoint(self):
+        save_watch_checkpoint(self.checkpoint, self.checkpoint_fn)
+
+    def queue(self, file_path: str):
+        """
+        Queue a file to be synced with the next batch, if it matches RAW_DATA.
+        """
+        if not matches_raw_data(file_path, raw_data=self.raw_data):
+            return
+
+        with self._lock:
+            self._pending.setdefault(os.path.abspath(file_path), time.monotonic())
+        self._event.set()
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.queue(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.queue(event.src_path)
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self.queue(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.queue(event.src_path)
+            self.queue(event.dest_path)
+
+    def queue_changed_files(self) -> int:
+        """
+        Queue the files that changed since the checkpoint, by size and modification time.
+
+        Returns:
+            int: The number of files queued.
+        """
+        current = {os.path.abspath(file_path) for file_path in glob.glob(self.raw_data, recursive=True)}
+        queued = 0
+
+        for file_path in current | set(self.checkpoint["files"]):
+            entry = self.checkpoint["files"].get(file_path)
+            try:
+                stat = os.stat(file_path)
+                changed = entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime
+            except FileNotFoundError:
+                changed = True
+
+            if changed:
+                self.queue(file_path)
+                queued += 1
+
+        return queued
+
+    def file_actions(self, file_path: str):
+        """
+        Build the actions that bring the index in step with a file.
+
+        Returns:
+            tuple: The actions, and the checkpoint entry of the file once they are applied,
+                or None if the file is gone.
+        """
+        old_docs = self.checkpoint["files"].get(file_path, {}).get("docs", {})
+
+        try:
+            stat = os.stat(file_path)
+            new_docs = {}
+            actions = []
+            # tagged before hashing, so a copy of a line that becomes the embedded one is sent
+            # again. Only exact duplicates are clustered here, the near duplicates are found
+            # again by the next full load
+            for action in tag_duplicates(parse_file_to_actions(file_path, index_name=self.index_name)):
+                new_docs[action["_id"]] = document_hash(action["_source"])
+                if old_docs.get(action["_id"]) != new_docs[action["_id"]]:
+                    actions.append(action)
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime, "docs": new_docs}
+        except FileNotFoundError:
+            new_docs = {}
+            actions = []
+            entry = None
+
+        actions.extend({"_op_type": "delete", "_index": self.index_name, "_id": doc_id}
+                       for doc_id in old_docs if doc_id not in new_docs)
+
+        return actions, entry
+
+    def sync(self, file_paths) -> dict:
+        """
+        Send one micro-batch for the given files, and checkpoint the files that were applied.
+
+        Returns:
+            dict: The number of files, index and delete actions, and failed files.
+        """
+        stats = {"files": 0, "index": 0, "delete": 0, "failed": 0}
+        updates = {}
+        actions = []
+        action_files = []
+
+        for file_path in file_paths:
+            file_actions, entry = self.file_actions(file_path)
+            updates[file_path] = entry
+            actions.extend(file_actions)
+            action_files.extend([file_path] * len(file_actions))
+            stats["files"] += 1
+
+        failed_ids = set()
+        if actions:
+            for ok, item in helpers.streaming_bulk(self.client, actions, raise_on_error=False, raise_on_exception=False):
+                op_type, result = next(iter(item.items()))
+                stats[op_type] = stats.get(op_type, 0) + 1
+                # deleting a line that was never indexed is not a failure
+                if not ok and not (op_type == "delete" and result.get("status") == 404):
+                    ic(f"Could not {op_type} {result.get('_id')}: {result.get('error')}")
+                    failed_ids.add(result.get("_id"))
+
+            # the search pages drop the results they cached before this batch
+            try:
+                mark_index_changed(client=self.client, index_name=self.index_name)
+            except Exception as e:
+                ic(f"Could not mark {self.index_name} as changed: {e}")
+
+        # the checkpoint only moves on for files whose actions all went through
+        failed_files = {file_path for file_path, action in zip(action_files, actions) if action["_id"] in failed_ids}
+        stats["failed"] = len(failed_files)
+
+        for file_path, entry in updates.items():
+            if file_path in failed_files:
+                continue
+            if entry is None:
+                self.checkpoint["files"].pop(file_path, None)
+            else:
+                self.checkpoint["files"][file_path] = entry
+
+        self.save_checkpoint()
+        ic(stats)
+
+        return stats
+
+    def next_batch(self, timeout: float = None) -> list:
+        """
+        Wait for the next burst of events to settle, and take the files it touched.
+
+        Returns:
+            list: The files, empty if nothing happened before the timeout or stop.
+        """
+        if not self._event.wait(timeout):
+            return []
+
+        with self._lock:
+            first = min(self._pending.values(), default=None)
+
+        if first is None:
+            self._event.clear()
+            return []
+
+        # wait for a quiet period, but not for ever under a steady stream of saves
+        while not self._stop.is_set():
+            self._event.clear()
+            remaining = self.max_delay - (time.monotonic() - first)
+            if remaining <= 0 or not self._event.wait(min(self.debounce, remaining)):
+                break
+
+        with self._lock:
+            file_paths = list(self._pending)
+            self._pending.clear()
+
+        return file_paths
+
+    def run(self):
+        """
+        Sync what changed since the checkpoint, then watch for changes until stopped.
+        """
+        ic(f"Resuming from {self.checkpoint_fn}: {self.queue_changed_files()} files changed")
+
+        observer = Observer()
+        observer.schedule(self, raw_data_root(self.raw_data), recursive="**" in self.raw_data)
+        observer.start()
+
+        try:
+            while not self._stop.is_set():
+                file_paths = self.next_batch(timeout=1.0)
+                if file_paths:
+                    try:
+                        self.sync(file_paths)
+                    except Exception as e:
+                        # the cluster may be away for a while, so try these files again with the next batch
+                        ic(f"Could not sync {len(file_paths)} files: {e}")
+                        for file_path in file_paths:
+                            self.queue(file_path)
+                        self._stop.wait(self.max_delay)
+        finally:
+            observer.stop()
+            observer.join()
+
+    def stop(self):
+        self._stop.set()
+        self._event.set()
+
+def watch(client=elastic_client,
+          index_name=elastic_index_name,
+          raw_data=raw_data,
+          checkpoint_fn=watch_checkpoint_fn,
+          debounce: float = watch_debounce,
+          max_delay: float = watch_max_delay):
+    """
+    Watch the files matching RAW_DATA and index their changes as they are saved, until interrupted.
+
+    The index has to exist already, with `index` or `all`.
+
+    Args:
+        client (Elasticsearch): The Elasticsearch client.
+        index_name (str): The name of the index to keep up to date.
+        raw_data (str): The path pattern to match the files to watch.
+        checkpoint_fn (str): The path of the checkpoint file.
+        debounce (float): The quiet period, in seconds, that ends a burst of events.
+        max_delay (float): The longest, in seconds, a change waits under a steady stream of events.
+    """
+    watcher = IndexWatcher(client=client,
+                           index_name=index_name,
+                           raw_data=raw_data,
+                           checkpoint_fn=checkpoint_fn,
+                           debounce=debounce,
+                           max_delay=max_delay)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
 
 def all(client=elastic_client, 
         index_name=elastic_index_name,
         sparse_field_name=elastic_sparse_field_name,
         synonyms_fn=elastic_synonym_fn, 
         synonyms_id=elastic_synonym_id, 
-        raw_data=raw_data):
+        raw_data=raw_data,
+        store_dir=corpus_store_dir):
     """
-    Perform all steps: create synonyms, create index, and index files.
+    Perform all steps: create the inference endpoint, create synonyms, create index, store the
+    search templates, tag duplicate lines, index files, and build the corpus store.
+
+    The steps are run as a pipeline: files are parsed to a spool file and the corpus store is
+    built straight away, the synonyms are uploaded while the model deploys, and the bulk load
+    starts as soon as the index exists and the model is deployed.
 
     Args:
         client (Elasticsearch): The Elasticsearch client.
@@ -331,18 +1149,41 @@ def all(client=elastic_client,
         synonyms_fn (str): The path to the CSV file containing synonyms.
         synonyms_id (str): The ID to assign to the synonyms set in Elasticsearch.
         raw_data (str): The path pattern to match the files to index.
+        store_dir (str): The directory to write the local corpus store into.
+
+    Returns:
+        dict: The timings of each stage, in seconds.
     """
-    create_inference_endpoint(inference_endpoint_name=elastic_sparse_inference_endpoint_name,
-                                client=client)
-    create_synonyms_with_csv(client=client, 
-                             synonyms_fn=synonyms_fn, 
-                             synonyms_id=synonyms_id)
-    create_index_with_fields(client=client, 
-                             index_name=index_name,
-                             sparse_field_name=sparse_field_name)
-    index_directory_to_elasticsearch(client=client, 
-                                     index_name=index_name, 
-                                     raw_data=raw_data)
+    with tempfile.TemporaryDirectory() as spool_dir:
+        spool_fn = os.path.join(spool_dir, "actions.jsonl")
+
+        return run_pipeline({
+            "inference": (lambda: create_inference_endpoint(inference_endpoint_name=elastic_sparse_inference_endpoint_name,
+                                                            client=client,
+                                                            wait=False), []),
+            "deploy": (lambda model_id: wait_for_inference_endpoint(model_id, client=client), ["inference"]),
+            "synonyms": (lambda: create_synonyms_with_csv(client=client, 
+                                                          synonyms_fn=synonyms_fn, 
+                                                          synonyms_id=synonyms_id), []),
+            # the mapping refers to both the synonyms set and the inference endpoint
+            "index": (lambda *_: create_index_with_fields(client=client, 
+                                                          index_name=index_name,
+                                                          sparse_field_name=sparse_field_name), ["synonyms", "inference"]),
+            "parse": (lambda: spool_directory_actions(spool_fn, 
+                                                      index_name=index_name, 
+                                                      raw_data=raw_data), []),
+            "corpus": (lambda: build_corpus_store(raw_data=raw_data,
+                                                  store_dir=store_dir), []),
+            "templates": (lambda: create_search_templates(client=client), []),
+            # near duplicates are found across the whole corpus, while the model deploys
+            "dedup": (lambda *_: find_duplicate_clusters(action["_source"]["text"] for action in read_spooled_actions(spool_fn)), ["parse"]),
+            # the semantic_text field needs the model to be deployed before documents arrive
+            "load": (lambda _index, _deploy, spooled_files, cluster_keys: load_spooled_actions(spool_fn,
+                                                                                               cluster_keys,
+                                                                                               spooled_files,
+                                                                                               client=client,
+                                                                                               index_name=index_name), ["index", "deploy", "parse", "dedup"]),
+        })
 
 if __name__ == "__main__":
 
@@ -351,15 +1192,23 @@ if __name__ == "__main__":
     # Invoking this function would look something like:
     #   python indexing.py inference  (grabs defaults from .env)
     #   python indexing.py synonyms  (grabs defaults from .env)
+    #   python indexing.py sync-synonyms --dry_run  (grabs defaults from .env)
     #   python indexing.py index  (grabs defaults from .env)
+    #   python indexing.py templates  (grabs defaults from .env)
     #   python indexing.py load  (grabs defaults from .env)
+    #   python indexing.py corpus  (grabs defaults from .env)
+    #   python indexing.py watch  (grabs defaults from .env, keeps running)
     #   python indexing.py all --index-name acme --synonyms_fn synonyms.csv --synonyms_id acme-synonyms --raw_data "site/*.txt" (overrides defaults)
 
     fire.Fire({
         "inference": create_inference_endpoint,
         "synonyms": create_synonyms_with_csv,
+        "sync-synonyms": sync_synonyms_with_csv,
         "index": create_index_with_fields,
+        "templates": create_search_templates,
         "load": index_directory_to_elasticsearch,
+        "corpus": build_corpus_store,
+        "watch": watch,
         "all": all
     })
 
@@ -1,11 +1,12 @@
 import streamlit as st
 import os
-import codecs
-import markdown
+import html
 from decouple import config
 import glob
 from icecream import ic
 
+from corpus import CorpusStore, render_markdown_file, read_line_window, corpus_store_dir
+
 page_title = "File Browser"
 st.title(page_title)
 st.session_state.current_page = page_title
@@ -15,20 +16,80 @@ if 'previous_page' not in st.session_state:
 
 glob_pattern = config('RAW_DATA', default='none')
 
-# Function to load and convert markdown to html
-def load_markdown_file(markdown_file):
-    with codecs.open(markdown_file, "r", encoding="utf-8") as input_file:
-        text = input_file.read()
-    return markdown.markdown(text)
+@st.cache_resource
+def get_corpus_store(store_dir):
+    """
+    Get the corpus store, shared across sessions so the memory maps and LRU are reused.
+    """
+    return CorpusStore(store_dir=store_dir)
+
+@st.cache_data
+def list_markdown_files(glob_pattern):
+    return [f for f in glob.glob(glob_pattern, recursive=True)]
+
+def render_line_window(first_line, lines, line_number):
+    """
+    Render a window of lines as HTML, with line numbers and the hit line highlighted.
+    """
+    rows = []
+    for number, line in enumerate(lines, start=first_line):
+        style = ' style="background-color: #ff0; color: #000; font-weight: bold;"' if number == line_number else ''
+        rows.append(f'<tr{style}><td style="text-align: right; color: #888;">{number}</td><td>{html.escape(line)}</td></tr>')
+    return f'<table style="width: 100%; font-family: monospace;">{"".join(rows)}</table>'
+
+if CorpusStore.exists(corpus_store_dir):
+    store = get_corpus_store(corpus_store_dir)
+    # a rebuilt store is picked up by the same store, and the memory maps of the old one released
+    store.reopen_if_rebuilt()
+    list_files = store.search
+    find_file = store.find
+    load_markdown_file = store.html
+    load_line_window = store.lines
+else:
+    # no store has been built yet, so fall back to scanning and rendering on the fly
+    st.warning("No corpus store found. Run `python indexing.py corpus` to speed up this page.")
+    list_files = lambda term: [f for f in list_markdown_files(glob_pattern) if term.lower() in f.lower()]
+    find_file = lambda file_name: next((f for f in list_markdown_files(glob_pattern) if os.path.basename(f) == file_name), None)
+    load_markdown_file = render_markdown_file
+    load_line_window = read_line_window
+
+# a search hit links here with the file name and line number of the hit
+context_file = st.query_params.get('file')
+context_line = st.query_params.get('line')
+
+if context_file and context_line:
+    context_path = find_file(context_file)
+
+    # the link can be edited by hand, so the line may not be a line number
+    try:
+        line_number = int(context_line)
+    except ValueError:
+        line_number = None
+
+    if not context_path:
+        st.error(f"File {context_file} was not found.")
+    elif line_number is None or line_number < 1:
+        st.error(f"Line {context_line} is not a line number.")
+    else:
+        st.header(f"{context_file}, line {line_number}")
+
+        context = st.slider('Lines of context', min_value=1, max_value=100, value=10)
+        first_line, lines = load_line_window(context_path, line_number, context)
+        st.html(render_line_window(first_line, lines, line_number))
 
-# List of markdown files in directory
-markdown_files = [f for f in glob.glob(glob_pattern, recursive=True)]
+    if st.button('Browse all files'):
+        st.query_params.clear()
+        st.rerun()
+else:
+    # Filter and dropdown to select markdown file
+    file_filter = st.text_input('Filter files', value="")
+    markdown_files = list_files(file_filter)
 
-# Dropdown to select markdown file
-selected_markdown_file = st.selectbox('Select a Markdown File', markdown_files)
+    selected_markdown_file = st.selectbox('Select a Markdown File', markdown_files)
 
-# Load and render selected markdown file
-markdown_path = selected_markdown_file
-markdown_html = load_markdown_file(markdown_path)
-st.markdown(markdown_html, unsafe_allow_html=True)
+    # Load and render selected markdown file
+    if selected_markdown_file:
+        markdown_html = load_markdown_file(selected_markdown_file)
+        st.markdown(markdown_html, unsafe_allow_html=True)
 
+st.session_state.previous_page = page_title
@@ -5,7 +5,7 @@ from typing import Any, List
 from decouple import config
 from icecream import ic
 
-from utils import query_elastic_by_single_field, get_elastic_client, build_search_metadata, add_to_search_history, display_results
+from utils import query_elastic_by_single_field, get_elastic_client, build_search_metadata, add_to_search_history, display_search, fuzzy_fuzziness
 
 elastic_index_name = config('ELASTIC_INDEX_NAME', default='none')
 elastic_cloud_id = config('ELASTIC_CLOUD_ID', default='none')
@@ -27,14 +27,15 @@ def fuzzy_elastic(searchterm: str,
                      display_field_name="text") -> List[Any]:
 
     index_field_name = field_name
-    excluded_fields = ['_index', '_id', 'text_completion', 'heading_completion', 'text_synonym', 'text_sparse_embedding','model_id']
+    source_fields = ['file_name', 'line_number', 'heading', 'text']
     search_type = "match"
 
-    hits, query = query_elastic_by_single_field(searchterm, 
+    hits, query, stats = query_elastic_by_single_field(searchterm, 
                                   index_name=elastic_index_name, 
                                   field_name=index_field_name,
                                   search_type="fuzzy",
-                                  fuzziness=2,
+                                  fuzziness=fuzzy_fuzziness,
+                                  source_fields=source_fields,
                                   client=elastic_client,
                                   highlight=True)
 
@@ -46,22 +47,13 @@ def fuzzy_elastic(searchterm: str,
                               index_field_name,
                               display_field_name,
                               hits,
-                              excluded_fields,
-                              query=query)
+                              query=query,
+                              stats=stats)
     add_to_search_history(m)
 
     return text_values
 
-# pass search function to searchbox
-results = st_searchbox(
-    fuzzy_elastic,
-    key=page_title,
-    label=page_title,
-    clear_on_submit=True,
-    default_use_searchterm=True,
-    rerun_on_update=True,
-)
-
-display_results(page_title, results=results)
+# only the searchbox and results rerun as the user types
+display_search(page_title, fuzzy_elastic)
 
 st.session_state.previous_page = page_title
@@ -5,7 +5,7 @@ from typing import Any, List
 from decouple import config
 from icecream import ic
 
-from utils import query_elastic_by_single_field, get_elastic_client, display_results
+from utils import query_elastic_by_single_field, get_elastic_client, display_search
 
 elastic_index_name = config('ELASTIC_INDEX_NAME', default='none')
 elastic_cloud_id = config('ELASTIC_CLOUD_ID', default='none')
@@ -23,7 +23,7 @@ from icecream import ic
 import re
 
 
-from utils import query_elastic_by_multiple_fields, get_elastic_client, build_search_metadata,add_to_search_history
+from utils import query_elastic_hybrid, get_elastic_client, build_search_metadata,add_to_search_history
 
 # get the environment variables
 elastic_index_name = config('ELASTIC_INDEX_NAME', default='none')
@@ -33,7 +33,6 @@ elastic_api_key = config('ELASTIC_API_KEY', default='none')
 page_title = "Hybrid Search"
 st.title(page_title)
 st.session_state.current_page = page_title
-suggestion_fields = []
 
 if 'previous_page' not in st.session_state:
     st.session_state.previous_page = None
@@ -44,7 +43,7 @@ elastic_client = get_elastic_client(cloud_id=elastic_cloud_id,
 
 
 def build_fields_list(index_name :str, 
-                      included_types=['text', 'sparse_vector', 'dense_vector'], 
+                      included_types=['text', 'semantic_text', 'dense_vector'], 
                       excluded_fields=[], 
                       client = elastic_client):
     """
@@ -62,8 +61,13 @@ def build_fields_list(index_name :str,
 
     mappings = client.indices.get_mapping(index=index_name)
 
-    # Extract the field names and types
-    fields = mappings[index_name]['mappings']['properties']
+    # Extract the field names and types, including multi-fields such as text.completion
+    fields = {}
+    for field, properties in mappings[index_name]['mappings']['properties'].items():
+        fields[field] = properties
+        for sub_field, sub_properties in properties.get('fields', {}).items():
+            fields[f"{field}.{sub_field}"] = sub_properties
+
     field_types = {field: properties.get('type', 'unknown') for field, properties in fields.items() if field not in excluded_fields and properties.get('type', 'unknown') in included_types}
 
     # Sort the fields
@@ -72,127 +76,90 @@ def build_fields_list(index_name :str,
     return sorted_fields
 
 def build_query_from_checkbox(status: dict,
-                              fields: List[str]):
-    
+                              fields: List[str]) -> dict:
+    """
+    Pick the fields of the hybrid query from the checked boxes.
+
+    Args:
+        status: whether each field is checked
+        fields: a list of tuples with the field name and type
+
+    Returns:
+        query_fields: the arguments of `query_elastic_hybrid` for the checked fields
+    """
     f = dict(fields)
 
     text_fields = []
-    sparse_vector_fields = []
+    semantic_fields = []
     dense_vector_fields = []
 
-    query = {}
-
     # categorize all the fields and their types.
     for item in status:
         if status[item]:
             if f[item] == 'text':
                 text_fields.append(item)
-            if f[item]  == 'sparse_vector':
-                sparse_vector_fields.append(item)
+            if f[item] == 'semantic_text':
+                semantic_fields.append(item)
             if f[item] == 'dense_vector':
                 dense_vector_fields.append(item)
 
-    text_field_query = {}
-    sparse_field_query = {}   
-    dense_field_query = {}   
-
-    if text_fields:
-
-        # put all the fields into a single multi_match query
-        text_field_query = {
-                "standard": {
-                    "query": {
-                        "multi_match": {
-                            "query": "{query}",
-                            "fields": text_fields
-                        }
-                    }
-                }
-            }
-
-    if sparse_vector_fields:
-        # build the shell of the query
-        sparse_field_query = {
-            "standard": {
-                "query": {
-                    }
-                }
-            }
-
-        # add in the details for each sparse vector feild
-        for field in sparse_vector_fields:
-            sparse_field_query["standard"]["query"][field] = {}
-            sparse_field_query["standard"]["query"][field]["model_id"] = ".elser_model_2_linux-x86_64"
-            sparse_field_query["standard"]["query"][field]["model_text"] = "{query}"
-   
+    query_fields = {"field_names": text_fields}
+
+    if semantic_fields:
+        query_fields["semantic_field_name"] = semantic_fields[0]
+
+    # a dense vector field is searched on its own, with a knn query
     if dense_vector_fields:
-          
-        # build the shell of the query
-        dense_vectory_query = {
-          "knn": {
-            "field": "my_embeddings.predicted_value",
-            "k": 10,
-            "num_candidates": 100,
-            "query_vector_builder": {
-                "text_embedding": {
-                    "model_id": "sentence-transformers__msmarco-minilm-l-12-v3",
-                    "model_text": "{query}"
-                }
-                }
-            }
-        }
- 
-    ic(text_fields, sparse_vector_fields, dense_vector_fields, text_field_query, sparse_field_query)
+        query_fields["dense_field_name"] = dense_vector_fields[0]
+
+    ic(text_fields, semantic_fields, dense_vector_fields)
+
+    return query_fields
 
 def hybrid_elastic(searchterm: str, 
-                     field_names: List[str] = suggestion_fields,
                      display_field_name="text") -> List[Any]:
 
-    index_field_names = field_names
-    excluded_fields = ['_index', '_id', 'text', 'heading', 'text_synonym', 'text_sparse_embedding','model_id']
-    search_type = "match"
+    query_fields = st.session_state.get('hybrid_query_fields', {})
+    source_fields = ['file_name', 'line_number', 'heading', 'text']
+    search_type = "knn" if query_fields.get('dense_field_name') else "hybrid"
 
-    hits, query = query_elastic_by_multiple_fields(searchterm, 
+    hits, query, stats = query_elastic_hybrid(searchterm, 
                                   index_name=elastic_index_name, 
-                                  field_names=index_field_names,
-                                  search_type=search_type,
-                                  client=elastic_client)
+                                  source_fields=source_fields,
+                                  client=elastic_client,
+                                  **query_fields)
 
     text_values = [suggestion['_source']['text'] for suggestion in hits]
     
     m = build_search_metadata(text_values,
                               searchterm,
                               search_type,
-                              index_field_names,
+                              query_fields.get('dense_field_name') or query_fields.get('field_names'),
                               display_field_name,
                               hits,
-                              excluded_fields, 
-                              query=query)
+                              query=query,
+                              stats=stats)
     
     add_to_search_history(m)
 
     return text_values
 
-sorted_fields = build_fields_list(index_name=elastic_index_name, 
-                                  included_types=['text', 'sparse_vector', 'dense_vector'],
-                                  excluded_fields=['_index', '_id', 'heading_completion','text_completion','model_id'],
-                                  client=elastic_client)
+# the mapping doesn't change while the app runs, so it is only fetched once per session
+if 'hybrid_sorted_fields' not in st.session_state:
+    st.session_state.hybrid_sorted_fields = build_fields_list(index_name=elastic_index_name, 
+                                                              included_types=['text', 'semantic_text', 'dense_vector'],
+                                                              excluded_fields=['_index', '_id', 'model_id', 'text.shingle', 'text.trigram'],
+                                                              client=elastic_client)
+sorted_fields = st.session_state.hybrid_sorted_fields
 
 st.header("Fields to use")
 checkbox_status = {field: st.checkbox(f'{field} ({field_type})') for field, field_type in sorted_fields}
 
-build_query_from_checkbox(status=checkbox_status,
-                          fields=sorted_fields)
-
-results = st_searchbox(
-    hybrid_elastic,
-    key=page_title,
-    label=page_title,
-    clear_on_submit=True,
-    default_use_searchterm=True,
-    rerun_on_update=True,
-)
+# the searchbox reruns on its own as the user types, so it reads the fields from the session
+st.session_state.hybrid_query_fields = build_query_from_checkbox(status=checkbox_status,
+                                                                 fields=sorted_fields)
 
-display_results(page_title, results=results)
+# only the searchbox and results rerun as the user types
+display_search(page_title, hybrid_elastic)
 
 st.session_state.previous_page = page_title
\ No newline at end of file
@@ -23,7 +23,7 @@ from icecream import ic
 import re
 
 
-from utils import query_elastic_by_multiple_fields, get_elastic_client, build_search_metadata,add_to_search_history
+from utils import query_elastic_by_multiple_fields, get_elastic_client, build_search_metadata,add_to_search_history, display_search, multi_suggest_fields
 
 # get the environment variables
 elastic_index_name = config('ELASTIC_INDEX_NAME', default='none')
@@ -67,13 +67,14 @@ def suggest_elastic(searchterm: str,
                      display_field_name="text") -> List[Any]:
 
     index_field_names = field_names
-    excluded_fields = ['_index', '_id', 'text', 'heading', 'text_synonym', 'text_sparse_embedding','model_id']
+    source_fields = ['file_name', 'line_number', 'heading', 'text']
     search_type = "match"
 
-    hits, query = query_elastic_by_multiple_fields(searchterm, 
+    hits, query, stats = query_elastic_by_multiple_fields(searchterm, 
                                   index_name=elastic_index_name, 
                                   field_names=index_field_names,
                                   search_type=search_type,
+                                  source_fields=source_fields,
                                   client=elastic_client)
 
     text_values = [suggestion['_source']['text'] for suggestion in hits]
@@ -84,39 +85,19 @@ def suggest_elastic(searchterm: str,
                               index_field_names,
                               display_field_name,
                               hits,
-                              excluded_fields,
-                              query=query)
+                              query=query,
+                              stats=stats)
     
     add_to_search_history(m)
 
     return text_values
 
-fields_text = st.text_input("Fields to search", value="text_completion^3, heading_completion^5.5")
+fields_text = st.text_input("Fields to search", value=multi_suggest_fields)
 suggestion_fields = fields_text.split(',')
 
 check_fields(suggestion_fields)
 
-results = st_searchbox(
-    suggest_elastic,
-    key=page_title,
-    label=page_title,
-    clear_on_submit=True,
-    default_use_searchterm=True,
-    rerun_on_update=True,
-)
-
-# we only want to generate results if we are typing on the page
-if st.session_state.previous_page == page_title and \
-    st.session_state.current_page == page_title and \
-        results:
-
-    ic('a',st.session_state.previous_page, results)
-    # write the header
-    if 'text_values' in st.session_state.search_last.keys():
-        header = st.html(f"<h2>{st.session_state.search_last['search_term']}</h2>")
-
-    # write the actual values, with some formatting
-    if 'df_hits_html' in st.session_state.search_last.keys():
-        table = st.html(st.session_state.search_last['df_hits_html'])
+# only the searchbox and results rerun as the user types
+display_search(page_title, suggest_elastic)
 
 st.session_state.previous_page = page_title
\ No newline at end of file
@@ -0,0 +1,51 @@
+import streamlit as st
+from icecream import ic
+import pandas as pd
+from utils import history_store, search_guard_metrics
+
+page_title = "Search Analytics"
+st.title(page_title)
+st.session_state.current_page = page_title
+
+if 'previous_page' not in st.session_state:
+    st.session_state.previous_page = None
+
+if history_store.count() == 0:
+    st.write("No search history found. Run a search on one of the search pages.")
+else:
+    limit = st.slider("Number of queries", min_value=5, max_value=100, value=20)
+
+    top, zero = st.columns(2)
+
+    with top:
+        st.markdown("#### Top queries")
+        st.dataframe(history_store.top_queries(limit=limit), hide_index=True)
+
+    with zero:
+        st.markdown("#### Zero-result queries")
+        st.dataframe(history_store.zero_result_queries(limit=limit), hide_index=True)
+
+    st.markdown("#### Latency")
+    freq = st.radio("Bucket by", ["min", "h", "D"], index=1, horizontal=True,
+                    format_func={"min": "Minute", "h": "Hour", "D": "Day"}.get)
+    df_trend = history_store.latency_trend(freq=freq)
+
+    st.markdown("Median server time (ms)")
+    st.line_chart(df_trend.pivot(index='search_time', columns='search_type', values='took_ms_p50'))
+    st.markdown("90th percentile server time (ms)")
+    st.line_chart(df_trend.pivot(index='search_time', columns='search_type', values='took_ms_p90'))
+    st.markdown("Searches")
+    st.bar_chart(df_trend.pivot(index='search_time', columns='search_type', values='searches'))
+
+    if history_store.dropped:
+        st.caption(f"{history_store.dropped} searches were dropped because the history queue was full.")
+
+st.markdown("#### Search guards")
+guard_metrics = search_guard_metrics()
+if guard_metrics:
+    st.caption("Admission control and circuit breaking of each search type, since the app started.")
+    st.dataframe(pd.DataFrame(guard_metrics), hide_index=True)
+else:
+    st.write("No searches have run since the app started.")
+
+st.session_state.previous_page = page_title
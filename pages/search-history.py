@@ -1,6 +1,7 @@
 import streamlit as st
 from icecream import ic
-from utils import df_to_html
+from utils import df_to_html, history_store
+from export import export_formats, export_history, export_to_bytes
 
 page_title = "Search History"
 st.title(page_title)
@@ -9,22 +10,57 @@ st.session_state.current_page = page_title
 if 'previous_page' not in st.session_state:
     st.session_state.previous_page = None
 
-history_count = 0
-
-if 'search_history' in st.session_state:
-    if st.session_state.search_history:
-        for i, search in enumerate(reversed(st.session_state.search_history)):
-            if search:
-                ic(search)
-                with st.expander(f"Search {search['search_time']} - {search['search_type']} - '{search['search_term']}'", expanded=False):
-                    st.markdown(f"**Search Time:** {search['search_time']}")
-                    st.markdown(f"**Search Query:**")
-                    st.json(search['search_query'], expanded=False)
-                    st.markdown(f"**Search Display Field:** {search['search_display_field']}")
-                    st.markdown("#### Hits:")
-                    st.html(search['df_hits_html'])
-                history_count += 1
+history_page_size = 50
+
+session_tab, all_tab = st.tabs(["This session", "All searches"])
+
+with session_tab:
+    history_count = 0
+
+    if 'search_history' in st.session_state:
+        if st.session_state.search_history:
+            for i, search in enumerate(reversed(st.session_state.search_history)):
+                if search:
+                    ic(search)
+                    with st.expander(f"Search {search['search_time']} - {search['search_type']} - '{search['search_term']}'", expanded=False):
+                        st.markdown(f"**Search Time:** {search['search_time']}")
+                        st.markdown(f"**Search Query:**")
+                        st.json(search['search_query'], expanded=False)
+                        st.markdown(f"**Search Display Field:** {search['search_display_field']}")
+                        st.markdown("#### Hits:")
+                        st.html(search['df_hits_html'])
+                    history_count += 1
+        else:
+            st.write("No search history found.")
     else:
         st.write("No search history found.")
-else:
-    st.write("No search history found.")
+
+with all_tab:
+    # the shared store only holds compact records, and is paged in SQL rather than loaded whole
+    term_filter = st.text_input("Filter by search term", key="history_term_filter")
+    total = history_store.count(term_filter)
+
+    if total == 0:
+        st.write("No search history found.")
+    else:
+        page_count = (total + history_page_size - 1) // history_page_size
+        page_number = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1,
+                                      key="history_page_number")
+
+        df_searches = history_store.page(offset=(page_number - 1) * history_page_size,
+                                         limit=history_page_size,
+                                         term_filter=term_filter)
+        st.caption(f"{total} searches")
+        st.dataframe(df_searches.drop(columns=['id', 'search_query']), hide_index=True)
+
+        # the whole history can be large, so it is only exported on request
+        file_format = st.selectbox("Export format", list(export_formats), key="history_export_format")
+        if st.button("Prepare export"):
+            mime, extension = export_formats[file_format]
+            st.download_button(f"Download {total} searches",
+                               data=export_to_bytes(export_history, file_format=file_format,
+                                                    term_filter=term_filter, store=history_store),
+                               file_name="search-history" + extension,
+                               mime=mime)
+
+st.session_state.previous_page = page_title
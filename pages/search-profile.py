@@ -0,0 +1,71 @@
+import streamlit as st
+import altair as alt
+import pandas as pd
+from icecream import ic
+
+from utils import render_search_request
+
+page_title = "Search Profile"
+st.title(page_title)
+st.session_state.current_page = page_title
+
+if 'previous_page' not in st.session_state:
+    st.session_state.previous_page = None
+
+# widget state is dropped when the page isn't shown, so keep the switch in its own key
+profile_searches = st.checkbox("Profile searches",
+                               value=st.session_state.get('profile_searches', False),
+                               help="Run the searches on the other pages with the profile API. Profiling slows searches down.")
+st.session_state.profile_searches = profile_searches
+
+def flame_chart(df_profile):
+    """
+    Draw the rows of one shard as a flame chart: one bar per node, nested under its parent.
+    """
+    return alt.Chart(df_profile).mark_bar(stroke='white').encode(
+        x=alt.X('start_ms:Q', title='ms'),
+        x2='end_ms:Q',
+        y=alt.Y('depth:O', title=None),
+        row=alt.Row('section:N', title=None),
+        color=alt.Color('name:N', legend=None),
+        tooltip=['name', 'description', alt.Tooltip('time_ms:Q', format='.3f')],
+    ).properties(height=alt.Step(20))
+
+profiled = [search for search in st.session_state.get('search_history', [])
+            if search and search.get('search_stats') and search['search_stats'].get('profile')]
+
+if not profiled:
+    st.write("No profiled searches found. Turn on 'Profile searches' and run a search on one of the search pages.")
+else:
+    labels = [f"{search['search_time']} - {search['search_type']} - '{search['search_term']}'" for search in reversed(profiled)]
+    selected = st.selectbox("Search", range(len(labels)), format_func=lambda i: labels[i])
+    search = list(reversed(profiled))[selected]
+    stats = search['search_stats']
+
+    took, round_trip, overhead = st.columns(3)
+    took.metric("Took (server)", f"{stats['took_ms']} ms")
+    round_trip.metric("Round trip (client)", f"{stats['round_trip_ms']:.1f} ms")
+    overhead.metric("Network and client", f"{stats['round_trip_ms'] - (stats['took_ms'] or 0):.1f} ms")
+
+    df_profile = pd.DataFrame(stats['profile'])
+    df_profile['end_ms'] = df_profile['start_ms'] + df_profile['time_ms']
+
+    for shard, df_shard in df_profile.groupby('shard'):
+        st.markdown(f"#### {shard}")
+        st.altair_chart(flame_chart(df_shard), use_container_width=True)
+
+    st.markdown("#### Most expensive nodes")
+    st.dataframe(df_profile.sort_values('time_ms', ascending=False)[['shard', 'section', 'name', 'description', 'time_ms']].head(20),
+                 hide_index=True)
+
+    # a search sent as a stored template only has its ID and parameters, so show the query it stands for
+    try:
+        search_query = render_search_request(search['search_query'])
+    except Exception as e:
+        ic(f"Could not render the search template: {e}")
+        search_query = search['search_query']
+
+    st.markdown("**Search Query:**")
+    st.json(search_query, expanded=False)
+
+st.session_state.previous_page = page_title
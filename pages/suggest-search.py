@@ -21,7 +21,7 @@ from typing import Any, List
 from decouple import config
 from icecream import ic
 
-from utils import query_elastic_by_single_field, get_elastic_client, build_search_metadata,add_to_search_history, display_results
+from utils import query_elastic_by_single_field, get_elastic_client, build_search_metadata,add_to_search_history, display_search
 
 # get the environment variables
 elastic_index_name = config('ELASTIC_INDEX_NAME', default='none')
@@ -40,17 +40,18 @@ elastic_client = get_elastic_client(cloud_id=elastic_cloud_id,
                                    api_key=elastic_api_key)
 
 def suggest_elastic(searchterm: str, 
-                     field_name = "text_completion", 
+                     field_name = "text.completion", 
                      display_field_name="text") -> List[Any]:
 
     index_field_name = field_name
-    excluded_fields = ['_index', '_id', 'text', 'heading_completion', 'text_synonym', 'text_sparse_embedding','model_id']
+    source_fields = ['file_name', 'line_number', 'heading', 'text']
     search_type = "match"
 
-    hits, query = query_elastic_by_single_field(searchterm, 
+    hits, query, stats = query_elastic_by_single_field(searchterm, 
                                   index_name=elastic_index_name, 
                                   field_name=index_field_name,
                                   search_type=search_type,
+                                  source_fields=source_fields,
                                   client=elastic_client,
                                   highlight=True)
 
@@ -62,22 +63,14 @@ def suggest_elastic(searchterm: str,
                               index_field_name,
                               display_field_name,
                               hits,
-                              excluded_fields,
-                              query=query)
+                              query=query,
+                              stats=stats)
     
     add_to_search_history(m)
 
     return text_values
 
-results = st_searchbox(
-    suggest_elastic,
-    key=page_title,
-    label=page_title,
-    clear_on_submit=True,
-    default_use_searchterm=True,
-    rerun_on_update=True,
-)
-
-display_results(page_title, results=results)
+# only the searchbox and results rerun as the user types
+display_search(page_title, suggest_elastic)
 
 st.session_state.previous_page = page_title
\ No newline at end of file
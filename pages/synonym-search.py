@@ -5,7 +5,7 @@ from typing import Any, List
 from decouple import config
 from icecream import ic
 
-from utils import query_elastic_by_single_field, get_elastic_client, build_search_metadata, add_to_search_history, display_results
+from utils import query_elastic_by_single_field, get_elastic_client, build_search_metadata, add_to_search_history, display_search
 
 # get the environment variables
 elastic_index_name = config('ELASTIC_INDEX_NAME', default='none')
@@ -25,21 +25,22 @@ if 'previous_page' not in st.session_state:
     st.session_state.previous_page = None
 
 def synonym_elastic(searchterm: str, 
-                     field_name = "text_synonym", 
+                     field_name = "text.synonym", 
                      display_field_name="text") -> List[Any]:
 
     index_field_name = field_name
-    excluded_fields = ['_index', '_id', 'text', 'heading_completion', 'text_completion', 'text_sparse_embedding','model_id']
+    source_fields = ['file_name', 'line_number', 'heading', 'text']
     search_type = "match"
 
-    hits, query = query_elastic_by_single_field(searchterm, 
+    hits, query, stats = query_elastic_by_single_field(searchterm, 
                                   index_name=elastic_index_name, 
                                   field_name=index_field_name,
                                   search_type=search_type,
+                                  source_fields=source_fields,
                                   client=elastic_client,
                                   highlight=True)
 
-    text_values = [hit['_source'][index_field_name] for hit in hits if '_source' in hit and index_field_name in hit['_source']]
+    text_values = [hit['_source'][display_field_name] for hit in hits if '_source' in hit and display_field_name in hit['_source']]
 
     m = build_search_metadata(text_values,
                               searchterm,
@@ -47,24 +48,16 @@ def synonym_elastic(searchterm: str,
                               index_field_name,
                               display_field_name,
                               hits,
-                              excluded_fields,
-                              query=query)
+                              query=query,
+                              stats=stats)
     
     add_to_search_history(m)
 
     return text_values
 
     
-results = st_searchbox(
-    synonym_elastic,
-    key=page_title,
-    label=page_title,
-    clear_on_submit=True,
-    default_use_searchterm=True,
-    rerun_on_update=True,
-)
-
-display_results(page_title, results=results)
+# only the searchbox and results rerun as the user types
+display_search(page_title, synonym_elastic)
 
 # ensures that we have been on this page before
 st.session_state.previous_page = page_title
\ No newline at end of file
@@ -0,0 +1,518 @@
+from typing import List, Dict
+import functools
+import hashlib
+import inspect
+import json
+
+from decouple import config
+
+from dedup import DUPLICATE_CLUSTER_FIELD, DUPLICATE_TEXT_FIELD
+
+elastic_sparse_field_name = config('ELASTIC_SPARSE_FIELD_NAME', default='text_sparse_embedding')
+elastic_dense_field_name = config('ELASTIC_DENSE_FIELD_NAME', default='none')
+elastic_dense_field_model_name = config('ELASTIC_DENSE_FIELD_MODEL_NAME', default='none')
+search_page_size = config('SEARCH_PAGE_SIZE', default=10, cast=int)
+
+# query parameters picked by `python tuning.py run ... --write_env`
+fuzzy_fuzziness = config('FUZZY_FUZZINESS', default='2')
+fuzzy_prefix_length = config('FUZZY_PREFIX_LENGTH', default=1, cast=int)
+# Elasticsearch expands a fuzzy term to 50 terms by default
+fuzzy_max_expansions = config('FUZZY_MAX_EXPANSIONS', default=10, cast=int)
+fuzzy_transpositions = config('FUZZY_TRANSPOSITIONS', default=True, cast=bool)
+fuzzy_trigram_prefilter = config('FUZZY_TRIGRAM_PREFILTER', default=False, cast=bool)
+fuzzy_trigram_field = config('FUZZY_TRIGRAM_FIELD', default='text.trigram')
+fuzzy_trigram_minimum_should_match = config('FUZZY_TRIGRAM_MINIMUM_SHOULD_MATCH', default='25%')
+# the phrase suggester needs the text.shingle field and collapsing needs the duplicate_cluster
+# field, which an index created before them lacks, so they are off until it is rebuilt
+spell_suggester = config('SPELL_SUGGESTER', default='none')
+spell_suggest_field = config('SPELL_SUGGEST_FIELD', default='text.shingle')
+spell_text_field = config('SPELL_TEXT_FIELD', default='text')
+search_collapse = config('SEARCH_COLLAPSE', default=False, cast=bool)
+search_template_prefix = config('SEARCH_TEMPLATE_PREFIX', default='search')
+multi_suggest_fields = config('MULTI_SUGGEST_FIELDS', default='text.completion^3, heading.completion^5.5')
+hybrid_text_weight = config('HYBRID_TEXT_WEIGHT', default=1.0, cast=float)
+hybrid_semantic_weight = config('HYBRID_SEMANTIC_WEIGHT', default=1.0, cast=float)
+knn_k = config('KNN_K', default=10, cast=int)
+knn_num_candidates = config('KNN_NUM_CANDIDATES', default=100, cast=int)
+
+# the fields results can be narrowed to, and the keyword sub-fields their filters and counts use
+facet_fields = {
+    "file_name": "file_name.keyword",
+    "heading": "heading.keyword",
+}
+facet_size = config('FACET_SIZE', default=10, cast=int)
+
+def build_source_filter(source_fields: List[str] = None,
+                        excluded_fields: List[str] = None) -> Dict:
+    """
+    Build the `_source` filter for a query, so hits only carry the fields that are displayed.
+
+    Args:
+        source_fields (list): The fields to return. Default is None, for all fields.
+        excluded_fields (list): The fields never to return. Default is the semantic_text
+            embeddings and the inference metadata, which are large and never displayed.
+
+    Returns:
+        dict: The `_source` filter.
+    """
+    if excluded_fields is None:
+        excluded_fields = [elastic_sparse_field_name, 'model_id']
+
+    source_filter = {"excludes": excluded_fields}
+
+    if source_fields:
+        # copies of a line that aren't embedded carry their text in another field
+        if 'text' in source_fields:
+            source_fields = source_fields + [DUPLICATE_TEXT_FIELD]
+        source_filter["includes"] = source_fields
+
+    return source_filter
+
+def build_filter_clauses(filters: Dict[str, List[str]] = None) -> List[Dict]:
+    """
+    Build the filter clauses that keep hits to the chosen values of each facet field.
+
+    Args:
+        filters (dict): The values to keep for each of the `facet_fields`. Default is None, for no filter.
+
+    Returns:
+        list: One terms clause per facet field with values.
+    """
+    return [{"terms": {facet_fields[name]: list(values)}} for name, values in (filters or {}).items() if values]
+
+def add_filters_and_facets(query_body: Dict,
+                           filters: Dict[str, List[str]] = None,
+                           facets: bool = False,
+                           collapse: bool = False) -> Dict:
+    """
+    Narrow a query body to the chosen facet values, and ask for the facet counts in the same request.
+
+    The filters go in a bool `filter`, which doesn't score and which Elasticsearch caches, so
+    a narrowed search costs less than an open one. A knn search takes them as its own filter,
+    so the nearest neighbours are only looked for among the matching documents.
+
+    Args:
+        query_body (dict): The query body, changed in place.
+        filters (dict): The values to keep for each of the `facet_fields`. Default is None, for no filter.
+        facets (bool): Whether to add a terms aggregation for each facet field. Default is False.
+        collapse (bool): Whether to return only the best hit of each cluster of duplicate lines.
+            Default is False.
+
+    Returns:
+        dict: The query body.
+    """
+    clauses = build_filter_clauses(filters)
+
+    if clauses and 'knn' in query_body:
+        query_body['knn']['filter'] = clauses
+    elif clauses:
+        query_body['query'] = {"bool": {"must": [query_body['query']], "filter": clauses}}
+
+    if facets and facet_size > 0:
+        query_body['aggs'] = {name: {"terms": {"field": field, "size": facet_size}} for name, field in facet_fields.items()}
+
+    if collapse:
+        query_body['collapse'] = {"field": DUPLICATE_CLUSTER_FIELD}
+
+    return query_body
+
+def add_spell_suggester(query_body: Dict, searchterm: str, suggester: str = spell_suggester) -> Dict:
+    """
+    Ask for a spelling correction of the search term in the same request as the search.
+
+    The phrase suggester corrects the term as a whole from the shingles of `spell_suggest_field`,
+    and only keeps corrections that match documents, which Elasticsearch checks while it runs
+    the search. The term suggester is cheaper, and corrects each word that isn't in the index
+    on its own.
+
+    Args:
+        query_body (dict): The query body, changed in place.
+        searchterm (str): The search term to correct.
+        suggester (str): "phrase", "term", or "none" to leave the body as it is. Default is
+            SPELL_SUGGESTER, or "none".
+
+    Returns:
+        dict: The query body.
+    """
+    if suggester == "phrase":
+        query_body['suggest'] = {
+            "text": searchterm,
+            "did_you_mean": {
+                "phrase": {
+                    "field": spell_suggest_field,
+                    "size": 1,
+                    "direct_generator": [{"field": spell_suggest_field, "suggest_mode": "always"}],
+                    "collate": {
+                        "query": {"source": {"match": {spell_text_field: {"query": "{{suggestion}}", "operator": "and"}}}},
+                        "prune": False
+                    }
+                }
+            }
+        }
+    elif suggester == "term":
+        query_body['suggest'] = {
+            "text": searchterm,
+            "did_you_mean": {
+                "term": {
+                    "field": spell_text_field,
+                    "size": 1,
+                    "suggest_mode": "missing"
+                }
+            }
+        }
+    elif suggester != "none":
+        raise ValueError("Unknown suggester {}, expected 'phrase', 'term' or 'none'".format(suggester))
+
+    return query_body
+
+def build_single_field_query(searchterm: str, 
+                             field_name="",
+                             search_type="match",
+                             fuzziness: str = None,
+                             prefix_length: int = fuzzy_prefix_length,
+                             max_expansions: int = fuzzy_max_expansions,
+                             transpositions: bool = fuzzy_transpositions,
+                             trigram_prefilter: bool = fuzzy_trigram_prefilter,
+                             highlight: bool = False,
+                             source_fields: List[str] = None,
+                             filters: Dict[str, List[str]] = None,
+                             facets: bool = False,
+                             suggest: bool = False,
+                             collapse: bool = False,
+                             size: int = search_page_size) -> Dict:
+    """
+    Build the body of a query on a single field, without running it.
+
+    Args:
+        searchterm (str): The search term to query.
+        field_name (str): The name of the field to search in.
+        search_type (str): The type of search to perform. Options: "match" (default), "fuzzy", "semantic".
+        fuzziness (str): The fuzziness parameter for fuzzy search. Default is None.
+        prefix_length (int): The number of leading characters a fuzzy match must share with the
+            term. Default is FUZZY_PREFIX_LENGTH, or 1.
+        max_expansions (int): The most terms a fuzzy search expands to. Default is FUZZY_MAX_EXPANSIONS, or 10.
+        transpositions (bool): Whether swapping two adjacent characters counts as one edit.
+            Default is FUZZY_TRANSPOSITIONS, or True.
+        trigram_prefilter (bool): Whether to only score fuzzy matches among the documents that share
+            trigrams with the term. Only the field FUZZY_TRIGRAM_FIELD is a subfield of, `text`
+            by default, can be prefiltered. Default is FUZZY_TRIGRAM_PREFILTER, or False.
+        highlight (bool): Whether to highlight the search term in the results. Default is False.
+        source_fields (list): The fields to return in each hit. Default is None, for all but the embeddings.
+        filters (dict): The values to keep for each of the `facet_fields`. Default is None, for no filter.
+        facets (bool): Whether to ask for the facet counts. Default is False.
+        suggest (bool): Whether to ask for a spelling correction of the search term. Default is False.
+        collapse (bool): Whether to return only the best hit of each cluster of duplicate lines. Default is False.
+        size (int): The number of hits to return. Default is SEARCH_PAGE_SIZE, or 10.
+
+    Returns:
+        dict: The query body.
+    """
+
+    if search_type in ["semantic", "text_expansion", "vector"]:
+        search_type = "semantic"
+        highlight = False
+
+    query_body = {"query": {}, "size": size, "_source": build_source_filter(source_fields)}
+
+    if search_type == "match":
+        query_body["query"]["match"] = {
+            field_name : {
+                "query": searchterm
+            }
+        }
+    elif search_type == "fuzzy":
+        # every character of prefix_length cuts the terms the fuzzy query has to walk through
+        query_body["query"]["fuzzy"] = {
+            field_name : {
+                "value": searchterm,
+                "fuzziness": fuzziness if fuzziness else "AUTO",
+                "prefix_length": prefix_length,
+                "max_expansions": max_expansions,
+                "transpositions": transpositions
+            }
+        }
+
+        # a term too short to have a trigram would filter out everything, and the trigrams
+        # only stand for the field they are a subfield of
+        if trigram_prefilter and len(searchterm) >= 3 and fuzzy_trigram_field.rsplit('.', 1)[0] == field_name:
+            query_body["query"] = {
+                "bool": {
+                    "must": [query_body["query"]],
+                    "filter": [{
+                        "match": {
+                            fuzzy_trigram_field: {
+                                "query": searchterm,
+                                "minimum_should_match": fuzzy_trigram_minimum_should_match
+                            }
+                        }
+                    }]
+                }
+            }
+
+    elif search_type == "semantic":
+
+        query_body["query"]["semantic"] = {
+            "field": field_name,
+            "query": searchterm
+        }
+
+    if 'highlight' not in query_body:
+        query_body['highlight'] = {}
+
+    if 'fields' not in query_body['highlight']:
+        query_body['highlight']['fields'] = {}
+
+    if highlight:
+        query_body["highlight"]["fields"][field_name] = {}
+
+    if suggest:
+        add_spell_suggester(query_body, searchterm)
+
+    return add_filters_and_facets(query_body, filters=filters, facets=facets, collapse=collapse)
+
+def build_multiple_fields_query(searchterm: str, 
+                                field_names=None, 
+                                search_type="match",
+                                fuzziness: str = None,
+                                prefix_length: int = fuzzy_prefix_length,
+                                max_expansions: int = fuzzy_max_expansions,
+                                transpositions: bool = fuzzy_transpositions,
+                                source_fields: List[str] = None,
+                                filters: Dict[str, List[str]] = None,
+                                facets: bool = False,
+                                suggest: bool = False,
+                                collapse: bool = False,
+                                size: int = search_page_size) -> Dict:
+    """
+    Build the body of a query on multiple fields, without running it.
+
+    Args:
+        searchterm (str): The search term to query.
+        field_names (list): A list of field names to search in.
+        search_type (str): The type of search to perform. Options: "match" (default), "fuzzy".
+        fuzziness (str): The fuzziness parameter for fuzzy search. Default is None.
+        prefix_length (int): The number of leading characters a fuzzy match must share with the
+            term. Default is FUZZY_PREFIX_LENGTH, or 1.
+        max_expansions (int): The most terms a fuzzy search expands to, per field. Default is FUZZY_MAX_EXPANSIONS, or 10.
+        transpositions (bool): Whether swapping two adjacent characters counts as one edit.
+            Default is FUZZY_TRANSPOSITIONS, or True.
+        source_fields (list): The fields to return in each hit. Default is None, for all but the embeddings.
+        filters (dict): The values to keep for each of the `facet_fields`. Default is None, for no filter.
+        facets (bool): Whether to ask for the facet counts. Default is False.
+        suggest (bool): Whether to ask for a spelling correction of the search term. Default is False.
+        collapse (bool): Whether to return only the best hit of each cluster of duplicate lines. Default is False.
+        size (int): The number of hits to return. Default is SEARCH_PAGE_SIZE, or 10.
+
+    Returns:
+        dict: The query body.
+    """
+
+    if search_type in ["semantic", "text_expansion", "vector"]:
+        search_type = "semantic"
+        highlight = False
+
+    query_body = {"query": {}, "size": size, "_source": build_source_filter(source_fields)}
+
+    if search_type == "match":
+        # Use multi_match query to search in multiple fields
+        query_body["query"]["multi_match"] = {
+            "query": searchterm,
+            "fields": field_names
+        }
+    elif search_type == "fuzzy":
+        # one multi_match rather than a fuzzy clause per field, so the fields are searched
+        # and scored in one query, and the field boosts apply
+        query_body["query"]["multi_match"] = {
+            "query": searchterm,
+            "fields": field_names,
+            "fuzziness": fuzziness if fuzziness else "AUTO",
+            "prefix_length": prefix_length,
+            "max_expansions": max_expansions,
+            "fuzzy_transpositions": transpositions
+        }
+
+    if 'highlight' not in query_body:
+        query_body['highlight'] = {}
+
+    if 'fields' not in query_body['highlight']:
+        query_body['highlight']['fields'] = {}
+
+    if suggest:
+        add_spell_suggester(query_body, searchterm)
+
+    return add_filters_and_facets(query_body, filters=filters, facets=facets, collapse=collapse)
+
+def build_hybrid_query(searchterm: str, 
+                       field_names=None,
+                       semantic_field_name=elastic_sparse_field_name,
+                       text_weight: float = hybrid_text_weight,
+                       semantic_weight: float = hybrid_semantic_weight,
+                       source_fields: List[str] = None,
+                       filters: Dict[str, List[str]] = None,
+                       facets: bool = False,
+                       collapse: bool = False,
+                       size: int = search_page_size) -> Dict:
+    """
+    Build the body of a hybrid query, mixing a lexical match on text fields with a semantic query.
+
+    The two queries are combined in a bool `should`, so each hit's score is the weighted sum
+    of its lexical and semantic scores.
+
+    Args:
+        searchterm (str): The search term to query.
+        field_names (list): A list of text field names for the lexical part.
+        semantic_field_name (str): The semantic_text field for the semantic part.
+        text_weight (float): The boost of the lexical part. Default is HYBRID_TEXT_WEIGHT, or 1.0.
+        semantic_weight (float): The boost of the semantic part. Default is HYBRID_SEMANTIC_WEIGHT, or 1.0.
+        source_fields (list): The fields to return in each hit. Default is None, for all but the embeddings.
+        filters (dict): The values to keep for each of the `facet_fields`. Default is None, for no filter.
+        facets (bool): Whether to ask for the facet counts. Default is False.
+        collapse (bool): Whether to return only the best hit of each cluster of duplicate lines. Default is False.
+        size (int): The number of hits to return. Default is SEARCH_PAGE_SIZE, or 10.
+
+    Returns:
+        dict: The query body.
+    """
+    query_body = {"query": {}, "size": size, "_source": build_source_filter(source_fields)}
+
+    query_body["query"]["bool"] = {
+        "should": [
+            {
+                "multi_match": {
+                    "query": searchterm,
+                    "fields": field_names,
+                    "boost": text_weight
+                }
+            },
+            {
+                "semantic": {
+                    "field": semantic_field_name,
+                    "query": searchterm,
+                    "boost": semantic_weight
+                }
+            }
+        ]
+    }
+
+    return add_filters_and_facets(query_body, filters=filters, facets=facets, collapse=collapse)
+
+def build_knn_query(searchterm: str,
+                    field_name=elastic_dense_field_name,
+                    model_id=elastic_dense_field_model_name,
+                    k: int = knn_k,
+                    num_candidates: int = knn_num_candidates,
+                    source_fields: List[str] = None,
+                    filters: Dict[str, List[str]] = None,
+                    facets: bool = False,
+                    size: int = search_page_size) -> Dict:
+    """
+    Build the body of a knn query on a dense vector field, embedding the search term with a model.
+
+    Args:
+        searchterm (str): The search term to query.
+        field_name (str): The dense_vector field to search.
+        model_id (str): The text embedding model that fills the field.
+        k (int): The number of nearest neighbours to return. Default is KNN_K, or 10.
+        num_candidates (int): The number of candidates to consider per shard. Default is KNN_NUM_CANDIDATES, or 100.
+        source_fields (list): The fields to return in each hit. Default is None, for all but the embeddings.
+        filters (dict): The values to keep for each of the `facet_fields`. Default is None, for no filter.
+        facets (bool): Whether to ask for the facet counts. Default is False.
+        size (int): The number of hits to return. Default is SEARCH_PAGE_SIZE, or 10.
+
+    Returns:
+        dict: The query body.
+    """
+    query_body = {
+        "knn": {
+            "field": field_name,
+            "k": k,
+            "num_candidates": num_candidates,
+            "query_vector_builder": {
+                "text_embedding": {
+                    "model_id": model_id,
+                    "model_text": searchterm
+                }
+            }
+        },
+        "size": size,
+        "_source": build_source_filter(source_fields),
+    }
+
+    return add_filters_and_facets(query_body, filters=filters, facets=facets)
+
+# the placeholders a template is built with, and the mustache tags that replace them. Templates
+# switch mustache to <% %> delimiters, so the {{suggestion}} of the phrase suggester is left as it is.
+template_placeholders = {
+    '"__size__"': '<%size%>',
+    '"__filters__"': '<%#toJson%>filters<%/toJson%>',
+    '__searchterm__': '<%searchterm%>',
+}
+
+def template_shape(builder, **shape) -> str:
+    """
+    Get the arguments of a query builder that set the shape of its body, with its defaults filled in.
+
+    Args:
+        builder (function): The query builder.
+        **shape: The arguments of the builder, other than the search term, size and filters.
+
+    Returns:
+        str: The arguments as JSON, the same however they were passed.
+    """
+    arguments = inspect.signature(builder).bind_partial(**shape)
+    arguments.apply_defaults()
+
+    return json.dumps({name: value for name, value in arguments.arguments.items()
+                       if name not in ['searchterm', 'size', 'filters']}, sort_keys=True)
+
+@functools.lru_cache(maxsize=None)
+def build_search_template(builder, shape: str) -> tuple:
+    """
+    Build the mustache search template of a query shape.
+
+    The template is the body the builder makes, with the search term, size and filter clauses
+    left as parameters. The filters are always in a bool `filter`, which scores the same as
+    no filter when it is empty.
+
+    Args:
+        builder (function): The query builder.
+        shape (str): The arguments that set the shape of the body, as returned by `template_shape`.
+
+    Returns:
+        tuple: The ID of the template, named after the builder and a hash of the source, and its source.
+    """
+    query_body = builder("__searchterm__", size="__size__", **json.loads(shape))
+    query_body['query'] = {"bool": {"must": [query_body['query']], "filter": "__filters__"}}
+
+    source = json.dumps(query_body, sort_keys=True)
+    for placeholder, tag in template_placeholders.items():
+        source = source.replace(placeholder, tag)
+    source = "{{=<% %>=}}" + source
+
+    name = builder.__name__[len('build_'):-len('_query')]
+    template_id = "{}-{}-{}".format(search_template_prefix, name, hashlib.sha256(source.encode()).hexdigest()[:12])
+
+    return template_id, source
+
+# the query shapes of the search pages, stored ahead of time by `python indexing.py templates`
+page_source_fields = ['file_name', 'line_number', 'heading', 'text']
+search_template_modes = {
+    "match": (build_single_field_query, {"field_name": "text", "search_type": "match", "highlight": True,
+                                         "source_fields": page_source_fields, "facets": True, "suggest": True,
+                                         "collapse": search_collapse}),
+    "synonym": (build_single_field_query, {"field_name": "text.synonym", "search_type": "match", "highlight": True,
+                                           "source_fields": page_source_fields, "facets": True, "suggest": True,
+                                           "collapse": search_collapse}),
+    "suggest": (build_single_field_query, {"field_name": "text.completion", "search_type": "match", "highlight": True,
+                                           "source_fields": page_source_fields, "facets": True, "suggest": True,
+                                           "collapse": search_collapse}),
+    "fuzzy": (build_single_field_query, {"field_name": "text", "search_type": "fuzzy", "fuzziness": fuzzy_fuzziness,
+                                         "highlight": True, "source_fields": page_source_fields, "facets": True,
+                                         "collapse": search_collapse}),
+    "semantic": (build_single_field_query, {"field_name": elastic_sparse_field_name, "search_type": "semantic",
+                                            "source_fields": page_source_fields, "facets": True,
+                                            "collapse": search_collapse}),
+    "multi_field": (build_multiple_fields_query, {"field_names": [field.strip() for field in multi_suggest_fields.split(",")],
+                                                  "search_type": "match", "source_fields": page_source_fields,
+                                                  "facets": True, "suggest": True, "collapse": search_collapse}),
+}
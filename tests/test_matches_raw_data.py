@@ -0,0 +1,33 @@
+import glob
+import os
+
+from corpus import matches_raw_data
+
+def test_double_star_matches_top_level_and_nested_files(tmp_path):
+    raw_data = os.path.join(tmp_path, "site", "**", "*.md")
+
+    assert matches_raw_data(os.path.join(tmp_path, "site", "a.md"), raw_data=raw_data)
+    assert matches_raw_data(os.path.join(tmp_path, "site", "docs", "a.md"), raw_data=raw_data)
+    assert matches_raw_data(os.path.join(tmp_path, "site", "docs", "api", "a.md"), raw_data=raw_data)
+    assert not matches_raw_data(os.path.join(tmp_path, "site", "a.txt"), raw_data=raw_data)
+    assert not matches_raw_data(os.path.join(tmp_path, "other", "a.md"), raw_data=raw_data)
+
+def test_star_stays_within_one_directory(tmp_path):
+    raw_data = os.path.join(tmp_path, "site", "*.md")
+
+    assert matches_raw_data(os.path.join(tmp_path, "site", "a.md"), raw_data=raw_data)
+    assert not matches_raw_data(os.path.join(tmp_path, "site", "docs", "a.md"), raw_data=raw_data)
+
+def test_matches_like_glob(tmp_path):
+    for parts in [("a.md",), ("docs", "b.md"), ("docs", "api", "c.md"), ("docs", "d.txt")]:
+        file_path = os.path.join(tmp_path, "site", *parts)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        open(file_path, "w").close()
+
+    raw_data = os.path.join(tmp_path, "site", "**", "*.md")
+    globbed = {os.path.abspath(file_path) for file_path in glob.glob(raw_data, recursive=True)}
+
+    for root, _, files in os.walk(tmp_path):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            assert matches_raw_data(file_path, raw_data=raw_data) == (file_path in globbed)
@@ -0,0 +1,53 @@
+import pytest
+
+from guards import SearchGuard, SearchRejected
+
+def make_guard():
+    return SearchGuard("test", max_concurrency=1, queue_timeout=0.1, failure_rate=0.5,
+                       slow_call_ms=1000, window=4, min_calls=2, cooldown=0)
+
+def open_circuit(guard):
+    for _ in range(2):
+        guard.acquire()
+        guard.release(ok=False)
+    assert guard.state == "open"
+
+def test_failures_open_the_circuit():
+    guard = SearchGuard("test", min_calls=2, failure_rate=0.5, cooldown=60)
+    open_circuit(guard)
+
+    with pytest.raises(SearchRejected):
+        guard.acquire()
+
+def test_trial_search_closes_the_circuit():
+    guard = make_guard()
+    open_circuit(guard)
+
+    guard.acquire()
+    assert guard.state == "half_open"
+    guard.release(ok=True, latency_ms=10)
+
+    assert guard.state == "closed"
+
+def test_cached_trial_search_closes_the_circuit():
+    guard = make_guard()
+    open_circuit(guard)
+
+    guard.acquire()
+    assert guard.state == "half_open"
+    guard.release(ok=True, latency_ms=None)
+
+    assert guard.state == "closed"
+    assert guard.in_flight == 0
+    guard.acquire()
+    guard.release(ok=True, latency_ms=10)
+
+def test_failed_trial_search_opens_the_circuit_again():
+    guard = make_guard()
+    open_circuit(guard)
+
+    guard.acquire()
+    guard.release(ok=False)
+
+    assert guard.state == "open"
+    assert guard.metrics()["opened"] == 2
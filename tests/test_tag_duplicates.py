@@ -0,0 +1,32 @@
+from dedup import DUPLICATE_CLUSTER_FIELD, DUPLICATE_TEXT_FIELD, restore_duplicate_text, tag_duplicates
+
+def index_action(file_name, line_number, text):
+    return {"_index": "test", "_id": f"{file_name}:{line_number}",
+            "_source": {"file_name": file_name, "line_number": line_number, "heading": "", "text": text}}
+
+def test_first_copy_of_a_line_in_each_file_keeps_its_text():
+    actions = [index_action("a.md", 1, "footer line"),
+               index_action("a.md", 2, "Footer line!"),
+               index_action("b.md", 1, "footer line"),
+               {"_op_type": "delete", "_index": "test", "_id": "c.md:1"}]
+
+    tagged = list(tag_duplicates(actions))
+
+    assert ["text" in action.get("_source", {}) for action in tagged] == [True, False, True, False]
+    assert tagged[1]["_source"][DUPLICATE_TEXT_FIELD] == "Footer line!"
+    assert len({action["_source"][DUPLICATE_CLUSTER_FIELD] for action in tagged[:3]}) == 1
+
+def test_cluster_keys_are_used_when_given():
+    actions = [index_action("a.md", 1, "one"), index_action("a.md", 2, "two")]
+
+    tagged = list(tag_duplicates(actions, cluster_keys=["k", "k"]))
+
+    assert [action["_source"][DUPLICATE_CLUSTER_FIELD] for action in tagged] == ["k", "k"]
+    assert all("text" in action["_source"] for action in tagged)
+
+def test_duplicate_text_is_read_back_as_text():
+    hits = [{"_source": {"file_name": "a.md", DUPLICATE_TEXT_FIELD: "footer line"}},
+            {"_source": {"file_name": "a.md", "text": "body"}}]
+
+    assert [hit["_source"] for hit in restore_duplicate_text(hits)] == [{"file_name": "a.md", "text": "footer line"},
+                                                                        {"file_name": "a.md", "text": "body"}]
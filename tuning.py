@@ -0,0 +1,247 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict
+from icecream import ic
+import itertools
+import json
+import random
+import re
+import fire
+
+import numpy as np
+
+from decouple import config
+
+from batch import parse_modes
+from evaluation import CachedClient, read_judgments, evaluate_mode, evaluation_cache_dir
+from utils import elastic_client, elastic_index_name
+
+tuning_parallelism = config('TUNING_PARALLELISM', default=4, cast=int)
+
+# the values to try for each mode. "boost:<field>" entries are turned into the field list
+# of the multi-field query, e.g. {"boost:text.completion": 3} -> "text.completion^3".
+search_spaces = {
+    "fuzzy": {
+        "fuzziness": ["1", "2", "AUTO"],
+        "prefix_length": [0, 1, 2],
+        "max_expansions": [10, 50],
+    },
+    "multi_field": {
+        "boost:text.completion": [1, 2, 3, 5],
+        "boost:heading.completion": [1, 3, 5.5, 8],
+    },
+    "hybrid": {
+        "text_weight": [0.25, 0.5, 1.0, 2.0],
+        "semantic_weight": [0.25, 0.5, 1.0, 2.0],
+    },
+    "knn": {
+        "k": [5, 10, 20, 50],
+        "num_candidates": [50, 100, 200, 500],
+    },
+}
+
+# the .env settings each mode's parameters are written to, read by utils and the pages
+env_settings = {
+    "fuzzy": lambda params: {"FUZZY_FUZZINESS": params["fuzziness"],
+                             "FUZZY_PREFIX_LENGTH": params["prefix_length"],
+                             "FUZZY_MAX_EXPANSIONS": params["max_expansions"]},
+    "multi_field": lambda params: {"MULTI_SUGGEST_FIELDS": ", ".join(params["field_names"])},
+    "hybrid": lambda params: {"HYBRID_TEXT_WEIGHT": params["text_weight"],
+                              "HYBRID_SEMANTIC_WEIGHT": params["semantic_weight"]},
+    "knn": lambda params: {"KNN_K": params["k"], "KNN_NUM_CANDIDATES": params["num_candidates"]},
+}
+
+def generate_candidates(space: Dict[str, List], strategy: str = "grid", samples: int = 20, seed: int = 0) -> List[Dict]:
+    """
+    Generate the candidate settings of a search space.
+
+    Args:
+        space (dict): The values to try for each parameter.
+        strategy (str): "grid" for every combination, or "random" for a sample of them.
+        samples (int): The number of combinations to sample with "random". Default is 20.
+        seed (int): The seed of the random sample. Default is 0.
+
+    Returns:
+        list: The candidates, each a dictionary of parameter values.
+    """
+    names = list(space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+    if strategy == "grid":
+        return grid
+    if strategy == "random":
+        return random.Random(seed).sample(grid, min(samples, len(grid)))
+
+    raise ValueError("Unknown strategy {}, expected 'grid' or 'random'".format(strategy))
+
+def candidate_params(candidate: Dict) -> Dict:
+    """
+    Turn a candidate into the parameters of the mode's query builder.
+    """
+    params = {name: value for name, value in candidate.items() if not name.startswith("boost:")}
+    boosts = [f"{name[len('boost:'):]}^{value}" for name, value in candidate.items() if name.startswith("boost:")]
+
+    if boosts:
+        params["field_names"] = boosts
+
+    return params
+
+def pareto_front(results: List[Dict], quality: str, latency: str) -> List[Dict]:
+    """
+    Keep the results that no other result beats on both quality and latency.
+
+    Args:
+        results (list): The results of `tune`.
+        quality (str): The key of the quality metric, higher is better.
+        latency (str): The key of the latency measure, lower is better.
+
+    Returns:
+        list: The results on the front, from fastest to slowest.
+    """
+    front = []
+    best_quality = None
+
+    for result in sorted(results, key=lambda result: (result[latency], -result[quality])):
+        if best_quality is None or result[quality] > best_quality:
+            front.append(result)
+            best_quality = result[quality]
+
+    return front
+
+def write_env(settings: Dict, env_fn: str = ".env"):
+    """
+    Set values in a .env file, replacing the existing lines for those settings and keeping the rest.
+
+    Args:
+        settings (dict): The settings to write.
+        env_fn (str): The path to the .env file. Default is ".env".
+    """
+    try:
+        with open(env_fn, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+
+    remaining = dict(settings)
+    for i, line in enumerate(lines):
+        match = re.match(r'^\s*([A-Za-z_][A-Za-z0-9_]*)\s*=', line)
+        if match and match.group(1) in remaining:
+            lines[i] = "{}={}".format(match.group(1), remaining.pop(match.group(1)))
+
+    lines.extend("{}={}".format(name, value) for name, value in remaining.items())
+
+    with open(env_fn, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+
+    ic("Updated {}".format(env_fn), settings)
+
+def tune(judgments_fn: str,
+         modes="fuzzy,multi_field,hybrid",
+         metric: str = "ndcg",
+         k: int = 10,
+         strategy: str = "grid",
+         samples: int = 20,
+         seed: int = 0,
+         parallelism: int = tuning_parallelism,
+         max_latency_ms: float = None,
+         output_fn: str = None,
+         write_env_fn: str = None,
+         cache_dir=evaluation_cache_dir,
+         offline: bool = False,
+         index_name=elastic_index_name) -> Dict:
+    """
+    Sweep the query parameters of each mode against a judgments file, and find the best trade-offs.
+
+    Every candidate is evaluated with `evaluation.evaluate_mode`, several at a time, and gets
+    its mean metric and its median and p90 server latency. The candidates that are not beaten
+    on both quality and median latency form the Pareto front, and the winner is the best one on
+    the front within `max_latency_ms`.
+
+    Args:
+        judgments_fn (str): The path to a JSONL or CSV judgments file.
+        modes (str): The modes to tune, comma separated, from the keys of `search_spaces`.
+        metric (str): The metric to maximize: "ndcg", "mrr" or "recall". Default is "ndcg".
+        k (int): The rank cutoff. Default is 10.
+        strategy (str): "grid" to try every candidate, or "random" to sample them.
+        samples (int): The number of candidates per mode with "random". Default is 20.
+        seed (int): The seed of the random sample. Default is 0.
+        parallelism (int): The number of candidates evaluated at the same time.
+        max_latency_ms (float): The highest median latency the winner may have. Default is None.
+        output_fn (str): The path of a JSONL file to write every result to. Default is None.
+        write_env_fn (str): The .env file to write the winners to, e.g. ".env". Default is None.
+        cache_dir (str): The directory of the response cache.
+        offline (bool): Only use the response cache, never the cluster. Default is False.
+        index_name (str): The name of the Elasticsearch index to search in.
+
+    Returns:
+        dict: For each mode, the Pareto front and the winner.
+    """
+    judgments = read_judgments(judgments_fn)
+    client = CachedClient(cache_dir=cache_dir, client=None if offline else elastic_client)
+    quality = f"{metric}@{k}"
+
+    def run_candidate(mode, candidate):
+        params = candidate_params(candidate)
+        summary = evaluate_mode(mode, judgments,
+                                k=k,
+                                concurrency=1,
+                                index_name=index_name,
+                                client=client,
+                                **params)
+        took = [record["took_ms"] for record in summary["records"] if record["took_ms"] is not None]
+
+        return {
+            "mode": mode,
+            "candidate": candidate,
+            "params": params,
+            quality: summary[quality] or 0.0,
+            "errors": summary["errors"],
+            "took_ms_p50": float(np.percentile(took, 50)) if took else float("inf"),
+            "took_ms_p90": float(np.percentile(took, 90)) if took else float("inf"),
+        }
+
+    tuned = {}
+    output_file = open(output_fn, 'w', encoding='utf-8') if output_fn else None
+
+    try:
+        for mode in parse_modes(modes):
+            if mode not in search_spaces:
+                raise ValueError("No search space for mode {}, expected some of {}".format(mode, list(search_spaces)))
+
+            candidates = generate_candidates(search_spaces[mode], strategy=strategy, samples=samples, seed=seed)
+
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                results = list(executor.map(lambda candidate: run_candidate(mode, candidate), candidates))
+
+            if output_file:
+                for result in results:
+                    output_file.write(json.dumps(result) + "\n")
+
+            front = pareto_front(results, quality=quality, latency="took_ms_p50")
+            allowed = [result for result in front if max_latency_ms is None or result["took_ms_p50"] <= max_latency_ms]
+            winner = max(allowed, key=lambda result: result[quality]) if allowed else None
+
+            tuned[mode] = {"front": front, "winner": winner}
+            ic(mode, front, winner)
+    finally:
+        if output_file:
+            output_file.close()
+
+    if write_env_fn:
+        settings = {}
+        for mode, result in tuned.items():
+            if result["winner"]:
+                settings.update(env_settings[mode](result["winner"]["params"]))
+        write_env(settings, env_fn=write_env_fn)
+
+    return tuned
+
+if __name__ == "__main__":
+
+    # Invoking this function would look something like:
+    #   python tuning.py run judgments.jsonl  (grabs defaults from .env)
+    #   python tuning.py run judgments.jsonl --modes fuzzy,hybrid --strategy random --samples 10 --max_latency_ms 50
+    #   python tuning.py run judgments.jsonl --write_env_fn .env  (saves the winners for the pages to use)
+
+    fire.Fire({
+        "run": tune,
+    })
@@ -1,18 +1,74 @@
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, NotFoundError
 
 from typing import Any, List, Dict
 from decouple import config
 from icecream import ic
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import copy
+import queue
+import html
+import inspect
+import json
+import os
+import tempfile
+import uuid
 
 import pandas as pd
 
 from streamlit_searchbox import st_searchbox
 import streamlit as st
 
+from history import HistoryStore, compact_search_record, search_history_db
+from dedup import restore_duplicate_text
+from guards import ResultCache, SingleFlight, SearchRejected, SearchGuard, SearchGuards
+from queries import elastic_sparse_field_name, search_page_size, fuzzy_fuzziness, fuzzy_trigram_prefilter, search_collapse, \
+    multi_suggest_fields, knn_k, knn_num_candidates, facet_fields, build_source_filter, build_filter_clauses, \
+    add_filters_and_facets, build_single_field_query, build_multiple_fields_query, build_hybrid_query, build_knn_query, \
+    template_shape, build_search_template
+
 elastic_index_name = config('ELASTIC_INDEX_NAME', default='none')
 elastic_cloud_id = config('ELASTIC_CLOUD_ID', default='none')
 elastic_api_key = config('ELASTIC_API_KEY', default='none')
 elastic_sparse_model_name = config('ELASTIC_SPARSE_MODEL_NAME', default='none')
+file_browser_url = config('FILE_BROWSER_URL', default='/file-browser')
+search_pit_keep_alive = config('SEARCH_PIT_KEEP_ALIVE', default='2m')
+search_prefetch_workers = config('SEARCH_PREFETCH_WORKERS', default=4, cast=int)
+search_export_page_size = config('SEARCH_EXPORT_PAGE_SIZE', default=1000, cast=int)
+search_export_slices = config('SEARCH_EXPORT_SLICES', default=2, cast=int)
+search_export_max_hits = config('SEARCH_EXPORT_MAX_HITS', default=100000, cast=int)
+
+spell_auto_correct = config('SPELL_AUTO_CORRECT', default=False, cast=bool)
+search_templates_enabled = config('SEARCH_TEMPLATES', default=True, cast=bool)
+
+# shared caches of search results and query embeddings, and the warmer that fills them from the history
+search_result_cache_size = config('SEARCH_RESULT_CACHE_SIZE', default=1000, cast=int)
+search_result_cache_ttl = config('SEARCH_RESULT_CACHE_TTL', default=300, cast=float)
+search_generation_ttl = config('SEARCH_GENERATION_TTL', default=2, cast=float)
+query_embedding_cache_size = config('QUERY_EMBEDDING_CACHE_SIZE', default=1000, cast=int)
+cache_warmer_interval = config('CACHE_WARMER_INTERVAL', default=0, cast=float)
+cache_warmer_top_n = config('CACHE_WARMER_TOP_N', default=20, cast=int)
+cache_warmer_concurrency = config('CACHE_WARMER_CONCURRENCY', default=2, cast=int)
+
+# the field a rejected semantic search falls back to a match on
+search_fallback_field = config('SEARCH_FALLBACK_FIELD', default='text')
+
+facet_options_size = config('FACET_OPTIONS_SIZE', default=1000, cast=int)
+
+# what a search type degrades to when it is rejected
+search_fallbacks = {
+    "semantic": "match",
+    "fuzzy": "match",
+    "hybrid": "match",
+    "knn": "match",
+}
+
+# only ask for the parts of the response the pages actually use
+search_filter_path = ['took', 'hits.total', 'hits.hits._id', 'hits.hits._score', 'hits.hits._source', 'hits.hits.highlight',
+                      'aggregations.*.buckets.key', 'aggregations.*.buckets.doc_count',
+                      'suggest.*.offset', 'suggest.*.length', 'suggest.*.options.text']
 
 @st.cache_resource
 def get_elastic_client(cloud_id, api_key):
@@ -35,6 +91,242 @@ def get_elastic_client(cloud_id, api_key):
 
 elastic_client = get_elastic_client(cloud_id=elastic_cloud_id, api_key=elastic_api_key)
 
+@st.cache_resource
+def get_prefetch_executor(max_workers):
+    """
+    Get the thread pool used to fetch result pages in the background, shared by all sessions.
+
+    Args:
+        max_workers (int): The maximum number of pages fetched at the same time.
+
+    Returns:
+        ThreadPoolExecutor: The thread pool.
+    """
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+
+prefetch_executor = get_prefetch_executor(search_prefetch_workers)
+
+@st.cache_resource
+def get_history_store(db_fn):
+    """
+    Get the search history store, shared by all sessions.
+
+    Args:
+        db_fn (str): The path to the SQLite database.
+
+    Returns:
+        HistoryStore: The history store.
+    """
+    return HistoryStore(db_fn=db_fn)
+
+history_store = get_history_store(search_history_db)
+
+# st.fragment was st.experimental_fragment before Streamlit 1.37
+fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+# searchbox releases with rerun_scope can refresh their suggestions by rerunning only their fragment
+searchbox_rerun_scope = {"rerun_scope": "fragment"} if "rerun_scope" in inspect.signature(st_searchbox).parameters else {}
+
+@st.cache_resource
+def get_result_cache(max_size, ttl):
+    """
+    Get the cache of search results, shared by all sessions.
+
+    Args:
+        max_size (int): The maximum number of results kept.
+        ttl (float): The number of seconds a result is kept.
+
+    Returns:
+        ResultCache: The cache.
+    """
+    return ResultCache(max_size=max_size, ttl=ttl)
+
+@st.cache_resource
+def get_embedding_cache(max_size):
+    """
+    Get the cache of query embeddings, shared by all sessions. Embeddings don't go stale, so they never expire.
+
+    Args:
+        max_size (int): The maximum number of embeddings kept.
+
+    Returns:
+        ResultCache: The cache.
+    """
+    return ResultCache(max_size=max_size)
+
+@st.cache_resource
+def get_generation_cache(ttl):
+    """
+    Get the cache of index generations, shared by all sessions, so the result cache only asks
+    Elasticsearch whether an index changed once every `ttl` seconds.
+
+    Args:
+        ttl (float): The number of seconds a generation is kept.
+
+    Returns:
+        ResultCache: The cache.
+    """
+    return ResultCache(max_size=100, ttl=ttl)
+
+@st.cache_resource
+def get_single_flight():
+    """
+    Get the single-flight layer of the searches, shared by all sessions.
+
+    Returns:
+        SingleFlight: The single-flight layer.
+    """
+    return SingleFlight()
+
+class StoredTemplates:
+    """
+    The search templates this process has stored in Elasticsearch.
+
+    Template IDs carry a hash of their source, so a stored template never changes and each
+    one only has to be stored once. A template that can't be stored, for instance because the
+    API key may not manage scripts, is not tried again. The sources are kept, so a template
+    that Elasticsearch lost, for instance to a cluster restore, can be stored again.
+    """
+
+    def __init__(self):
+        self._stored = set()
+        self._failed = set()
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def store(self, template_id: str, source: str, client=elastic_client) -> bool:
+        """
+        Store a template, unless it already is.
+
+        Args:
+            template_id (str): The ID of the template.
+            source (str): The mustache source of the template.
+            client (Elasticsearch): The Elasticsearch client.
+
+        Returns:
+            bool: Whether the template is stored.
+        """
+        if template_id in self._stored:
+            return True
+
+        with self._lock:
+            if template_id in self._stored or template_id in self._failed:
+                return template_id in self._stored
+
+            try:
+                client.put_script(id=template_id, script={"lang": "mustache", "source": source})
+            except Exception as e:
+                ic(f"Could not store search template {template_id}: {e}")
+                self._failed.add(template_id)
+                return False
+
+            self._stored.add(template_id)
+            self._sources[template_id] = source
+            return True
+
+    def restore(self, template_id: str, client=elastic_client) -> bool:
+        """
+        Store a template again, after Elasticsearch reported it missing.
+
+        Args:
+            template_id (str): The ID of the template.
+            client (Elasticsearch): The Elasticsearch client.
+
+        Returns:
+            bool: Whether the template is stored again. Only the templates this process stored can be.
+        """
+        with self._lock:
+            source = self._sources.get(template_id)
+            self._stored.discard(template_id)
+
+        return source is not None and self.store(template_id, source, client=client)
+
+@st.cache_resource
+def get_stored_templates():
+    """
+    Get the record of the stored search templates, shared by all sessions.
+
+    Returns:
+        StoredTemplates: The stored templates.
+    """
+    return StoredTemplates()
+
+@st.cache_resource
+def get_search_guards():
+    """
+    Get the search guards, shared by all sessions.
+
+    Returns:
+        SearchGuards: The guard of each search type.
+    """
+    return SearchGuards()
+
+search_guards = get_search_guards()
+
+result_cache = get_result_cache(search_result_cache_size, search_result_cache_ttl)
+single_flight = get_single_flight()
+stored_templates = get_stored_templates()
+embedding_cache = get_embedding_cache(query_embedding_cache_size)
+generation_cache = get_generation_cache(search_generation_ttl)
+
+def display_search(page_title: str, search_function, **searchbox_options):
+    """
+    Display the searchbox of a page and its results in a fragment.
+
+    Typing in the searchbox or paging through the results only reruns the fragment, not the
+    page script around it, so the title, settings widgets and anything the page loads are
+    not redone on every keystroke.
+
+    Args:
+        page_title (str): The title of the page, also the key of the searchbox.
+        search_function (function): The function the searchbox calls with the search term.
+        **searchbox_options: Options of the searchbox, overriding the ones every page uses.
+    """
+    options = dict(key=page_title,
+                   label=page_title,
+                   clear_on_submit=True,
+                   default_use_searchterm=True,
+                   rerun_on_update=True,
+                   **searchbox_rerun_scope)
+    options.update(searchbox_options)
+
+    # the sidebar can't be written to from a fragment, and changing a filter reruns the page anyway
+    display_facet_filters()
+
+    @fragment
+    def search_fragment():
+        results = st_searchbox(search_function, **options)
+
+        # the correction came with the search that found nothing, so offering it costs no request
+        suggestion = display_spell_suggestion(page_title)
+        if suggestion:
+            search_function(suggestion)
+
+        display_results(page_title, results=results)
+
+    search_fragment()
+
+def display_spell_suggestion(page_title: str) -> str:
+    """
+    Offer the spelling correction of the last search of the page, if it found nothing.
+
+    Args:
+        page_title (str): The title of the page.
+
+    Returns:
+        str: The correction, if the user picked it, or None.
+    """
+    search_last = st.session_state.get('search_last', {})
+    suggestion = (search_last.get('search_stats') or {}).get('suggestion')
+
+    if st.session_state.current_page != page_title or not suggestion or search_last.get('hits'):
+        return None
+
+    if st.button(f"Did you mean: {suggestion}?", key=f"{page_title}-did-you-mean"):
+        return suggestion
+
+    return None
+
 def display_results(page_title:str, results:str):
     """
     Display the results of the search, based on the page title and the sesion state
@@ -53,6 +345,15 @@ def display_results(page_title:str, results:str):
 
     """
 
+    search_stats = st.session_state.get('search_last', {}).get('search_stats') or {}
+    if st.session_state.current_page == page_title and search_stats.get('rejected'):
+        st.warning(f"The search was not run: {search_stats['rejected']}")
+    elif st.session_state.current_page == page_title and search_stats.get('fallback'):
+        st.info(f"The search was degraded: {search_stats['fallback']}")
+
+    if st.session_state.current_page == page_title and search_stats.get('corrected'):
+        st.info(f"Nothing matched '{search_stats['corrected']['from']}', showing the results for '{search_stats['corrected']['to']}'.")
+
     # We don't want to generate HTML if we are on the page for the first time.
     if st.session_state.previous_page == page_title and \
         st.session_state.current_page == page_title and \
@@ -63,14 +364,201 @@ def display_results(page_title:str, results:str):
         if 'text_values' in st.session_state.search_last.keys():
             header = st.html(f"<h2>{st.session_state.search_last['search_term']}</h2>")
 
+        if search_stats.get('facets'):
+            display_facet_counts(search_stats['facets'])
+
         # write the actual values, with some formatting
         if 'df_hits_html' in st.session_state.search_last.keys():
-            table = st.html(st.session_state.search_last['df_hits_html'])
+            page_number = display_page_selector(page_title, st.session_state.search_last)
+
+            # once the pages after the first are read from a point in time, the first page is
+            # read from it too, so that no hit is shown twice or skipped between pages
+            pager = st.session_state.get(f"{page_title}_result_pager")
+            paging = pager is not None and pager.search_time == st.session_state.search_last['search_time']
+
+            if page_number == 1 and not paging:
+                hits = st.session_state.search_last['hits']
+                table = st.html(st.session_state.search_last['df_hits_html'])
+            else:
+                pager = get_result_pager(page_title, st.session_state.search_last)
+                hits = pager.page(page_number)
+
+                if hits:
+                    highlighted = [replace_with_highlight(hit) for hit in hits]
+                    df_hits = add_context_links(flatten_hits(highlighted, excluded_fields=st.session_state.search_last['excluded_fields']))
+                    table = st.html(df_to_html(df_hits, remove_highlights=True))
+                else:
+                    st.write("No more results.")
+
+            if hits:
+                display_export_buttons(page_title, hits, page_number)
+
+def display_export_buttons(page_title: str, hits: List[dict], page_number: int = 1):
+    """
+    Display the export of the hits on display, and of every match, in the chosen format.
+
+    The files are only built when asked for, rather than in every format on every rerun.
+
+    Args:
+        page_title (str): The title of the page.
+        hits (list): The hits on display, with their `_source` as indexed rather than highlighted.
+        page_number (int): The page of results on display.
+    """
+    # export imports this module for its command line, so it can't be imported at the top
+    from export import export_formats, export_hits, export_to_bytes, limit_hits
+
+    file_stem = "{}-page-{}".format(page_title.lower().replace(" ", "-"), page_number)
+    file_format = st.selectbox("Export format", list(export_formats), key=f"{page_title}_export_format")
+    mime, extension = export_formats[file_format]
+
+    if st.button("Prepare this page", key=f"{page_title}_export_page"):
+        st.download_button(f"Download page {page_number}",
+                           data=export_to_bytes(export_hits, hit_pages=[hits], file_format=file_format),
+                           file_name=file_stem + extension,
+                           mime=mime,
+                           key=f"{page_title}_export_page_download")
+
+    with st.expander("Export every match"):
+        # every match can be many pages, so they are only fetched on request
+        if st.button("Prepare export", key=f"{page_title}_export_all"):
+            search_metadata = st.session_state.search_last
+            hit_pages = scan_hits(search_metadata['search_query'], index_name=search_metadata['search_index'])
+
+            # the hits are streamed to a file rather than built up in memory, but the download
+            # button keeps the whole file in memory, so the pages stop at SEARCH_EXPORT_MAX_HITS
+            with tempfile.TemporaryDirectory() as export_dir:
+                export_fn = os.path.join(export_dir, "export" + extension)
+                rows = export_hits(limit_hits(hit_pages, search_export_max_hits), export_fn, file_format=file_format)
+
+                with open(export_fn, 'rb') as export_file:
+                    st.download_button(f"Download {rows} matches",
+                                       data=export_file,
+                                       file_name=page_title.lower().replace(" ", "-") + extension,
+                                       mime=mime,
+                                       key=f"{page_title}_export_all_download")
+
+            if rows >= search_export_max_hits:
+                st.warning(f"The export stops at {search_export_max_hits} matches. For every match, "
+                           "run `python export.py search` from the command line.")
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_facet_options(index_name: str, name: str, narrowing: tuple = ()) -> List[str]:
+    """
+    Get the values of a facet field across the index, to choose filters from.
+
+    Args:
+        index_name (str): The name of the Elasticsearch index.
+        name (str): The facet field, one of the keys of `facet_fields`.
+        narrowing (tuple): (facet field, values) pairs of filters the values must match, e.g. the
+            chosen files for the headings. A tuple, so that it can be cached.
+
+    Returns:
+        list: The values, sorted.
+    """
+    query_body = add_filters_and_facets({"query": {"match_all": {}}, "size": 0},
+                                        filters={field: list(values) for field, values in narrowing})
+    query_body['aggs'] = {name: {"terms": {"field": facet_fields[name], "size": facet_options_size}}}
+
+    try:
+        response = elastic_client.search(index=index_name, body=query_body, filter_path=['aggregations'])
+    except Exception as e:
+        ic(f"Could not get the values of {name}: {e}")
+        return []
+
+    return sorted(value for value, _ in parse_facets(response.get('aggregations', {})).get(name, []))
+
+def display_facet_filters(index_name=elastic_index_name):
+    """
+    Display a filter for each facet field in the sidebar, and keep the choices in
+    `st.session_state.facet_filters`, which the query functions follow.
+
+    The choices stay the same across pages, and the values of each field are narrowed by
+    the choices of the fields before it, so only the headings of the chosen files are offered.
+    """
+    filters = st.session_state.get('facet_filters', {})
+    chosen = {}
+
+    st.sidebar.markdown("### Filters")
+
+    for name in facet_fields:
+        selected = filters.get(name, [])
+        options = get_facet_options(index_name, name, tuple((field, tuple(values)) for field, values in chosen.items() if values))
+        # widget state is dropped when the page isn't shown, so the choices live in their own key
+        chosen[name] = st.sidebar.multiselect(name.replace("_", " ").capitalize(),
+                                              sorted(set(options) | set(selected)),
+                                              default=selected)
+
+    st.session_state.facet_filters = {name: values for name, values in chosen.items() if values}
+
+def display_facet_counts(facets: Dict):
+    """
+    Display the facet counts of a search, which came back with its hits.
+
+    Args:
+        facets (dict): The facet counts, as returned by `parse_facets`.
+    """
+    for name, buckets in facets.items():
+        if buckets:
+            counts = ", ".join(f"{value} ({count})" for value, count in buckets)
+            st.caption(f"**{name.replace('_', ' ').capitalize()}:** {counts}")
+
+def display_page_selector(page_title: str, search_metadata: Dict) -> int:
+    """
+    Display the page selector for the results, going back to the first page on a new search.
+
+    Args:
+        page_title (str): The title of the page.
+        search_metadata (dict): The metadata of the search being displayed.
+
+    Returns:
+        int: The page of results to display, starting at 1.
+    """
+    key = f"{page_title}_result_page"
+    search_key = f"{page_title}_result_page_search"
+
+    if st.session_state.get(search_key) != search_metadata['search_time']:
+        st.session_state[search_key] = search_metadata['search_time']
+        st.session_state[key] = 1
+
+    # a full first page is the only sign that there may be more
+    query = search_metadata['search_query']
+    if len(search_metadata['hits']) < query.get('params', query).get('size', search_page_size):
+        return 1
+
+    return st.number_input("Page", min_value=1, step=1, key=key)
+
+def get_result_pager(page_title: str, search_metadata: Dict):
+    """
+    Get the pager for the search being displayed on a page, replacing the pager of an older search.
+
+    Args:
+        page_title (str): The title of the page.
+        search_metadata (dict): The metadata of the search being displayed.
+
+    Returns:
+        ResultPager: The pager.
+    """
+    key = f"{page_title}_result_pager"
+    pager = st.session_state.get(key)
+
+    if pager is None or pager.search_time != search_metadata['search_time']:
+        if pager is not None:
+            pager.close()
+
+        pager = ResultPager(search_metadata['search_query'],
+                            index_name=search_metadata['search_index'],
+                            search_time=search_metadata['search_time'])
+        st.session_state[key] = pager
+
+    return pager
 
 def add_to_search_history(search_metadata, max_history_size=100):
     """
     Add the search metadata to the search history.
 
+    The session keeps the full metadata, and a compact record is queued for the shared
+    history store, which writes it in the background.
+
     Args:
         search_metadata (dict): The search metadata to add to the search history.
         max_history_size (int): The maximum size of the search history. Default is 100.
@@ -78,6 +566,14 @@ def add_to_search_history(search_metadata, max_history_size=100):
 
     st.session_state.search_last = search_metadata
 
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+
+    if search_metadata:
+        history_store.record(compact_search_record(search_metadata,
+                                                   session_id=st.session_state.session_id,
+                                                   page=st.session_state.get('current_page')))
+
     if 'search_history' not in st.session_state:
         st.session_state.search_history = []
     
@@ -92,11 +588,13 @@ def build_search_metadata(text_values,
                             index_field_name, 
                             display_field_name, 
                             hits,
-                            excluded_fields,
+                            excluded_fields = None,
                             query = [], 
+                            stats = None,
                             min_stearchterm_length=1,
                             add_to_history=False,
-                            max_history_size=100) -> Dict:
+                            max_history_size=100,
+                            index_name=elastic_index_name) -> Dict:
     """
     Build the search metadata.
 
@@ -109,10 +607,13 @@ def build_search_metadata(text_values,
         display_field_name (str): The name of the field to display in the search results.
         hits (list): The hits from the Elasticsearch query.
         query (list): The query used in the Elasticsearch query.
-        excluded_fields (list): A list of fields to drop from the DataFrame.
+        stats (dict): The stats of the search, as returned with its hits. Default is None.
+        excluded_fields (list): A list of fields to drop from the DataFrame. Default is None, for
+            the ones `flatten_hits` drops.
         min_stearchterm_length (int): The minimum length of the search term. Default is 4.
         add_to_history (bool): Whether to add the search metadata to the search history. Default is False.
         max_history_size (int): The maximum size of the search history. Default is 100.
+        index_name (str): The name of the index that was searched.
 
     Returns:
 
@@ -137,12 +638,15 @@ def build_search_metadata(text_values,
         search_metadata['search_field'] = index_field_name
         search_metadata['search_display_field'] = display_field_name
         search_metadata['search_query'] = query
+        search_metadata['search_index'] = index_name
+        search_metadata['excluded_fields'] = excluded_fields
+        search_metadata['search_stats'] = stats
 
         if hits:
-            updated_hits = [replace_with_highlight(hit) for hit in hits]
-
-            search_metadata['hits'] = updated_hits
-            search_metadata['df_hits'] = flatten_hits(search_metadata['hits'], excluded_fields=excluded_fields)
+            # the hits keep their _source as indexed, for exports, and only the table is highlighted
+            search_metadata['hits'] = hits
+            search_metadata['df_hits'] = add_context_links(flatten_hits([replace_with_highlight(hit) for hit in hits],
+                                                                        excluded_fields=excluded_fields))
             search_metadata['df_hits_html'] = df_to_html(search_metadata['df_hits'], remove_highlights=True)
         else:
             search_metadata['hits'] = []
@@ -154,22 +658,46 @@ def build_search_metadata(text_values,
     
     return search_metadata
     
+def add_context_links(df, url=file_browser_url):
+    """
+    Add a column linking each hit to its source line in the File Browser page.
+
+    Args:
+        df (pandas.DataFrame): The flattened hits.
+        url (str): The URL of the File Browser page.
+
+    Returns:
+        pandas.DataFrame: The hits with a 'context' column, if they carry a file name and line number.
+    """
+    if 'file_name' not in df.columns or 'line_number' not in df.columns:
+        return df
+
+    df = df.copy()
+    df['context'] = [
+        f'<a href="{html.escape(url + "?" + urlencode({"file": file_name, "line": int(line_number)}))}" target="_self">view</a>'
+        for file_name, line_number in zip(df['file_name'], df['line_number'])
+    ]
+    return df
+
 def replace_with_highlight(hit):
     """
 
         Replace the original text with the exerpts of highlighted text from Elasticsearch.
 
         Args:       
-            hit (dict): The hit from Elasticsearch.
+            hit (dict): The hit from Elasticsearch, which is left as it is.
 
         Returns:
-            dict: The hit with the highlighted text.
+            dict: A copy of the hit with the highlighted text.
 
     """    
     if 'highlight' in hit:
+        hit = {**hit, '_source': dict(hit['_source'])}
         for key in hit['highlight']:
-            if key in hit['_source']:
-                hit['_source'][key] = ' '.join(hit['highlight'][key])
+            # a multi-field such as text.completion isn't in _source, and highlights the field it is built from
+            field = key if key in hit['_source'] else key.split('.')[0]
+            if field in hit['_source']:
+                hit['_source'][field] = ' '.join(hit['highlight'][key])
     return hit
 
 def df_to_html(df, 
@@ -216,12 +744,14 @@ def df_to_html(df,
         '''
     return html
 
-def flatten_hits(hits: List[dict], excluded_fields=['_id', '_index', 'text_synonym']) -> List[dict]:
+def flatten_hits(hits: List[dict], excluded_fields: List[str] = None) -> List[dict]:
     """
     Flatten the hits from an Elasticsearch query.
 
     Args:
         hits (list): A list of dictionaries containing the hits from an Elasticsearch query.
+        excluded_fields (list): The columns to drop. Default is None, for the `_id` and `_index`
+            of each hit. The embeddings are already left out of the hits by `build_source_filter`.
 
     Returns:
         pandas.DataFrame: A dataframe containing the values in hits.
@@ -235,11 +765,611 @@ def flatten_hits(hits: List[dict], excluded_fields=['_id', '_index', 'text_synon
     # Convert the list of dictionaries into a pandas DataFrame
     tmp = pd.DataFrame(flattened_data)
 
+    if excluded_fields is None:
+        excluded_fields = ['_id', '_index']
+
     valid_fields = set(excluded_fields).intersection(set(tmp.columns))       
     df = tmp.drop(valid_fields, axis=1)
 
     return df
 
+def embed_query(searchterm: str, model_id: str, client=elastic_client) -> List[float]:
+    """
+    Embed a search term with a text embedding model, through the embedding cache.
+
+    Args:
+        searchterm (str): The search term to embed.
+        model_id (str): The text embedding model.
+        client (Elasticsearch): The Elasticsearch client.
+
+    Returns:
+        list: The embedding.
+    """
+    key = ResultCache.key(model_id, searchterm)
+    vector = embedding_cache.get(key)
+
+    if vector is None:
+        response = client.ml.infer_trained_model(model_id=model_id, docs=[{"text_field": searchterm}])
+        vector = response['inference_results'][0]['predicted_value']
+        embedding_cache.put(key, vector)
+
+    return vector
+
+def resolve_query_vector(query_body: Dict, client=elastic_client) -> Dict:
+    """
+    Replace the `query_vector_builder` of a knn query with a cached embedding of its text.
+
+    Elasticsearch would otherwise run the model for every search, even for a term it has just
+    seen. If the model can't be called from here, the builder is left for Elasticsearch to run.
+
+    Args:
+        query_body (dict): The query body.
+        client (Elasticsearch): The Elasticsearch client.
+
+    Returns:
+        dict: The query body, copied if the knn query was changed.
+    """
+    knn = query_body.get('knn')
+    if not isinstance(knn, dict) or 'query_vector_builder' not in knn:
+        return query_body
+
+    builder = knn['query_vector_builder']['text_embedding']
+
+    try:
+        vector = embed_query(builder['model_text'], builder['model_id'], client=client)
+    except Exception as e:
+        ic(f"Could not embed the query, leaving it to Elasticsearch: {e}")
+        return query_body
+
+    knn = {key: value for key, value in knn.items() if key != 'query_vector_builder'}
+    knn['query_vector'] = vector
+
+    return {**query_body, "knn": knn}
+
+def fetch_hits(query_body: Dict,
+               index_name=elastic_index_name,
+               client=elastic_client,
+               profile: bool = False,
+               refresh: bool = False):
+    """
+    Run a search through the result cache, and return its hits and timings.
+
+    Profiled searches always go to Elasticsearch, and are neither cached nor shared. The
+    generation of the index is part of the cache key, so results cached before the index was
+    rebuilt or written to are no longer found.
+
+    Args:
+        query_body (dict): The query body, or the template request built by `build_search_request`.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The Elasticsearch client to use for the query.
+        profile (bool): Whether to run the search with the profile API. Default is False.
+        refresh (bool): Whether to skip the cached result and replace it. Default is False.
+
+    Returns:
+        tuple: The hits, which must not be changed as they may be shared, and a dictionary
+            with the took time, the client round trip, the facet counts, the spelling correction
+            of the suggester, whether the result came from the cache or from an identical search
+            in flight, and, when profiling, the parsed profile of the search.
+    """
+    key = ResultCache.key(index_name, current_index_generation(index_name=index_name, client=client), query_body)
+
+    if not profile and not refresh:
+        start = time.perf_counter()
+        cached = result_cache.get(key)
+        if cached is not None:
+            return cached['hits'], {
+                "took_ms": cached['took_ms'],
+                "round_trip_ms": (time.perf_counter() - start) * 1000,
+                "profile": None,
+                "facets": cached['facets'],
+                "suggestion": cached['suggestion'],
+                "cached": True,
+                "shared": False,
+            }
+
+    filter_path = search_filter_path
+    body = resolve_query_vector(query_body, client=client)
+    suggest_text = query_body['params'].get('searchterm', '') if 'params' in query_body else query_body.get('suggest', {}).get('text', '')
+
+    if profile:
+        body = {**body, "profile": True}
+        filter_path = search_filter_path + ['profile']
+
+    def run_search():
+        start = time.perf_counter()
+        if 'params' in body:
+            response = call_with_stored_template(lambda: client.search_template(index=index_name,
+                                                                                id=body.get('id'),
+                                                                                source=body.get('source'),
+                                                                                params=body['params'],
+                                                                                profile=body.get('profile'),
+                                                                                filter_path=filter_path),
+                                                 body, client=client)
+        else:
+            response = client.search(index=index_name, body=body, filter_path=filter_path)
+        result = {
+            # filter_path leaves out 'hits' altogether when nothing matched
+            "hits": restore_duplicate_text(response.get('hits', {}).get('hits', [])),
+            "took_ms": response.get('took'),
+            "round_trip_ms": (time.perf_counter() - start) * 1000,
+            "facets": parse_facets(response.get('aggregations', {})),
+            "suggestion": parse_suggestion(response.get('suggest', {}), suggest_text),
+            "profile": response.get('profile'),
+        }
+
+        if not profile:
+            result_cache.put(key, {"hits": result['hits'], "took_ms": result['took_ms'], "facets": result['facets'],
+                                   "suggestion": result['suggestion']})
+
+        return result
+
+    if profile:
+        # every profiled search is its own measurement
+        result, shared = run_search(), False
+        round_trip_ms = result['round_trip_ms']
+    else:
+        # identical searches already in flight, from other sessions or the warmer, are waited on rather than repeated
+        start = time.perf_counter()
+        result, shared = single_flight.do(key, run_search)
+        round_trip_ms = (time.perf_counter() - start) * 1000 if shared else result['round_trip_ms']
+
+    return result['hits'], {
+        "took_ms": result['took_ms'],
+        "round_trip_ms": round_trip_ms,
+        "profile": parse_profile(result['profile']) if result['profile'] else None,
+        "facets": result['facets'],
+        "suggestion": result['suggestion'],
+        "cached": False,
+        "shared": shared,
+    }
+
+def parse_facets(aggregations: Dict) -> Dict:
+    """
+    Get the facet counts out of the aggregations of a search response.
+
+    Args:
+        aggregations (dict): The `aggregations` section of the response.
+
+    Returns:
+        dict: For each facet field, a list of (value, count) pairs, most frequent first.
+    """
+    return {name: [(bucket['key'], bucket['doc_count']) for bucket in aggregations[name].get('buckets', [])]
+            for name in facet_fields if name in aggregations}
+
+def parse_suggestion(suggest: Dict, text: str) -> str:
+    """
+    Get the spelling correction out of the suggestions of a search response.
+
+    The phrase suggester corrects the whole text in one option, and the term suggester each
+    of its words, so every correction is put in place of the span of the text it covers.
+
+    Args:
+        suggest (dict): The `suggest` section of the response.
+        text (str): The text the suggester was given.
+
+    Returns:
+        str: The corrected text, or None if there is nothing to correct.
+    """
+    corrected = text
+
+    # from the end, so the offsets of the spans not yet replaced still hold
+    for entry in sorted(suggest.get('did_you_mean', []), key=lambda entry: entry['offset'], reverse=True):
+        if entry.get('options'):
+            corrected = corrected[:entry['offset']] + entry['options'][0]['text'] + corrected[entry['offset'] + entry['length']:]
+
+    return corrected if corrected.lower() != text.lower() else None
+
+def search_hits(query_body: Dict, 
+                index_name=elastic_index_name, 
+                client=elastic_client,
+                profile: bool = False):
+    """
+    Run a search and return its hits and stats, with the response trimmed by `search_filter_path`.
+
+    Args:
+        query_body (dict): The query body.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The Elasticsearch client to use for the query.
+        profile (bool): Whether to run the search with the profile API. Default is False.
+
+    Returns:
+        tuple: A list of Elasticsearch hits, which the caller is free to change, and the stats
+            of the search, as returned by `fetch_hits`.
+    """
+    hits, stats = fetch_hits(query_body, index_name=index_name, client=client, profile=profile)
+
+    # cached hits are shared with every session
+    return copy.deepcopy(hits), stats
+
+def guarded_search(search_type: str,
+                   query_body: Dict,
+                   index_name=elastic_index_name,
+                   client=elastic_client,
+                   profile: bool = False):
+    """
+    Run `search_hits` through the guard of its search type.
+
+    Args:
+        search_type (str): The search type, which picks the guard.
+        query_body (dict): The query body.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The Elasticsearch client to use for the query.
+        profile (bool): Whether to run the search with the profile API. Default is False.
+
+    Raises:
+        SearchRejected: If the guard doesn't let the search through.
+
+    Returns:
+        tuple: A list of Elasticsearch hits, and the stats of the search.
+    """
+    guard = search_guards[search_type]
+    guard.acquire()
+
+    ok, latency_ms = False, None
+    try:
+        hits, stats = search_hits(query_body, index_name=index_name, client=client, profile=profile)
+        ok, latency_ms = True, None if stats.get('cached') else stats['round_trip_ms']
+    finally:
+        guard.release(ok=ok, latency_ms=latency_ms)
+
+    return hits, stats
+
+def search_guard_metrics() -> List[Dict]:
+    """
+    Get the metrics of the guard of every search type that has run.
+    """
+    return [guard.metrics() for guard in list(search_guards.values())]
+
+def parse_profile(profile: Dict) -> List[Dict]:
+    """
+    Flatten the output of the profile API into one row per timed node, laid out for a flame chart.
+
+    Each node starts where the sibling before it ends, inside the span of its parent, so the
+    rows of a shard section can be drawn as nested bars.
+
+    Args:
+        profile (dict): The `profile` section of a search response.
+
+    Returns:
+        list: The rows, each with the shard, section (query, rewrite or collector), depth,
+            name, description, start_ms and time_ms.
+    """
+    rows = []
+
+    def add_nodes(nodes, shard, section, depth, start_ms, name_key):
+        for node in nodes:
+            time_ms = node.get('time_in_nanos', 0) / 1e6
+            rows.append({
+                "shard": shard,
+                "section": section,
+                "depth": depth,
+                "name": node.get(name_key, ''),
+                "description": node.get('description', node.get('reason', '')),
+                "start_ms": start_ms,
+                "time_ms": time_ms,
+            })
+            add_nodes(node.get('children', []), shard, section, depth + 1, start_ms, name_key)
+            start_ms += time_ms
+
+    for shard in profile.get('shards', []):
+        for search in shard.get('searches', []):
+            add_nodes(search.get('query', []), shard['id'], 'query', 0, 0.0, 'type')
+            add_nodes(search.get('collector', []), shard['id'], 'collector', 0, 0.0, 'name')
+
+            rows.append({
+                "shard": shard['id'],
+                "section": 'rewrite',
+                "depth": 0,
+                "name": 'rewrite',
+                "description": 'query rewrite, including term expansion',
+                "start_ms": 0.0,
+                "time_ms": search.get('rewrite_time', 0) / 1e6,
+            })
+
+    return rows
+
+class ResultPager:
+    """
+    Page through the results of a query with a point in time and `search_after`.
+
+    Every page, the first one included, is read from the same point in time, so the pages
+    don't overlap or leave hits out however the index changes meanwhile. Each page continues
+    from the sort values of the last hit of the page before it, so a deep page costs the
+    same as the first one. A query that collapses duplicates is paged
+    with `from` instead, as `search_after` can't follow a collapse on a score sort. Pages are fetched on the prefetch thread
+    pool and kept, and the page after the one being read is fetched ahead of time.
+    """
+
+    def __init__(self, query_body: Dict,
+                 index_name=elastic_index_name,
+                 page_size: int = None,
+                 keep_alive=search_pit_keep_alive,
+                 search_time=None,
+                 client=elastic_client,
+                 executor=prefetch_executor):
+        self.query_body = copy.deepcopy(render_search_request(query_body, client=client))
+        self.page_size = page_size or self.query_body.get('size', search_page_size)
+        self.keep_alive = keep_alive
+        self.search_time = search_time
+        self.client = client
+        self.executor = executor
+        self.pit_id = client.open_point_in_time(index=index_name, keep_alive=keep_alive)['id']
+        self._pages = {}
+        self._lock = threading.RLock()
+
+    def _future(self, number: int):
+        with self._lock:
+            if number not in self._pages:
+                # every page needs the one before it, so make sure that one is on its way first
+                if number > 1:
+                    self._future(number - 1)
+                self._pages[number] = self.executor.submit(self._fetch, number)
+            return self._pages[number]
+
+    def _fetch(self, number: int) -> List[Any]:
+        body = copy.deepcopy(self.query_body)
+        # the facet counts and the spelling correction came with the first page
+        body.pop('aggs', None)
+        body.pop('suggest', None)
+        body['size'] = self.page_size
+        body['pit'] = {"id": self.pit_id, "keep_alive": self.keep_alive}
+        # with a point in time, Elasticsearch adds the _shard_doc tiebreaker to the sort values
+        body['sort'] = [{"_score": {"order": "desc"}}]
+        body['track_total_hits'] = False
+
+        if number > 1:
+            previous = self._pages[number - 1].result()
+            if len(previous) < self.page_size:
+                return []
+            # search_after can only follow a collapse sorted on the collapsed field, so a
+            # collapsed query is paged with from instead, within the result window
+            if 'collapse' in body:
+                body['from'] = (number - 1) * self.page_size
+            else:
+                body['search_after'] = previous[-1]['sort']
+
+        response = self.client.search(body=body, filter_path=search_filter_path + ['pit_id', 'hits.hits.sort'])
+
+        # the point in time id can change between requests, and the latest one has to be used
+        self.pit_id = response.get('pit_id', self.pit_id)
+
+        return restore_duplicate_text(response.get('hits', {}).get('hits', []))
+
+    def page(self, number: int) -> List[Any]:
+        """
+        Get a page of hits, and start fetching the page after it.
+
+        Args:
+            number (int): The page to get, starting at 1.
+
+        Returns:
+            list: The hits on the page, empty past the last page.
+        """
+        hits = self._future(number).result()
+
+        if len(hits) == self.page_size:
+            self._future(number + 1)
+
+        return hits
+
+    def close(self):
+        """
+        Release the point in time, rather than waiting for it to expire.
+        """
+        try:
+            self.client.close_point_in_time(id=self.pit_id)
+        except Exception as e:
+            ic(f"Could not close point in time: {e}")
+
+def scan_hits(query_body: Dict,
+              index_name=elastic_index_name,
+              page_size: int = search_export_page_size,
+              slices: int = search_export_slices,
+              keep_alive=search_pit_keep_alive,
+              client=elastic_client):
+    """
+    Yield every hit of a query, a page at a time, with a point in time and `search_after`.
+
+    The point in time is split into slices that are read in parallel, each on its own thread.
+    Hits come in index order rather than by score, which is the cheapest order to read them
+    in. At most two pages per slice are waiting at any time, so memory stays the same however
+    many hits there are. Stopping early, or an error, stops every slice and releases the
+    point in time.
+
+    Args:
+        query_body (dict): The query body, as built by one of the query builders, or a template request.
+        index_name (str): The name of the Elasticsearch index to search in.
+        page_size (int): The number of hits per request. Default is SEARCH_EXPORT_PAGE_SIZE, or 1000.
+        slices (int): The number of slices read in parallel. Default is SEARCH_EXPORT_SLICES, or 2.
+        keep_alive (str): How long the point in time is kept between requests.
+        client (Elasticsearch): The Elasticsearch client.
+
+    Yields:
+        list: The hits of a page.
+    """
+    query_body = render_search_request(query_body, client=client)
+    pit_id = client.open_point_in_time(index=index_name, keep_alive=keep_alive)['id']
+    pages = queue.Queue(maxsize=2 * slices)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan_slice(slice_id):
+        body = {key: value for key, value in query_body.items() if key not in ['highlight', 'size', 'sort', 'aggs', 'suggest', 'collapse']}
+        body['size'] = page_size
+        body['sort'] = [{"_shard_doc": "asc"}]
+        body['track_total_hits'] = False
+        body['pit'] = {"id": pit_id, "keep_alive": keep_alive}
+        if slices > 1:
+            body['slice'] = {"id": slice_id, "max": slices}
+
+        try:
+            while not stop.is_set():
+                response = client.search(body=body, filter_path=search_filter_path + ['pit_id', 'hits.hits.sort'])
+                hits = restore_duplicate_text(response.get('hits', {}).get('hits', []))
+                body['pit']['id'] = response.get('pit_id', body['pit']['id'])
+
+                if hits and not put(hits):
+                    return
+                if len(hits) < page_size:
+                    return
+
+                body['search_after'] = hits[-1]['sort']
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    threads = [threading.Thread(target=scan_slice, args=(slice_id,), name=f"scan-{slice_id}", daemon=True)
+               for slice_id in range(slices)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        finished = 0
+        while finished < slices:
+            item = pages.get()
+            if item is done:
+                finished += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        try:
+            client.close_point_in_time(id=pit_id)
+        except Exception as e:
+            ic(f"Could not close point in time: {e}")
+
+def scan_elastic_by_single_field(searchterm: str,
+                                 index_name=elastic_index_name,
+                                 field_name="",
+                                 search_type="match",
+                                 fuzziness: str = None,
+                                 source_fields: List[str] = None,
+                                 page_size: int = search_export_page_size,
+                                 slices: int = search_export_slices,
+                                 client=elastic_client):
+    """
+    Yield every hit of the query `query_elastic_by_single_field` would run, a page at a time.
+
+    Args:
+        searchterm (str): The search term to query.
+        index_name (str): The name of the Elasticsearch index to search in.
+        field_name (str): The name of the field to search in.
+        search_type (str): The type of search to perform. Options: "match" (default), "fuzzy", "semantic".
+        fuzziness (str): The fuzziness parameter for fuzzy search. Default is None.
+        source_fields (list): The fields to return in each hit. Default is None, for all but the embeddings.
+        page_size (int): The number of hits per request.
+        slices (int): The number of slices read in parallel.
+        client (Elasticsearch): The Elasticsearch client to use for the query.
+
+    Yields:
+        list: The hits of a page.
+    """
+    query_body = build_single_field_query(searchterm,
+                                          field_name=field_name,
+                                          search_type=search_type,
+                                          fuzziness=fuzziness,
+                                          source_fields=source_fields)
+
+    return scan_hits(query_body, index_name=index_name, page_size=page_size, slices=slices, client=client)
+
+def scan_elastic_by_multiple_fields(searchterm: str,
+                                    index_name=elastic_index_name,
+                                    field_names=None,
+                                    search_type="match",
+                                    fuzziness: str = None,
+                                    source_fields: List[str] = None,
+                                    page_size: int = search_export_page_size,
+                                    slices: int = search_export_slices,
+                                    client=elastic_client):
+    """
+    Yield every hit of the query `query_elastic_by_multiple_fields` would run, a page at a time.
+
+    Args:
+        searchterm (str): The search term to query.
+        index_name (str): The name of the Elasticsearch index to search in.
+        field_names (list): A list of field names to search in.
+        search_type (str): The type of search to perform. Options: "match" (default), "fuzzy".
+        fuzziness (str): The fuzziness parameter for fuzzy search. Default is None.
+        source_fields (list): The fields to return in each hit. Default is None, for all but the embeddings.
+        page_size (int): The number of hits per request.
+        slices (int): The number of slices read in parallel.
+        client (Elasticsearch): The Elasticsearch client to use for the query.
+
+    Yields:
+        list: The hits of a page.
+    """
+    query_body = build_multiple_fields_query(searchterm,
+                                             field_names=field_names,
+                                             search_type=search_type,
+                                             fuzziness=fuzziness,
+                                             source_fields=source_fields)
+
+    return scan_hits(query_body, index_name=index_name, page_size=page_size, slices=slices, client=client)
+
+def correct_spelling(searchterm: str,
+                     hits: List[Any],
+                     stats: Dict,
+                     query_body: Dict,
+                     search_type: str,
+                     build_query,
+                     index_name=elastic_index_name,
+                     client=elastic_client,
+                     profile: bool = False,
+                     auto_correct: bool = spell_auto_correct):
+    """
+    Run the corrected search of a search that found nothing, when its suggester found a correction.
+
+    Without `auto_correct` the correction is only kept in the search stats, for the page to
+    offer, and no other request is made.
+
+    Args:
+        searchterm (str): The search term that found nothing.
+        hits (list): The hits of the search.
+        stats (dict): The stats of the search, with the correction of its suggester.
+        query_body (dict): The query body of the search.
+        search_type (str): The search type, which picks the guard.
+        build_query (function): Builds the query body of a search term, without a suggester.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The Elasticsearch client to use for the query.
+        profile (bool): Whether to run the search with the profile API.
+        auto_correct (bool): Whether to run the corrected search. Default is SPELL_AUTO_CORRECT, or False.
+
+    Returns:
+        list: The hits, of the corrected search if it was run.
+        query_body (dict): The query body of the hits.
+        stats (dict): The stats of the hits, noting the correction if it was run.
+    """
+    suggestion = stats.get('suggestion')
+
+    if hits or not suggestion or not auto_correct:
+        return hits, query_body, stats
+
+    corrected_body = build_query(suggestion)
+
+    try:
+        corrected_hits, corrected_stats = guarded_search(search_type, corrected_body, index_name=index_name, client=client, profile=profile)
+    except SearchRejected as e:
+        ic(f"Not running the corrected search: {e}")
+        return hits, query_body, stats
+
+    corrected_stats = {**corrected_stats, "corrected": {"from": searchterm, "to": suggestion}}
+
+    return corrected_hits, corrected_body, corrected_stats
+
 def query_elastic_by_single_field(searchterm: str, 
                                   
                   index_name=elastic_index_name, 
@@ -248,6 +1378,13 @@ def query_elastic_by_single_field(searchterm: str,
                   fuzziness: str = None,
                   highlight: bool = False,
                   model: str = elastic_sparse_model_name,
+                  source_fields: List[str] = None,
+                  filters: Dict[str, List[str]] = None,
+                  facets: bool = True,
+                  suggest: bool = True,
+                  collapse: bool = search_collapse,
+                  size: int = search_page_size,
+                  profile: bool = None,
                   client=elastic_client) -> List[Any]:
     """
     Query Elasticsearch by field.
@@ -260,63 +1397,128 @@ def query_elastic_by_single_field(searchterm: str,
         fuzziness (str): The fuzziness parameter for fuzzy search. Default is None.
         highlight (bool): Whether to highlight the search term in the results. Default is False.
         model (str): The name of the model to use for semantic search. Default is "none".
-        excluded_fields (list): A list of fields to drop from the DataFrame. Default is ['_id', '_index', 'text_synonym'].
+        source_fields (list): The fields to return in each hit. Default is None, for all but the embeddings.
+        filters (dict): The values to keep for each of the `facet_fields`. Default is None, to
+            follow the facet filters in the sidebar.
+        facets (bool): Whether to ask for the facet counts. Default is True.
+        suggest (bool): Whether a match search asks for a spelling correction, to offer or run
+            when nothing matches. Default is True.
+        collapse (bool): Whether to return only the best hit of each cluster of duplicate lines.
+            Default is SEARCH_COLLAPSE, or False.
+        size (int): The number of hits to return. Default is SEARCH_PAGE_SIZE, or 10.
+        profile (bool): Whether to profile the search. Default is None, to follow the
+            "Profile searches" switch of the Search Profile page.
         client (Elasticsearch): The Elasticsearch client to use for the query.
 
     Returns:
         list: A list of Elasticsearch hits.
         query_body (dict): The query body used in the Elasticsearch query.
+        stats (dict): The stats of the search, for `build_search_metadata`.
         st.session_state.df_hits: A dataframe with all the hits 
         st.session_state.hits: An HTML representation of the dataframe
 
     """
 
-    if search_type in ["semantic", "text_expansion", "vector"]:
-        search_type = "semantic"
-        highlight = False
-
-    query_body = {"query": {}}
-
-    if search_type == "match":
-        query_body["query"]["match"] = {
-            field_name : {
-                "query": searchterm
-            }
-        }
-    elif search_type == "fuzzy":
-        query_body["query"]["fuzzy"] = {
-            field_name : {
-                "value": searchterm,
-                "fuzziness": fuzziness if fuzziness else "AUTO"
-            }
-        }
-
-    elif search_type == "semantic":
-
-        query_body["query"]["semantic"] = {
-            "field": field_name,
-            "query": searchterm
-        }
-
-    if 'highlight' not in query_body:
-        query_body['highlight'] = {}
-
-    if 'fields' not in query_body['highlight']:
-        query_body['highlight']['fields'] = {}
+    if filters is None:
+        filters = st.session_state.get('facet_filters', {})
+
+    query_body = build_search_request(build_single_field_query, searchterm,
+                                      field_name=field_name,
+                                      search_type=search_type,
+                                      fuzziness=fuzziness,
+                                      highlight=highlight,
+                                      source_fields=source_fields,
+                                      filters=filters,
+                                      facets=facets,
+                                      collapse=collapse,
+                                      suggest=suggest and search_type == "match",
+                                      size=size,
+                                      client=client)
+
+    if profile is None:
+        profile = st.session_state.get('profile_searches', False)
+
+    try:
+        hits, stats = guarded_search(search_type, query_body, index_name=index_name, client=client, profile=profile)
+    except SearchRejected as e:
+        fallback = search_fallbacks.get(search_type)
+        ic(f"{e}, falling back to {fallback}")
+
+        if fallback is None:
+            return [], query_body, {"took_ms": None, "round_trip_ms": 0.0, "profile": None, "rejected": str(e)}
+
+        # a semantic_text field can't be matched on, so the fallback searches the plain text
+        query_body = build_search_request(build_single_field_query, searchterm,
+                                          field_name=search_fallback_field if search_type == "semantic" else field_name,
+                                          search_type=fallback,
+                                          highlight=highlight,
+                                          source_fields=source_fields,
+                                          filters=filters,
+                                          facets=facets,
+                                          collapse=collapse,
+                                          suggest=suggest and fallback == "match",
+                                          size=size,
+                                          client=client)
+        return query_elastic_fallback(e, search_type, fallback, query_body, index_name, client, profile)
+
+    def build_corrected_query(corrected_term):
+        return build_search_request(build_single_field_query, corrected_term,
+                                    field_name=field_name,
+                                    search_type=search_type,
+                                    highlight=highlight,
+                                    source_fields=source_fields,
+                                    filters=filters,
+                                    facets=facets,
+                                    collapse=collapse,
+                                    size=size,
+                                    client=client)
+
+    return correct_spelling(searchterm, hits, stats, query_body, search_type, build_corrected_query,
+                            index_name=index_name, client=client, profile=profile)
+
+def query_elastic_fallback(rejection: SearchRejected,
+                           search_type: str,
+                           fallback: str,
+                           query_body: Dict,
+                           index_name=elastic_index_name,
+                           client=elastic_client,
+                           profile: bool = False):
+    """
+    Run the fallback query of a rejected search, noting the degradation in its stats.
 
-    if highlight:
-        query_body["highlight"]["fields"][field_name] = {}
+    Args:
+        rejection (SearchRejected): Why the search was rejected.
+        search_type (str): The search type that was rejected.
+        fallback (str): The search type of the fallback query.
+        query_body (dict): The fallback query body.
+        index_name (str): The name of the Elasticsearch index to search in.
+        client (Elasticsearch): The Elasticsearch client to use for the query.
+        profile (bool): Whether to run the search with the profile API.
 
-    response = client.search(index=index_name, body=query_body)
-    hits = response['hits']['hits']
+    Returns:
+        list: A list of Elasticsearch hits, empty if the fallback is rejected too.
+        query_body (dict): The fallback query body.
+        stats (dict): The stats of the fallback search.
+    """
+    try:
+        hits, stats = guarded_search(fallback, query_body, index_name=index_name, client=client, profile=profile)
+    except SearchRejected as e:
+        return [], query_body, {"took_ms": None, "round_trip_ms": 0.0, "profile": None, "rejected": str(e)}
 
-    return hits, query_body
+    return hits, query_body, {**stats, "fallback": f"{search_type} -> {fallback} ({rejection})"}
 
 def query_elastic_by_multiple_fields(searchterm: str, 
                   index_name=elastic_index_name, 
                   field_names=None, 
                   search_type="match",
                   fuzziness: str = None,
+                  source_fields: List[str] = None,
+                  filters: Dict[str, List[str]] = None,
+                  facets: bool = True,
+                  suggest: bool = True,
+                  collapse: bool = search_collapse,
+                  size: int = search_page_size,
+                  profile: bool = None,
                   client=elastic_client) -> List[Any]:
     """
     Query Elasticsearch by multiple fields.
@@ -327,50 +1529,389 @@ def query_elastic_by_multiple_fields(searchterm: str,
         field_names (list): A list of field names to search in.
         search_type (str): The type of search to perform. Options: "match" (default), "fuzzy".
         fuzziness (str): The fuzziness parameter for fuzzy search. Default is None.
+        source_fields (list): The fields to return in each hit. Default is None, for all but the embeddings.
+        filters (dict): The values to keep for each of the `facet_fields`. Default is None, to
+            follow the facet filters in the sidebar.
+        facets (bool): Whether to ask for the facet counts. Default is True.
+        suggest (bool): Whether a match search asks for a spelling correction, to offer or run
+            when nothing matches. Default is True.
+        collapse (bool): Whether to return only the best hit of each cluster of duplicate lines.
+            Default is SEARCH_COLLAPSE, or False.
+        size (int): The number of hits to return. Default is SEARCH_PAGE_SIZE, or 10.
+        profile (bool): Whether to profile the search. Default is None, to follow the
+            "Profile searches" switch of the Search Profile page.
         client (Elasticsearch): The Elasticsearch client to use for the query.
 
     Returns:
         hits: A list of Elasticsearch hits.
         query_body (dict): The query body used in the Elasticsearch query.
+        stats (dict): The stats of the search, for `build_search_metadata`.
 
     """
 
-    if search_type in ["semantic", "text_expansion", "vector"]:
-        search_type = "semantic"
-        highlight = False
+    if filters is None:
+        filters = st.session_state.get('facet_filters', {})
+
+    query_body = build_search_request(build_multiple_fields_query, searchterm,
+                                      field_names=field_names,
+                                      search_type=search_type,
+                                      fuzziness=fuzziness,
+                                      source_fields=source_fields,
+                                      filters=filters,
+                                      facets=facets,
+                                      collapse=collapse,
+                                      suggest=suggest and search_type == "match",
+                                      size=size,
+                                      client=client)
+
+    if profile is None:
+        profile = st.session_state.get('profile_searches', False)
+
+    try:
+        hits, stats = guarded_search(search_type, query_body, index_name=index_name, client=client, profile=profile)
+    except SearchRejected as e:
+        fallback = search_fallbacks.get(search_type)
+        ic(f"{e}, falling back to {fallback}")
+
+        if fallback is None:
+            return [], query_body, {"took_ms": None, "round_trip_ms": 0.0, "profile": None, "rejected": str(e)}
+
+        query_body = build_search_request(build_multiple_fields_query, searchterm,
+                                          field_names=field_names,
+                                          search_type=fallback,
+                                          source_fields=source_fields,
+                                          filters=filters,
+                                          facets=facets,
+                                          collapse=collapse,
+                                          suggest=suggest and fallback == "match",
+                                          size=size,
+                                          client=client)
+        return query_elastic_fallback(e, search_type, fallback, query_body, index_name, client, profile)
+
+    def build_corrected_query(corrected_term):
+        return build_search_request(build_multiple_fields_query, corrected_term,
+                                    field_names=field_names,
+                                    search_type=search_type,
+                                    source_fields=source_fields,
+                                    filters=filters,
+                                    facets=facets,
+                                    collapse=collapse,
+                                    size=size,
+                                    client=client)
+
+    return correct_spelling(searchterm, hits, stats, query_body, search_type, build_corrected_query,
+                            index_name=index_name, client=client, profile=profile)
+
+def query_elastic_hybrid(searchterm: str,
+                         index_name=elastic_index_name,
+                         field_names: List[str] = None,
+                         semantic_field_name: str = elastic_sparse_field_name,
+                         dense_field_name: str = None,
+                         source_fields: List[str] = None,
+                         filters: Dict[str, List[str]] = None,
+                         facets: bool = True,
+                         collapse: bool = search_collapse,
+                         size: int = search_page_size,
+                         profile: bool = None,
+                         client=elastic_client) -> List[Any]:
+    """
+    Query Elasticsearch with a hybrid query, or with a knn query when a dense vector field is given.
 
-    query_body = {"query": {}}
+    The weights of the hybrid query and the k and candidates of the knn query are the
+    HYBRID_* and KNN_* settings picked by `python tuning.py run ... --write_env`.
 
-    if search_type == "match":
-        # Use multi_match query to search in multiple fields
-        query_body["query"]["multi_match"] = {
-            "query": searchterm,
-            "fields": field_names
-        }
-    elif search_type == "fuzzy":
-        # You need to write a loop for fuzzy search in multiple fields
-        query_body["query"]["bool"] = {
-            "should": [
-                {
-                    "fuzzy": {
-                        field_name: {
-                            "value": searchterm,
-                            "fuzziness": fuzziness if fuzziness else "AUTO"
-                        }
-                    }
-                }
-                for field_name in field_names
-            ]
-        }
+    Args:
+        searchterm (str): The search term to query.
+        index_name (str): The name of the Elasticsearch index to search in.
+        field_names (list): The text fields of the lexical part. Default is None, for text and heading.
+        semantic_field_name (str): The semantic_text field of the semantic part.
+        dense_field_name (str): The dense_vector field to search instead. Default is None, for a hybrid query.
+        source_fields (list): The fields to return in each hit. Default is None, for all but the embeddings.
+        filters (dict): The values to keep for each of the `facet_fields`. Default is None, to
+            follow the facet filters in the sidebar.
+        facets (bool): Whether to ask for the facet counts. Default is True.
+        collapse (bool): Whether a hybrid query returns only the best hit of each cluster of
+            duplicate lines. Default is SEARCH_COLLAPSE, or False.
+        size (int): The number of hits to return. Default is SEARCH_PAGE_SIZE, or 10.
+        profile (bool): Whether to profile the search. Default is None, to follow the
+            "Profile searches" switch of the Search Profile page.
+        client (Elasticsearch): The Elasticsearch client to use for the query.
+
+    Returns:
+        hits: A list of Elasticsearch hits.
+        query_body (dict): The query body used in the Elasticsearch query.
+        stats (dict): The stats of the search, for `build_search_metadata`.
+    """
+    if filters is None:
+        filters = st.session_state.get('facet_filters', {})
+
+    if profile is None:
+        profile = st.session_state.get('profile_searches', False)
+
+    field_names = field_names or ['text', 'heading']
+
+    if dense_field_name:
+        # a knn body has no query for a template to wrap
+        search_type = "knn"
+        query_body = build_search_request(build_knn_query, searchterm, field_name=dense_field_name, source_fields=source_fields,
+                                          filters=filters, facets=facets, size=size, templates=False, client=client)
+    else:
+        search_type = "hybrid"
+        query_body = build_search_request(build_hybrid_query, searchterm, field_names=field_names,
+                                          semantic_field_name=semantic_field_name, source_fields=source_fields,
+                                          filters=filters, facets=facets, collapse=collapse, size=size, client=client)
+
+    try:
+        hits, stats = guarded_search(search_type, query_body, index_name=index_name, client=client, profile=profile)
+    except SearchRejected as e:
+        fallback = search_fallbacks[search_type]
+        ic(f"{e}, falling back to {fallback}")
+
+        query_body = build_search_request(build_multiple_fields_query, searchterm,
+                                          field_names=field_names,
+                                          search_type=fallback,
+                                          source_fields=source_fields,
+                                          filters=filters,
+                                          facets=facets,
+                                          collapse=collapse,
+                                          size=size,
+                                          client=client)
+        return query_elastic_fallback(e, search_type, fallback, query_body, index_name, client, profile)
+
+    return hits, query_body, stats
+
+def build_search_request(builder,
+                         searchterm: str,
+                         size: int = search_page_size,
+                         filters: Dict[str, List[str]] = None,
+                         templates: bool = search_templates_enabled,
+                         client=elastic_client,
+                         **shape) -> Dict:
+    """
+    Build the request of a search: the ID and parameters of a stored search template, or the query body.
+
+    With templates, the body is only built once per query shape, and each search only sends
+    the search term, size and filters. The template is stored the first time it is used, and
+    if it can't be, it is sent inline with the parameters instead.
+
+    Args:
+        builder (function): The query builder, e.g. `build_single_field_query`.
+        searchterm (str): The search term to query.
+        size (int): The number of hits to return. Default is SEARCH_PAGE_SIZE, or 10.
+        filters (dict): The values to keep for each of the `facet_fields`. Default is None, for no filter.
+        templates (bool): Whether to use a search template. Default is SEARCH_TEMPLATES, or True.
+        client (Elasticsearch): The Elasticsearch client to store the template with.
+        **shape: The other arguments of the builder.
+
+    Returns:
+        dict: The template request, with an "id" or "source" and "params", or the query body.
+    """
+    if not templates:
+        return builder(searchterm, size=size, filters=filters, **shape)
+
+    # the builder leaves out the trigram prefilter for short terms, so that is part of the shape
+    if builder is build_single_field_query and shape.get('search_type') == 'fuzzy':
+        shape['trigram_prefilter'] = shape.get('trigram_prefilter', fuzzy_trigram_prefilter) and len(searchterm) >= 3
 
-    if 'highlight' not in query_body:
-        query_body['highlight'] = {}
+    template_id, source = build_search_template(builder, template_shape(builder, **shape))
+    params = {"searchterm": searchterm, "size": size, "filters": build_filter_clauses(filters)}
 
-    if 'fields' not in query_body['highlight']:
-        query_body['highlight']['fields'] = {}
+    if stored_templates.store(template_id, source, client=client):
+        return {"id": template_id, "params": params}
 
+    return {"source": source, "params": params}
+
+def call_with_stored_template(call, query_body: Dict, client=elastic_client):
+    """
+    Make a request that refers to a stored template, and if Elasticsearch lost the template,
+    store it again and make the request once more.
+
+    Args:
+        call (function): Makes the request, without arguments.
+        query_body (dict): The template request the call sends.
+        client (Elasticsearch): The Elasticsearch client to store the template with.
+
+    Returns:
+        The response of the call.
+    """
+    try:
+        return call()
+    except NotFoundError as e:
+        # a missing index is a not found error too, and storing the template won't help with it
+        if not query_body.get('id') or e.error != 'resource_not_found_exception' or \
+                not stored_templates.restore(query_body['id'], client=client):
+            raise
+
+    ic(f"Search template {query_body['id']} was missing, stored it again")
+    return call()
+
+def render_search_request(query_body: Dict, client=elastic_client) -> Dict:
+    """
+    Turn a template request into the query body it stands for, for the searches that change the body.
+
+    Args:
+        query_body (dict): The query body, or a template request.
+        client (Elasticsearch): The Elasticsearch client.
+
+    Returns:
+        dict: The query body.
+    """
+    if 'params' not in query_body:
+        return query_body
+
+    response = call_with_stored_template(lambda: client.render_search_template(id=query_body.get('id'),
+                                                                               source=query_body.get('source'),
+                                                                               params=query_body['params']),
+                                         query_body, client=client)
+    return response['template_output']
+
+def index_generation(index_name=elastic_index_name, client=elastic_client) -> tuple:
+    """
+    Identify the concrete indices behind an index name and their content. They change when
+    it is rebuilt or its alias is swapped, and the generation in the `_meta` of their mapping
+    changes when the indexing commands write to them.
+
+    Args:
+        index_name (str): The name of the index or alias.
+        client (Elasticsearch): The Elasticsearch client.
+
+    Returns:
+        tuple: The sorted names, UUIDs and generations of the concrete indices.
+    """
+    indices = client.indices.get(index=index_name, filter_path=['*.settings.index.uuid', '*.mappings._meta.generation'])
+    return tuple(sorted((name, index['settings']['index']['uuid'], index.get('mappings', {}).get('_meta', {}).get('generation'))
+                        for name, index in indices.items()))
+
+def current_index_generation(index_name=elastic_index_name, client=elastic_client) -> tuple:
+    """
+    Get the generation of an index, as Elasticsearch gave it at most SEARCH_GENERATION_TTL seconds ago.
+
+    Args:
+        index_name (str): The name of the index or alias.
+        client (Elasticsearch): The Elasticsearch client.
+
+    Returns:
+        tuple: The generation, as returned by `index_generation`, or an empty tuple if it can't be read.
+    """
+    key = ResultCache.key(index_name)
+    generation = generation_cache.get(key)
+
+    if generation is None:
+        try:
+            generation = index_generation(index_name=index_name, client=client)
+        except Exception as e:
+            ic(f"Could not get the generation of {index_name}: {e}")
+            generation = ()
+        generation_cache.put(key, generation)
+
+    return generation
+
+class CacheWarmer:
+    """
+    Replay the most frequent searches of each page from the history store, ahead of traffic.
+
+    The searches are replayed with the query bodies the pages last ran them with, so they land
+    on the same keys of the result cache, and knn searches fill the embedding cache on the way.
+    Every `interval` seconds the warmer refreshes the results before they expire; when the
+    index is rebuilt, its alias swapped or new lines written to it, it drops the cache and
+    warms it again right away.
+    """
+
+    def __init__(self, history=history_store,
+                 index_name=elastic_index_name,
+                 client=elastic_client,
+                 interval: float = cache_warmer_interval,
+                 top_n: int = cache_warmer_top_n,
+                 concurrency: int = cache_warmer_concurrency):
+        self.history = history
+        self.index_name = index_name
+        self.client = client
+        self.interval = interval
+        self.top_n = top_n
+        self.concurrency = concurrency
+        self.generation = None
+        self.warmed = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def warm(self) -> int:
+        """
+        Replay the top searches of each page once.
+
+        Returns:
+            int: The number of searches replayed.
+        """
+        df_top = self.history.top_query_bodies(limit=self.top_n)
+        bodies = [json.loads(body) for body in df_top['search_query']]
+        bodies = [body for body in bodies if isinstance(body, dict) and body]
+
+        def replay(body):
+            try:
+                fetch_hits(body, index_name=self.index_name, client=self.client, refresh=True)
+                return 1
+            except Exception as e:
+                ic(f"Could not warm search: {e}")
+                return 0
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="warmer") as executor:
+            warmed = sum(executor.map(replay, bodies))
+
+        self.warmed += warmed
+        ic(f"Warmed {warmed} of {len(bodies)} searches")
+        return warmed
+
+    def check_generation(self) -> bool:
+        """
+        Drop the result cache if the index has changed since the last check.
+
+        Returns:
+            bool: Whether the index changed.
+        """
+        generation = index_generation(index_name=self.index_name, client=self.client)
+        changed = generation != self.generation
+
+        if changed:
+            if self.generation is not None:
+                ic(f"Index {self.index_name} changed, dropping the result cache")
+                result_cache.clear()
+            self.generation = generation
+
+        return changed
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.check_generation()
+                self.warm()
+            except Exception as e:
+                ic(f"Cache warming failed: {e}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Start warming on a background thread.
+        """
+        self._thread = threading.Thread(target=self._run, name="cache-warmer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+@st.cache_resource
+def get_cache_warmer(interval):
+    """
+    Get the cache warmer, shared by all sessions, and start it if CACHE_WARMER_INTERVAL is set.
+
+    Args:
+        interval (float): The seconds between two warmings. 0 turns the warmer off.
+
+    Returns:
+        CacheWarmer: The warmer, or None when it is off.
+    """
+    if interval <= 0:
+        return None
 
-    response = client.search(index=index_name, body=query_body)
-    hits = response['hits']['hits']
+    return CacheWarmer(interval=interval).start()
 
-    return hits, query_body
+cache_warmer = get_cache_warmer(cache_warmer_interval)